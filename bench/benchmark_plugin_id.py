@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import argparse
+import copy
+import logging
+import os
+import sys
+import timeit
+
+# 从仓库根目录导入src，运行方式：python bench/benchmark_plugin_id.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.setting import PROJECT_SETTING
+from src.utils import tools
+
+
+def get_args():
+    """
+    获取参数
+    :return: 参数集合
+    """
+    args = argparse.ArgumentParser(description=u'benchmark plugin id hashing.')
+    args.add_argument(u'--number', type=int, default=10000, help=u'每种算法的执行次数')
+    return args.parse_args()
+
+
+def build_samples():
+    """
+    构造测试用的配置和消息
+    :return: 配置 | 消息
+    """
+    config = copy.deepcopy(PROJECT_SETTING[u'COMMON'])
+    config.update(PROJECT_SETTING[u'PLUGINS'][u'CRAWLER00'][0])
+    message = {
+        u'company': u'北京百度网讯科技有限公司',
+        u'_traceid': u'Q8hX2mK0aP4tLr9ZcB',
+        u'_sent_time': u'2018-01-01 12:00:00',
+        u'province': u'BJ',
+        u'tags': [u'互联网', u'搜索', u'人工智能'],
+        u'extra': {u'source': u'kafka', u'retry': 0, u'pages': [1, 2, 3]}
+    }
+    return config, message
+
+
+def bench(name, func, number):
+    """
+    执行并输出单次调用耗时
+    :param name: 名称
+    :param func: 被测函数
+    :param number: 执行次数
+    :return: 无
+    """
+    cost = min(timeit.repeat(func, number=number, repeat=3))
+    print(u'{0:<28}{1:>10.2f} us/call'.format(name, cost / number * 1000000))
+
+
+if __name__ == u'__main__':
+    params = get_args()
+    # 旧版算法遇到非ASCII字符时会记录异常日志，测试时关闭日志输出
+    logging.disable(logging.CRITICAL)
+    sample_config, sample_message = build_samples()
+    bench(u'config legacy', lambda: tools.build_plugin_id(sample_config, legacy=True), params.number)
+    bench(u'config fast', lambda: tools.build_plugin_id(sample_config, legacy=False), params.number)
+    bench(u'config fast + memo', lambda: tools.build_plugin_id(sample_config, memo=True, legacy=False), params.number)
+    bench(u'message legacy', lambda: tools.build_plugin_id(sample_message, legacy=True), params.number)
+    bench(u'message fast', lambda: tools.build_plugin_id(sample_message, legacy=False), params.number)
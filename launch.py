@@ -2,6 +2,7 @@
 from gevent import monkey
 monkey.patch_all()
 import argparse
+import logging
 from src.utils import tools
 from src.cores import launcher
 
@@ -15,9 +16,25 @@ def get_args():
     args.add_argument(u'--schema', default=u'STATIC', help=u'schema')
     args.add_argument(u'--log_level', default=u'debug', help=u'日志等级')
     args.add_argument(u'--task', type=int, default=1, help=u'并发量')
+    args.add_argument(u'--workers', type=int, default=1, help=u'进程数，大于1时每个进程运行独立的事件循环')
+    args.add_argument(u'--role', default=u'all', choices=[u'all', u'provider', u'consumer'],
+                      help=u'运行角色，QUEUE_BACKEND为redis时可以将消息提供和消息处理分别部署在不同的机器上')
     return args.parse_args()
 
 
+def init_worker(args):
+    """
+    worker进程初始化，每个worker输出到单独的日志文件
+    :param args: 运行参数
+    :return: 无
+    """
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    log_file = u'logs/iCrawler_{0}_worker{1}.log'.format(args.schema, args.worker_index)
+    tools.allot_logger(filename=log_file, level=args.log_level)
+
+
 def run(args):
     """
     开始函数
@@ -26,7 +43,10 @@ def run(args):
     """
     log_file = u'logs/iCrawler_{0}.log'.format(args.schema)
     tools.allot_logger(filename=log_file, level=args.log_level)
-    launcher.run(args)
+    if args.workers > 1:
+        launcher.run_workers(args, init_worker)
+    else:
+        launcher.run(args)
 
 
 if __name__ == u'__main__':
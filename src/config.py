@@ -2,7 +2,25 @@
 ENVIRONMENT = u'DEV'
 RESULT_QUEUE_MAX_SIZE = 1000
 SOURCE_QUEUE_MAX_SIZE = 1000
+# 队列水位统计日志的输出间隔(秒)，为0时不输出
+QUEUE_METRICS_INTERVAL = 60
 CACHE_FILE_KEY = u'__cache_file__'
+# 分布式队列的投递回执在消息中的键
+QUEUE_RECEIPT_KEY = u'__queue_receipt__'
+# 消息队列和结果队列的实现：local-进程内优先级队列；redis-多台机器共享的redis队列
+QUEUE_BACKEND = u'local'
+# 插件ID算法：fast-单次规范序列化后MD5；legacy-旧版逐层MD5，与旧版本生成的缓存文件名一致
+PLUGIN_ID_SCHEMA = u'fast'
+
+# http连接池配置
+HTTP_POOL_CONFIG = {
+    u'pool_connections': 10,    # 每个session缓存的连接池(host)数量
+    u'pool_maxsize': 50,        # 每个host连接池保持的最大连接数
+    u'pool_block': False,       # 连接池已满时是否阻塞等待
+    u'max_sessions': 500,       # 最多保留的session数量(按host+代理区分)
+    u'idle_timeout': 300,       # session空闲超过该时间(秒)后被回收
+    u'sweep_interval': 60       # 空闲回收检查间隔(秒)
+}
 
 # 卡夫卡消息队列服务配置
 KAFKA_CONFIG = {
@@ -20,6 +38,14 @@ KAFKA_CONFIG = {
     }
 }
 
+# 卡夫卡批量发送配置
+KAFKA_PRODUCER_CONFIG = {
+    u'max_records': 200,            # 单个topic单批最多发送的消息数量
+    u'max_bytes': 1024 * 1024,      # 单个topic单批最多发送的字节数
+    u'linger': 1.0,                 # 消息在缓冲中的最长停留时间(秒)
+    u'max_buffered': 5000           # 缓冲消息总数上限，超出后同步发送
+}
+
 # flask服务配置
 FLASK_SERVICE_CONFIG = {
     u'DEV': {
@@ -109,6 +135,31 @@ MYSQL_CONFIG = {
     },         # 开发库_本地连接
 }
 
+# MySQL连接池配置(直接连接数据库时使用)
+MYSQL_POOL_CONFIG = {
+    u'max_size': 10,                # 每个schema的最大连接数
+    u'checkout_timeout': 30,        # 连接数达到上限时取连接的最长等待时间(秒)
+    u'connect_timeout': 10,         # 建立连接的超时时间(秒)
+    u'max_lifetime': 3600,          # 连接的最长存活时间(秒)，超出后归还时关闭，避免被服务端超时断开
+    u'ping_interval': 30,           # 连接空闲超过该时间(秒)后，取出时先ping检查
+    u'retries': 1                   # 查询时连接失效的重试次数
+}
+
+# MySQL批量写入配置
+MYSQL_WRITER_CONFIG = {
+    u'max_records': 500,                # 单个表单批最多写入的行数
+    u'max_bytes': 1024 * 1024,          # 单个表单批最多写入的字节数(需小于服务端的max_allowed_packet)
+    u'linger': 1.0,                     # 数据在缓冲中的最长停留时间(秒)
+    u'max_buffered': 5000               # 缓冲行数上限，超出后同步写入
+}
+
+# MySQL批量写入遇到暂时性错误(连接失效、服务不可用等)时的整批重试配置
+MYSQL_WRITER_RETRY_CONFIG = {
+    u'retries': 5,                      # 最大重试次数，用尽后该批数据写入失败
+    u'backoff': 1,                      # 首次重试前等待的时间(秒)，之后每次翻倍
+    u'max_backoff': 30                  # 重试前最长等待的时间(秒)
+}
+
 # oss配置
 OSS_CONFIG = {
     u'SERVICE': {
@@ -162,6 +213,55 @@ OTS_CONFIG = {
     }
 }
 
+# 文件数据源读取配置
+FILE_INGEST_CONFIG = {
+    u'chunk_size': 500,                     # 每次在线程池中从文件读取的数据条数
+    u'report_interval': 60                  # 各文件读取进度日志的输出间隔(秒)，为0时不输出
+}
+
+# 消息预写日志配置
+WAL_CONFIG = {
+    u'path': u'cache/wal',                  # 日志目录
+    u'segment_bytes': 64 * 1024 * 1024,     # 单个分段的最大字节数，超出后封存并写新的分段
+    u'flush_interval': 0,                   # 缓冲写入操作系统的间隔(秒)，为0时每条记录立即写入
+    u'compact_interval': 300                # 压缩已封存分段的间隔(秒)，为0时不压缩
+}
+
+# OTS批量写入配置
+OTS_WRITER_CONFIG = {
+    u'max_records': 100,                # 单个表单批最多写入的行数(OTS单次批量写上限为200行)
+    u'max_bytes': 3 * 1024 * 1024,      # 单个表单批最多写入的字节数(OTS单次批量写上限为4MB)
+    u'linger': 1.0,                     # 数据在缓冲中的最长停留时间(秒)
+    u'max_buffered': 5000               # 缓冲行数上限，超出后同步写入
+}
+
+# 本地查重缓存配置
+DEDUP_CACHE_CONFIG = {
+    u'path': u'cache/dedup',            # 布隆过滤器文件目录，每种数据类型一个文件
+    u'capacity': 5000000,               # 每种数据类型预计的数据量
+    u'error_rate': 0.00001,             # 达到预计数据量时的误判率，误判的数据会被当作重复数据
+    u'negative_ttl': 60,                # 查重服务确认不存在的结果的缓存时间(秒)
+    u'negative_max_size': 100000,       # 不存在结果的最大缓存数量
+    u'concurrency': 10,                 # 并发请求查重服务的数量
+    u'writer': {                        # 查重服务的异步批量写入
+        u'max_records': 200,
+        u'max_bytes': 0,
+        u'linger': 1.0,
+        u'max_buffered': 5000
+    }
+}
+
+# 企业eid查询配置
+EID_RESOLVER_CONFIG = {
+    u'schema': u'gs',                   # 企业库的模式名
+    u'table': u'entities',              # 企业库的表名
+    u'max_size': 100000,                # 最大缓存数量
+    u'ttl': 3600,                       # 查询到的eid的缓存时间(秒)
+    u'negative_ttl': 300,               # 查不到的企业的缓存时间(秒)
+    u'max_batch': 100,                  # 单次$in查询的最大企业数
+    u'linger': 0                        # 合并查询前等待的时间(秒)，为0时只合并同一轮事件循环中的查询
+}
+
 # redis配置
 REDIS_CONFIG = {
     u'DEV': {
@@ -193,6 +293,31 @@ REDIS_CONFIG = {
     }
 }
 
+# redis连接池配置
+REDIS_POOL_CONFIG = {
+    u'max_connections': 50,             # 每个schema和index的最大连接数
+    u'timeout': 20,                     # 连接数达到上限时取连接的最长等待时间(秒)
+    u'socket_timeout': 10,              # 命令的超时时间(秒)
+    u'socket_connect_timeout': 5,       # 建立连接的超时时间(秒)
+    u'health_check_interval': 30,       # 连接空闲超过该时间(秒)后，使用前先检查
+    u'backoff': 0.5,                    # 连接出错后首次重连的等待时间(秒)，之后每次翻倍
+    u'max_backoff': 30                  # 重连的最长等待时间(秒)
+}
+
+# redis分布式队列配置(QUEUE_BACKEND为redis时使用)
+REDIS_QUEUE_CONFIG = {
+    u'schema': u'R2M',                  # REDIS_CONFIG中的schema
+    u'index': None,                     # redis index，为None时使用REDIS_CONFIG中的index
+    u'prefix': u'icrawler',             # 队列key的前缀，完整的key为 前缀:运行模式:队列名:类型
+    u'visibility_timeout': 600,         # 消息取出后未确认的最长时间(秒)，超时后重新放回队列
+    u'heartbeat_interval': 60,          # 处理中的消息延长可见性超时的间隔(秒)，为0时不延长
+    u'max_lease': 21600,                # 处理中的消息最多延长到取出后的该时间(秒)，之后超时重新放回队列
+    u'prefetch': 20,                    # 每个进程预取的消息数量
+    u'poll_interval': 0.5,              # 队列为空时的轮询间隔(秒)
+    u'reclaim_interval': 30,            # 检查超时未确认消息的间隔(秒)
+    u'size_cache': 1.0                  # 写入时检查队列长度的缓存时间(秒)
+}
+
 # 代理配置
 PROXY_CONFIG = {
     u'DEV': {
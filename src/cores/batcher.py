@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import atexit
+import logging
+import threading
+import time
+
+import gevent
+from gevent.event import AsyncResult
+
+
+class BatchWriter(object):
+    """按键分组缓冲记录，达到数量、字节数或等待时间阈值时批量写出，每条记录的写出结果在写出后通知调用方"""
+
+    __writers = list()
+    __mutex = threading.Lock()
+
+    def __init__(self, name, flush_func, max_records=200, max_bytes=1024 * 1024, linger=1.0, max_buffered=5000):
+        """
+        初始化批量写出器
+        :param name: 名称，仅用于日志
+        :param flush_func: 写出函数，调用方式为flush_func(key, records)，返回每条记录是否写出成功的列表，
+            返回None时视为全部成功，抛出异常时视为全部失败
+        :param max_records: 单个键缓冲的最大记录数，达到后立即写出
+        :param max_bytes: 单个键缓冲的最大字节数，达到后立即写出
+        :param linger: 记录在缓冲中的最长停留时间（秒）
+        :param max_buffered: 所有键缓冲的记录总数上限，超出后由调用方同步写出
+        """
+        self.name = name
+        self.flush_func = flush_func
+        self.max_records = max(1, max_records)
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.max_buffered = max(self.max_records, max_buffered)
+        self.__buffers = dict()
+        self.__results = dict()
+        self.__bytes = dict()
+        self.__since = dict()
+        self.__count = 0
+        self.__lock = threading.Lock()
+        self.__flusher = None
+        BatchWriter.__register(self)
+
+    @classmethod
+    def __register(cls, writer):
+        """
+        登记写出器，进程退出时统一写出
+        :param writer: 写出器
+        :return: 无
+        """
+        with cls.__mutex:
+            if not cls.__writers:
+                atexit.register(cls.flush_all)
+            cls.__writers.append(writer)
+
+    @classmethod
+    def flush_all(cls):
+        """
+        写出所有写出器中缓冲的记录
+        :return: 无
+        """
+        with cls.__mutex:
+            writers = list(cls.__writers)
+        for writer in writers:
+            writer.flush()
+
+    def __len__(self):
+        return self.__count
+
+    def put(self, key, record, size=0):
+        """
+        缓冲一条记录
+        :param key: 分组键
+        :param record: 记录
+        :param size: 记录的字节数
+        :return: 写出结果，记录写出后get()返回是否写出成功
+        """
+        result = AsyncResult()
+        with self.__lock:
+            if key not in self.__buffers:
+                self.__buffers[key] = list()
+                self.__results[key] = list()
+                self.__bytes[key] = 0
+                self.__since[key] = time.time()
+            self.__buffers[key].append(record)
+            self.__results[key].append(result)
+            self.__bytes[key] += size
+            self.__count += 1
+            full = len(self.__buffers[key]) >= self.max_records or \
+                (self.max_bytes and self.__bytes[key] >= self.max_bytes)
+            overflow = self.__count >= self.max_buffered
+        if self.__flusher is None:
+            self.__flusher = gevent.spawn(self.__linger_loop)
+        if overflow:
+            self.flush()
+        elif full:
+            self.flush(key)
+        return result
+
+    def __take(self, key):
+        """
+        取出指定键缓冲的记录
+        :param key: 分组键
+        :return: 记录列表 | 写出结果列表
+        """
+        with self.__lock:
+            records = self.__buffers.pop(key, None) or list()
+            results = self.__results.pop(key, None) or list()
+            self.__bytes.pop(key, None)
+            self.__since.pop(key, None)
+            self.__count -= len(records)
+        return records, results
+
+    def __write(self, key, records, results):
+        """
+        写出一组记录，并通知每条记录的写出结果
+        :param key: 分组键
+        :param records: 记录列表
+        :param results: 写出结果列表
+        :return: 无
+        """
+        if not records:
+            return
+        try:
+            outcome = self.flush_func(key, records)
+            logging.debug(u'{0} flushed {1} records of {2}.'.format(self.name, len(records), key))
+        except Exception as e:
+            logging.exception(u'{0} failed to flush {1} records of {2}! - {3}'.format(
+                self.name, len(records), key, e.message))
+            outcome = list()
+        for i, result in enumerate(results):
+            result.set(True if outcome is None else i < len(outcome) and bool(outcome[i]))
+
+    def flush(self, key=None):
+        """
+        写出缓冲的记录
+        :param key: 分组键，默认写出所有键
+        :return: 无
+        """
+        if key is not None:
+            self.__write(key, *self.__take(key))
+        else:
+            with self.__lock:
+                keys = list(self.__buffers.keys())
+            for k in keys:
+                self.__write(k, *self.__take(k))
+
+    def __linger_loop(self):
+        """
+        定时写出停留时间超过linger的记录
+        :return: 无
+        """
+        while 1:
+            try:
+                gevent.sleep(max(0.01, self.linger / 2.0))
+                now = time.time()
+                with self.__lock:
+                    keys = [k for k, since in self.__since.items() if now - since >= self.linger]
+                for key in keys:
+                    self.flush(key)
+            except Exception as e:
+                logging.exception(u'{0} linger loop error! - {1}'.format(self.name, e.message))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
 import datetime
+import decimal
 from bson import ObjectId
 
 
@@ -13,5 +14,7 @@ class CustomerJsonEncoder(json.JSONEncoder):
             return obj.strftime(u'%Y-%m-%d')
         elif isinstance(obj, ObjectId):
             return str(obj)
+        elif isinstance(obj, decimal.Decimal):
+            return float(obj)
         else:
             return json.JSONEncoder.default(self, obj)
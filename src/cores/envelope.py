@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import sys
+
+from src.cores.customer import CustomerJsonEncoder
+from src.cores.registry import ConfigRegistry
+
+
+class QueueEnvelope(object):
+    """队列元素，在进程内直接携带消息和结果对象，配置只通过插件ID引用"""
+
+    __slots__ = (u'priority', u'sequence', u'message', u'config_id', u'result', u'receipt')
+
+    __counter = itertools.count()
+
+    def __init__(self, priority, message, config_id, result=None):
+        """
+        初始化队列元素
+        :param priority: 优先级，数字越小优先级越高
+        :param message: 消息
+        :param config_id: 插件ID，对应的配置登记在ConfigRegistry中
+        :param result: 处理结果，仅结果队列使用
+        """
+        self.priority = int(priority)
+        self.sequence = next(QueueEnvelope.__counter)
+        self.message = message
+        self.config_id = config_id
+        self.result = result
+        # 分布式队列的投递回执，处理完成后用于确认，不参与序列化
+        self.receipt = None
+
+    @classmethod
+    def stop(cls, last=False):
+        """
+        构造停止信号，消费者取到后退出
+        :param last: 是否排在队列中所有元素之后，否则排在所有元素之前
+        :return: 停止信号
+        """
+        return cls(sys.maxsize if last else -sys.maxsize, None, None)
+
+    @property
+    def is_stop(self):
+        """
+        是否为停止信号
+        :return: 判断结果
+        """
+        return self.config_id is None
+
+    @property
+    def config(self):
+        """
+        插件配置
+        :return: 插件配置
+        """
+        return ConfigRegistry.get(self.config_id)
+
+    def __lt__(self, other):
+        # 优先级相同时按入队顺序出队
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def dumps(self):
+        """
+        序列化，用于跨进程传递。接收方进程需要登记相同的插件配置
+        :return: 序列化结果
+        """
+        return json.dumps(
+            {
+                u'priority': self.priority,
+                u'message': self.message,
+                u'config_id': self.config_id,
+                u'result': self.result
+            },
+            ensure_ascii=False,
+            cls=CustomerJsonEncoder
+        )
+
+    @classmethod
+    def loads(cls, text):
+        """
+        反序列化
+        :param text: 序列化结果
+        :return: 队列元素
+        """
+        args = json.loads(text)
+        return cls(args[u'priority'], args[u'message'], args[u'config_id'], args.get(u'result'))
+
+
+class SerializingQueue(object):
+    """对跨进程队列进行包装，入队时序列化、出队时反序列化队列元素"""
+
+    def __init__(self, queue):
+        """
+        初始化
+        :param queue: 被包装的队列，需要支持put、get和qsize
+        """
+        self.queue = queue
+
+    def put(self, envelope, *args, **kwargs):
+        # 携带优先级和序号，被包装的队列为优先级队列时依然有序
+        self.queue.put((envelope.priority, envelope.sequence, envelope.dumps()), *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return QueueEnvelope.loads(self.queue.get(*args, **kwargs)[-1])
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
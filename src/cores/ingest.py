@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import time
+
+import gevent
+from gevent.event import Event
+from gevent.queue import Queue
+
+
+def _take(rows, size):
+    """
+    在线程池中执行：从文件读取最多size条数据
+    :param rows: 数据生成器
+    :param size: 数量
+    :return: 数据列表
+    """
+    return list(itertools.islice(rows, size))
+
+
+class _FileTask(object):
+    """单个文件的读取任务"""
+
+    def __init__(self, filename, rows, push, total, weight, on_finish):
+        self.filename = filename
+        self.rows = rows
+        self.push = push
+        self.total = total
+        self.weight = max(1, weight)
+        self.on_finish = on_finish
+        self.buffer = Queue(maxsize=2)
+        self.current = 0
+        self.count = 0
+        self.position = 0
+        self.start_position = None
+        self.start_time = None
+        self.reader = None
+
+
+class FileIngestScheduler(object):
+    """
+    文件数据源调度器：同时读取多个文件，文件的读取和解析在线程池中进行，不阻塞事件循环；
+    各文件的数据按权重平滑交替写入消息队列，并定时输出各文件的进度和预计剩余时间
+    """
+
+    def __init__(self, name, concurrency=4, chunk_size=500, report_interval=60):
+        """
+        初始化
+        :param name: 名称，仅用于日志
+        :param concurrency: 同时读取的文件数
+        :param chunk_size: 每次从文件读取的数据条数
+        :param report_interval: 进度日志的输出间隔（秒），为0时不输出
+        """
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.chunk_size = max(1, chunk_size)
+        self.report_interval = report_interval
+        self.__pending = list()
+        self.__active = list()
+        self.__ready = Event()
+
+    def add(self, filename, rows, push, total=None, weight=1, on_finish=None):
+        """
+        添加文件
+        :param filename: 文件名
+        :param rows: 数据生成器，在线程池中迭代，产生(消息, 读取位置, 进度状态)
+        :param push: 写入函数，在事件循环中调用，调用方式为push(消息, 进度状态)
+        :param total: 读取位置的最大值，用于计算进度和预计剩余时间
+        :param weight: 权重，同时读取的文件按权重分配写入的数据量
+        :param on_finish: 文件读取完毕后的回调函数
+        :return: 无
+        """
+        self.__pending.append(_FileTask(filename, rows, push, total, weight, on_finish))
+
+    def __read(self, task):
+        """
+        读取文件数据，每次读取一批放入文件的缓冲区，缓冲区满时暂停读取
+        :param task: 读取任务
+        :return: 无
+        """
+        threadpool = gevent.get_hub().threadpool
+        try:
+            while 1:
+                chunk = threadpool.apply(_take, (task.rows, self.chunk_size))
+                task.buffer.put(chunk)
+                self.__ready.set()
+                if not chunk:
+                    break
+        except Exception as e:
+            logging.exception(u'{0} failed to read {1}! - {2}'.format(self.name, task.filename, e.message))
+            task.buffer.put(None)
+            self.__ready.set()
+
+    def __start(self):
+        """
+        启动等待中的文件，直到达到并发数
+        :return: 无
+        """
+        while self.__pending and len(self.__active) < self.concurrency:
+            task = self.__pending.pop(0)
+            task.start_time = time.time()
+            task.reader = gevent.spawn(self.__read, task)
+            self.__active.append(task)
+            logging.info(u'{0} started reading {1}.'.format(self.name, task.filename))
+
+    def __choose(self):
+        """
+        平滑加权轮询，从缓冲区中有数据的文件中选择一个
+        :return: 读取任务
+        """
+        while 1:
+            self.__ready.clear()
+            candidates = [task for task in self.__active if not task.buffer.empty()]
+            if candidates:
+                break
+            self.__ready.wait()
+        total = sum(task.weight for task in candidates)
+        for task in candidates:
+            task.current += task.weight
+        chosen = max(candidates, key=lambda t: t.current)
+        chosen.current -= total
+        return chosen
+
+    def __finish(self, task, chunk):
+        """
+        文件读取结束
+        :param task: 读取任务
+        :param chunk: 最后取到的数据，为None时表示读取出错
+        :return: 无
+        """
+        self.__active.remove(task)
+        if chunk is None:
+            logging.error(u'{0} stopped reading {1} after {2} records.'.format(self.name, task.filename, task.count))
+            return
+        if task.on_finish is not None:
+            task.on_finish()
+        logging.info(u'{0} finished reading {1}, {2} records in {3:.1f}s.'.format(
+            self.name, task.filename, task.count, time.time() - task.start_time))
+
+    def progress(self):
+        """
+        各文件的读取进度
+        :return: [{filename, count, progress, rate, eta}]
+        """
+        result = list()
+        now = time.time()
+        for task in self.__active:
+            elapsed = max(now - task.start_time, 0.001)
+            item = {u'filename': task.filename, u'count': task.count, u'rate': task.count / elapsed,
+                    u'progress': None, u'eta': None}
+            if task.total:
+                item[u'progress'] = min(1.0, float(task.position) / task.total)
+                done = task.position - (task.start_position or 0)
+                if done > 0:
+                    item[u'eta'] = elapsed * (task.total - task.position) / done
+            result.append(item)
+        return result
+
+    def __report(self):
+        """
+        定时输出进度
+        :return: 无
+        """
+        while 1:
+            gevent.sleep(self.report_interval)
+            for item in self.progress():
+                logging.info(u'{0} {1}: {2} records, {3}, {4:.0f} records/s, ETA {5}.'.format(
+                    self.name, item[u'filename'], item[u'count'],
+                    u'unknown' if item[u'progress'] is None else u'{0:.1%}'.format(item[u'progress']),
+                    item[u'rate'], u'unknown' if item[u'eta'] is None else u'{0:.0f}s'.format(item[u'eta'])))
+
+    def run(self):
+        """
+        读取所有文件，全部读取完毕后返回
+        :return: 无
+        """
+        reporter = gevent.spawn(self.__report) if self.report_interval else None
+        try:
+            self.__start()
+            while self.__active:
+                task = self.__choose()
+                chunk = task.buffer.get()
+                if not chunk:
+                    self.__finish(task, chunk)
+                    self.__start()
+                    continue
+                for message, position, state in chunk:
+                    if task.start_position is None:
+                        task.start_position = position
+                    # 消息队列已满时阻塞，此时各文件的读取也会因缓冲区已满而暂停
+                    task.push(message, state)
+                    task.count += 1
+                    task.position = position
+        finally:
+            if reporter is not None:
+                reporter.kill()
+            gevent.killall([task.reader for task in self.__active if task.reader is not None])
@@ -1,24 +1,183 @@
 # -*- coding: utf-8 -*-
+import logging
+import os
+import signal
+
 import gevent
-from gevent.queue import PriorityQueue
 
+from src.config import SOURCE_QUEUE_MAX_SIZE, RESULT_QUEUE_MAX_SIZE, QUEUE_METRICS_INTERVAL
 from src.cores import process
 from src.cores import provider
-from src.cores.pipeline import result_handler
+from src.cores.batcher import BatchWriter
+from src.cores.envelope import QueueEnvelope
+from src.cores.pipeline import join_acks, result_handler
+from src.cores.queues import IpcQueue, RedisPriorityQueue, create_queue, is_distributed
+from src.cores.wal import MessageJournal
 
 
-def run(args):
+def __shutdown(args, source_queue, result_queue, provider_task, process_task):
+    """
+    停止运行：停止提供消息，处理函数处理完当前消息后退出，结果队列清空后结果处理函数退出
+    :param args: 运行参数
+    :param source_queue: 消息队列
+    :param result_queue: 结果队列
+    :param provider_task: 消息提供任务
+    :param process_task: 处理任务
+    :return: 无
+    """
+    logging.warning(u'Received the stop signal, shutting down...')
+    if provider_task is not None:
+        provider_task.kill()
+    if process_task is None:
+        return
+    # 停止信号排在所有消息之前，队列中未处理的消息在下次启动时重新获取：记录到预写日志的消息从日志中恢复，
+    # excel|csv|txt从落后于队列容量的读取进度重新读取，static|daily每次启动都会重新发送。
+    # 多进程模式下进程间管道中的消息不在此列，会被丢弃
+    for i in range(args.task):
+        source_queue.put(QueueEnvelope.stop())
+    process_task.join()
+    # 停止信号排在所有结果之后，保证已产生的结果都被处理
+    for i in range(args.task):
+        result_queue.put(QueueEnvelope.stop(last=True))
+
+
+def __monitor(queues):
+    """
+    定时输出队列水位
+    :param queues: 队列列表
+    :return: 无
+    """
+    while 1:
+        gevent.sleep(QUEUE_METRICS_INTERVAL)
+        for queue in queues:
+            metrics = queue.metrics()
+            logging.info(u'{0} queue: {1}/{2}({3:.0%}), peak {4}, blocked {5} times for {6}s, {7} paused.'.format(
+                metrics[u'name'], metrics[u'size'], metrics[u'capacity'], metrics[u'fill'], metrics[u'peak'],
+                metrics[u'blocked_puts'], metrics[u'blocked_seconds'], len(metrics[u'paused_plugins'])))
+
+
+def __check_role(args):
+    """
+    检查运行角色：只有分布式队列在各台机器之间共享，使用本地队列时只提供或只处理消息的进程无法与其他进程协作
+    :param args: 运行参数
+    :return: 运行角色
+    """
+    role = getattr(args, u'role', u'all')
+    if role != u'all' and not is_distributed():
+        raise ValueError(u'role {0} requires QUEUE_BACKEND redis, the local queue is not shared!'.format(role))
+    return role
+
+
+def __register_signals(handler):
+    """
+    注册退出信号的处理函数
+    :param handler: 处理函数
+    :return: 无
+    """
+    register = getattr(gevent, u'signal_handler', None) or gevent.signal
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        register(signum, handler)
+
+
+def run(args, shared_queue=None):
     """
     开启子处理函数
     :param args:
+    :param shared_queue: 多进程模式下各worker共享的消息队列
     :return:
     """
-    source_queue = PriorityQueue()
-    result_queue = PriorityQueue()
-    tasks = [
-        gevent.spawn(provider.run, (args, source_queue)),
-        gevent.spawn(process.run, (args, source_queue, result_queue))
-    ]
-    for i in range(args.task):
-        tasks.append(gevent.spawn(result_handler, result_queue))
-    gevent.joinall(tasks)
+    role = __check_role(args)
+    # 多进程模式下所有worker共用运行ID，各自写一份预写日志，由第一个worker负责压缩
+    index = getattr(args, u'worker_index', 0)
+    MessageJournal.open(getattr(args, u'run_id', None), u'worker{0}'.format(index), compactor=index == 0)
+    source_queue = create_queue(u'source', SOURCE_QUEUE_MAX_SIZE, args.schema)
+    result_queue = create_queue(u'result', RESULT_QUEUE_MAX_SIZE, args.schema)
+    # 消息处理依赖插件配置，只处理消息时也要登记所有插件
+    provider.register_plugins(args.schema)
+    # 使用分布式队列时，可以只在一台机器上提供消息，其余机器只处理消息
+    provider_task = process_task = None
+    tasks = list()
+    if role != u'consumer':
+        provider_task = gevent.spawn(provider.run, (args, source_queue, shared_queue))
+        tasks.append(provider_task)
+    if role != u'provider':
+        process_task = gevent.spawn(process.run, (args, source_queue, result_queue))
+        tasks.append(process_task)
+        for i in range(args.task):
+            tasks.append(gevent.spawn(result_handler, result_queue))
+
+    stopping = []
+
+    def on_signal():
+        if not stopping:
+            stopping.append(gevent.spawn(__shutdown, args, source_queue, result_queue, provider_task, process_task))
+
+    __register_signals(on_signal)
+    monitor = gevent.spawn(__monitor, [source_queue, result_queue]) if QUEUE_METRICS_INTERVAL else None
+    try:
+        gevent.joinall(tasks)
+    finally:
+        if monitor is not None:
+            monitor.kill()
+        BatchWriter.flush_all()
+        join_acks()
+        for queue in (source_queue, result_queue):
+            if isinstance(queue, RedisPriorityQueue):
+                queue.close()
+        MessageJournal.close()
+
+
+def __run_worker(args, index, shared_queue, initializer):
+    """
+    worker进程入口，运行结束后直接退出，不返回父进程的调用栈
+    :param args: 运行参数
+    :param index: worker序号
+    :param shared_queue: 各worker共享的消息队列
+    :param initializer: 初始化函数
+    :return: 无
+    """
+    code = 0
+    try:
+        args.worker_index = index
+        if initializer is not None:
+            initializer(args)
+        logging.info(u'worker {0}/{1} started, pid {2}.'.format(index, args.workers, os.getpid()))
+        run(args, shared_queue)
+    except Exception as e:
+        logging.exception(u'worker {0} error! - {1}'.format(index, e.message))
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def run_workers(args, initializer=None):
+    """
+    多进程模式：每个worker进程运行独立的gevent事件循环，插件按序号分配到各worker，
+    kafka插件在所有worker中运行，由消费组分配消息；其余插件的消息经共享队列分发到所有worker处理
+    :param args: 运行参数，workers为进程数
+    :param initializer: worker进程启动后的初始化函数，调用方式为initializer(args)
+    :return: 无
+    """
+    __check_role(args)
+    # 共享队列需要在fork之前创建
+    shared_queue = IpcQueue()
+    args.run_id = MessageJournal.new_run_id()
+    children = list()
+    for index in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            __run_worker(args, index, shared_queue, initializer)
+        children.append(pid)
+
+    def on_signal():
+        logging.warning(u'Received the stop signal, stopping workers...')
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except OSError:
+                pass
+
+    __register_signals(on_signal)
+    for child in children:
+        pid, status = os.waitpid(child, 0)
+        logging.info(u'worker(pid {0}) exited with status {1}.'.format(pid, status))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import gevent
+from gevent.queue import Queue
+
+
+class KeysetPager(object):
+    """
+    键集分页读取器：按主键顺序逐页查询，每页以上一页最后一条记录的主键为起点，不使用偏移量；
+    后台协程预读后续的页，当前页的数据处理时下一页的查询已经在进行
+    """
+
+    def __init__(self, name, fetch, key, start=None, page_size=100, prefetch=1):
+        """
+        初始化
+        :param name: 名称，仅用于日志
+        :param fetch: 查询函数，调用方式为fetch(起始主键, 数量)，起始主键为None时从头查询，返回按主键升序排列的记录列表
+        :param key: 主键函数，调用方式为key(记录)
+        :param start: 起始主键，只返回主键大于该值的记录
+        :param page_size: 每页的记录数，为None时一次查询所有记录
+        :param prefetch: 预读的页数
+        """
+        self.name = name
+        self.fetch = fetch
+        self.key = key
+        self.start = start
+        self.page_size = page_size
+        self.prefetch = max(1, prefetch)
+        self.count = 0
+
+    def __read(self, buffer):
+        """
+        逐页查询并放入缓冲区，缓冲区满时暂停查询。返回的记录数少于每页记录数时视为已读取完毕
+        :param buffer: 缓冲区
+        :return: 无
+        """
+        last = self.start
+        try:
+            while 1:
+                records = self.fetch(last, self.page_size)
+                if not records:
+                    break
+                last = self.key(records[-1])
+                buffer.put((records, last))
+                if not self.page_size or len(records) < self.page_size:
+                    break
+            buffer.put(None)
+        except Exception as e:
+            logging.exception(u'{0} failed to fetch the page after {1}! - {2}'.format(self.name, last, e.message))
+            buffer.put(e)
+
+    def __iter__(self):
+        """
+        按顺序返回各页
+        :return: (记录列表, 该页最后一条记录的主键)生成器，查询出错时抛出异常
+        """
+        buffer = Queue(maxsize=self.prefetch)
+        reader = gevent.spawn(self.__read, buffer)
+        try:
+            while 1:
+                page = buffer.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                self.count += len(page[0])
+                yield page
+        finally:
+            reader.kill()
@@ -5,19 +5,179 @@ import json
 import logging
 
 import gevent
+from gevent.event import AsyncResult
+from gevent.local import local
+from gevent.pool import Group
 
-from src.config import RESULT_QUEUE_MAX_SIZE, CACHE_FILE_KEY
-from src.cores.customer import CustomerJsonEncoder
+from src.config import CACHE_FILE_KEY, EID_RESOLVER_CONFIG, MYSQL_WRITER_CONFIG, MYSQL_WRITER_RETRY_CONFIG, \
+    OTS_WRITER_CONFIG, QUEUE_RECEIPT_KEY
+from src.cores.batcher import BatchWriter
 from baseitem import dumps_item
+from src.cores.customer import CustomerJsonEncoder
+from src.cores.envelope import QueueEnvelope
+from src.cores.queues import acknowledge
+from src.cores.registry import ConfigRegistry
+from src.cores.resolver import EntityEidResolver
 from src.cores.services import kafka_client, ots_client
-from src.cores.services.mongodb_client import MongodbService
+from src.cores.services.mysql_client import MySQLClient, MySQLInterface
 from src.cores.services.oss_client import OSSService
-from src.utils import tools
+from src.cores.wal import MessageJournal
+from src.utils.cache import TTLCache
+from src.utils.tools import md5
+
+
+def _flush_ots_rows(key, rows):
+    """
+    批量写入缓冲的OTS数据，逐行报告写入失败的数据并单独重试
+    :param key: (OTS实例, 表名)
+    :param rows: 序列化后的行数据列表
+    :return: 每一行是否写入成功
+    """
+    instance, table = key
+    results = ots_client.ots_service_batch_write_row(instance, table, rows)
+    written = list()
+    for row, (ok, error) in zip(rows, results):
+        if not ok:
+            logging.error(u'Failed to batch write row to OTS({0}-{1})! - {2}|{3}'.format(instance, table, error, row))
+            row_json = json.loads(row)
+            ok = ots_client.ots_service_put_row(instance, table, row_json[u'pk'], row_json[u'columns']) is not None
+            if not ok:
+                logging.error(u'Lost OTS row({0}-{1}) - {2}'.format(instance, table, row))
+        written.append(ok)
+    logging.debug(u'Finished batch writing {0} rows to OTS({1}-{2}), {3} failed.'.format(
+        len(rows), instance, table, written.count(False)))
+    return written
+
+
+def _write_mysql_rows(key, rows):
+    """
+    使用一条多行INSERT语句写入一批MySQL数据
+    :param key: (是否使用接口服务, 服务环境, 模式, 表名, 字段列表, 冲突时更新的字段列表)
+    :param rows: 数据列表，每行为按字段顺序排列的值
+    :return: 无
+    """
+    service, env_schema, schema, table, columns, update_columns = key
+    if service:
+        args = dict()
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                args[u'v{0}_{1}'.format(i, j)] = value
+        result = MySQLInterface.insert(
+            schema, MySQLClient.build_insert_sql(table, columns, update_columns, len(rows)),
+            json.dumps(args, ensure_ascii=False, cls=CustomerJsonEncoder), env_schema)
+        if result is None:
+            raise IOError(u'mysql service returned no response')
+    else:
+        # executemany会将单行INSERT语句展开为多行语句批量执行
+        MySQLClient.execute_many(schema, MySQLClient.build_insert_sql(table, columns, update_columns), rows)
+
+
+def _flush_mysql_rows(key, rows):
+    """
+    批量写入缓冲的MySQL数据。连接失效、服务不可用等暂时性错误时整批退避重试；
+    数据错误时将该批数据对半拆分后分别重试，直到定位到写入失败的单行
+    :param key: (是否使用接口服务, 服务环境, 模式, 表名, 字段列表, 冲突时更新的字段列表)
+    :param rows: 数据列表
+    :return: 每一行是否写入成功
+    """
+    table = u'{0}.{1}'.format(key[2], key[3])
+    written = [False] * len(rows)
+    pending = [(0, len(rows))]
+    retries = 0
+    while pending:
+        start, end = pending.pop()
+        try:
+            _write_mysql_rows(key, rows[start:end])
+            written[start:end] = [True] * (end - start)
+            retries = 0
+            continue
+        except Exception as e:
+            error = e
+        if MySQLClient.is_transient_error(error):
+            if retries < MYSQL_WRITER_RETRY_CONFIG[u'retries']:
+                delay = min(MYSQL_WRITER_RETRY_CONFIG[u'max_backoff'],
+                            MYSQL_WRITER_RETRY_CONFIG[u'backoff'] * 2 ** retries)
+                retries += 1
+                logging.warning(u'Failed to write {0} rows to MySQL({1}), retry {2} in {3}s! - {4}'.format(
+                    end - start, table, retries, delay, error))
+                gevent.sleep(delay)
+                pending.append((start, end))
+            else:
+                logging.error(u'Lost {0} MySQL rows({1}) after {2} retries - {3}'.format(
+                    end - start, table, retries, error))
+        elif end - start == 1:
+            logging.error(u'Lost MySQL row({0}) - {1}|{2}'.format(table, error, rows[start]))
+        else:
+            logging.warning(u'Failed to write {0} rows to MySQL({1}), splitting the batch! - {2}'.format(
+                end - start, table, error))
+            middle = (start + end) // 2
+            pending.append((middle, end))
+            pending.append((start, middle))
+    logging.debug(u'Finished batch writing {0} rows to MySQL({1}), {2} failed.'.format(
+        len(rows), table, written.count(False)))
+    return written
+
+
+# 当前协程中pipeline提交的缓冲写入，消息在这些写入完成后才确认
+_TRACKER = local()
+
+# 等待缓冲写入完成后确认消息的协程
+_ACKERS = Group()
+
+
+def _track(put_result):
+    """
+    记录当前pipeline提交的缓冲写入。process_item中另起协程提交的写入不会被记录
+    :param put_result: 缓冲写入的结果
+    :return: 缓冲写入的结果
+    """
+    writes = getattr(_TRACKER, u'writes', None)
+    if writes is not None and put_result is not None:
+        writes.append(put_result)
+    return put_result
+
+
+def _offer_after(kafka_topic, record, after, put_result):
+    """
+    等待依赖的缓冲写入全部成功后再将记录放入kafka发送缓冲
+    :param kafka_topic: kafka队列的topic
+    :param record: 数据
+    :param after: 依赖的缓冲写入结果列表
+    :param put_result: 发送结果
+    :return: 无
+    """
+    try:
+        if all(write is not None and write.get() for write in after):
+            put_result.set(kafka_client.offer_buffered(kafka_topic, record).get())
+            return
+        logging.error(u'Skipped kafka record({0}) whose dependent writes failed - {1}'.format(
+            kafka_topic, json.dumps(record, ensure_ascii=False, cls=CustomerJsonEncoder)))
+    except Exception as e:
+        logging.exception(u'Failed to offer kafka record({0})! - {1}'.format(kafka_topic, e.message))
+    put_result.set(False)
+
+
+def join_acks(timeout=None):
+    """
+    等待缓冲写入完成后的消息确认，停止运行时在写出所有缓冲之后调用
+    :param timeout: 最长等待时间（秒）
+    :return: 无
+    """
+    _ACKERS.join(timeout)
 
 
 class Pipeline(object):
     """pipeline父类"""
 
+    # OTS批量写入器，按实例和表分组累积数据
+    ots_writer = BatchWriter(u'ots writer', _flush_ots_rows, **OTS_WRITER_CONFIG)
+
+    # MySQL批量写入器，按表和字段组合分组累积数据
+    mysql_writer = BatchWriter(u'mysql writer', _flush_mysql_rows, **MYSQL_WRITER_CONFIG)
+
+    # 企业eid查询器，在所有pipeline之间共享缓存
+    eid_resolver = EntityEidResolver(**EID_RESOLVER_CONFIG)
+
     def __init__(self):
         pass
 
@@ -35,41 +195,59 @@ class Pipeline(object):
     @staticmethod
     def build_ent_eid_by_name(name):
         """
-        根据企业名称查询企业eid
+        根据企业名称查询企业eid，结果会被缓存，并发的查询合并为批量查询
         :param name: 企业名
         :return: 企业eid
         """
-        eid = u''
-        if name:
-            resp_text = None
-            try:
-                query_dict = {u'name': name.replace(u'(', u'（').replace(u')', u'）')}
-                resp_text = MongodbService.find_one(u'gs', u'entities', query_dict, [u'eid'])
-                if resp_text:
-                    eid = json.loads(resp_text)[u'eid']
-            except Exception as e:
-                logging.exception(u'{0} - {1}'.format(e.message, resp_text))
-        return eid
+        return Pipeline.eid_resolver.resolve(name)
 
     @staticmethod
     def flow_to_ots(instance, table, pk, columns):
         """
-        流向OTS
+        流向OTS，数据先进入批量写入缓冲，按数量、字节数或等待时间批量写入。消息在写入完成后才确认
         :param instance: OTS实例
         :param table: 表名
         :param pk: pk
         :param columns: 需要更新的列名
-        :return: 操作结果
+        :return: 写入结果，批量写入后get()返回是否写入成功；参数无效时为None
         """
         put_result = None
         if instance and table and pk and columns:
-            put_result = ots_client.ots_service_put_row(instance, table, pk, columns)
-            logging.debug(u'Finished putted record to OTS({0}-{1})!'.format(instance, table))
+            row = ots_client.build_batch_row(pk, columns)
+            put_result = _track(Pipeline.ots_writer.put((instance, table), row, len(row)))
+            logging.debug(u'Buffered record for OTS({0}-{1})!'.format(instance, table))
         else:
             logging.exception(u'Invalid OTS params! - instance({0}), table({1}), pk({2}), columns({3})'.format(
                 instance, table, pk, columns))
         return put_result
 
+    @staticmethod
+    def flow_to_mysql(schema, table, record, upsert=False, update_columns=None, db_service=False, env_schema=None):
+        """
+        流向MySQL，数据先进入批量写入缓冲，同一张表中字段相同的数据合并为一条多行INSERT语句写入
+        :param schema: 模式
+        :param table: 表名
+        :param record: 数据，{字段名: 值}
+        :param upsert: 主键或唯一索引冲突时是否更新，即INSERT ... ON DUPLICATE KEY UPDATE
+        :param update_columns: 冲突时更新的字段，为None时更新数据中的所有字段
+        :param db_service: 是否使用接口服务
+        :param env_schema: 服务环境
+        :return: 写入结果，批量写入后get()返回是否写入成功；参数无效时为None
+        """
+        put_result = None
+        if schema and table and record and isinstance(record, dict):
+            columns = tuple(sorted(record.keys()))
+            updates = tuple(update_columns or columns) if upsert else None
+            row = tuple(record[column] for column in columns)
+            size = len(json.dumps(row, ensure_ascii=False, cls=CustomerJsonEncoder))
+            put_result = _track(Pipeline.mysql_writer.put(
+                (db_service, env_schema, schema, table, columns, updates), row, size))
+            logging.debug(u'Buffered record for MySQL({0}.{1})!'.format(schema, table))
+        else:
+            logging.exception(u'Invalid MySQL params! - schema({0}), table({1}), record({2})'.format(
+                schema, table, record))
+        return put_result
+
     @staticmethod
     def flow_to_oss(bucket_name, folder_name, filename, record):
         """
@@ -91,17 +269,23 @@ class Pipeline(object):
         return put_result
 
     @staticmethod
-    def flow_to_kafka(kafka_topic, record):
+    def flow_to_kafka(kafka_topic, record, after=None):
         """
-        流向kafka
+        流向kafka，记录先进入发送缓冲，再批量发送。消息在发送完成后才确认
         :param kafka_topic: kafka队列的topic
         :param record: 数据
-        :return: 操作结果
+        :param after: 需要先完成的缓冲写入结果列表，如flow_to_ots的返回值。kafka和OTS分别批量写出，
+            记录引用OTS中的数据时需要等OTS写入成功后再发送，任一写入失败时不发送
+        :return: 发送结果，批量发送后get()返回是否发送成功；数据无效时为None
         """
         put_result = None
-        if record:
-            put_result = kafka_client.offer(kafka_topic, record)
-            logging.debug(u'Finished putted record to Kafka({0})!'.format(kafka_topic))
+        if record and after:
+            put_result = _track(AsyncResult())
+            gevent.spawn(_offer_after, kafka_topic, record, after, put_result)
+            logging.debug(u'Record for Kafka({0}) is waiting for {1} writes!'.format(kafka_topic, len(after)))
+        elif record:
+            put_result = _track(kafka_client.offer_buffered(kafka_topic, record))
+            logging.debug(u'Buffered record for Kafka({0})!'.format(kafka_topic))
         else:
             logging.exception(u'Invalid record for Kafka({0})!'.format(kafka_topic))
         return put_result
@@ -139,28 +323,140 @@ class Pipeline(object):
             {
                 'result': '',  # 处理后的消息对象
                 'config': '',  # 参数
-                'message': ''  # 原始消息
+                'message': '',  # 原始消息
+                'receipt': ''  # 结果在分布式队列中的投递回执（可选）
             }
         :return:
         """
         result = copy.deepcopy(args[u'result'])
-        config = copy.deepcopy(args[u'config'])
+        # 配置在所有结果之间共享，只读使用，不再逐条复制
+        config = args[u'config']
         message = copy.deepcopy(args[u'message'])
 
-        # 处理结果，将数据发往下一步进行处理
+        # 处理结果，将数据发往下一步进行处理，并记录处理过程中提交的缓冲写入
+        _TRACKER.writes = writes = list()
+        processed = (config, args[u'result'])
         try:
             self.process_item(config, result, message)
         except Exception as e:
             logging.exception(e.message)
+            processed = None
+            release_result(config, args[u'result'])
+        finally:
+            _TRACKER.writes = None
 
-        # 删除缓存文件
-        try:
-            file_path = message.get(CACHE_FILE_KEY)
-            if file_path:
-                tools.remove_file(file_path)
-                logging.debug(u'remove cache file({0}) successfully!'.format(file_path))
-        except Exception as e:
-            logging.exception(u'failed to remove cache file! - {0}'.format(e.message))
+        # 缓冲写入全部完成后再确认消息，写入前进程退出时消息会被恢复并重新处理
+        if writes:
+            _ACKERS.spawn(_ack_when_written, message, args.get(u'receipt'), writes, processed)
+        else:
+            if processed is not None:
+                remember_result(*processed)
+            ack_message(message, args.get(u'receipt'))
+
+
+# 各插件的结果指纹缓存，{插件ID: TTLCache}，值为结果是否已处理完成，False表示结果正在处理
+_FINGERPRINTS = dict()
+
+
+def ack_message(message, receipt=None):
+    """
+    确认消息已处理完成，从预写日志和分布式队列中移除
+    :param message: 原始消息
+    :param receipt: 结果在分布式队列中的投递回执
+    :return: 无
+    """
+    try:
+        token = message.get(CACHE_FILE_KEY)
+        if token:
+            MessageJournal.ack(token)
+            logging.debug(u'ack message({0}) successfully!'.format(token))
+        acknowledge(message.get(QUEUE_RECEIPT_KEY))
+        acknowledge(receipt)
+    except Exception as e:
+        logging.exception(u'failed to ack message! - {0}'.format(e.message))
+
+
+def _ack_when_written(message, receipt, writes, processed=None):
+    """
+    等待缓冲写入全部完成后确认消息，写入失败的数据已由各写出函数记录日志
+    :param message: 原始消息
+    :param receipt: 结果在分布式队列中的投递回执
+    :param writes: 缓冲写入的结果列表
+    :param processed: 处理成功的(配置, 结果)，写入全部成功后记录结果指纹，写入失败时释放；处理出错时为None
+    :return: 无
+    """
+    failed = len([write for write in writes if not write.get()])
+    if failed:
+        logging.warning(u'{0}/{1} buffered writes of the message failed.'.format(failed, len(writes)))
+        if processed is not None:
+            release_result(*processed)
+    elif processed is not None:
+        remember_result(*processed)
+    ack_message(message, receipt)
+
+
+def _result_fingerprint(config, result):
+    """
+    按插件配置的去重字段计算结果指纹
+    :param config: 配置
+    :param result: 结果
+    :return: (指纹缓存, 指纹)，未配置去重字段或去重字段均为空时为(None, None)
+    """
+    keys = config.get(u'dedup_keys')
+    if not keys or not isinstance(result, dict):
+        return None, None
+    values = [result.get(key) for key in keys]
+    if all(value is None for value in values):
+        return None, None
+    fingerprint = md5(json.dumps(values, ensure_ascii=False, sort_keys=True, cls=CustomerJsonEncoder))
+    plugin_id = ConfigRegistry.register(config)
+    cache = _FINGERPRINTS.get(plugin_id)
+    if cache is None:
+        cache = _FINGERPRINTS[plugin_id] = TTLCache(config.get(u'dedup_max_size', 100000),
+                                                    config.get(u'dedup_window', 3600))
+    return cache, fingerprint
+
+
+def claim_result(config, result):
+    """
+    检查去重窗口内是否已出现过相同的结果，包括已处理完成和正在处理的结果；未出现过时记录为正在处理。
+    每个插件的指纹缓存容量有限，超出时淘汰最久未出现的指纹
+    :param config: 配置
+    :param result: 结果
+    :return: 是否需要处理，重复时为False；未配置去重字段或去重字段均为空时为True
+    """
+    cache, fingerprint = _result_fingerprint(config, result)
+    if cache is None:
+        return True
+    if fingerprint in cache:
+        return False
+    cache.put(fingerprint, False)
+    return True
+
+
+def remember_result(config, result):
+    """
+    记录已成功处理的结果的指纹，去重窗口内相同的结果将被丢弃。
+    结果处理出错或写入失败时不记录，之后出现的相同结果仍会被处理
+    :param config: 配置
+    :param result: 结果
+    :return: 无
+    """
+    cache, fingerprint = _result_fingerprint(config, result)
+    if cache is not None:
+        cache.put(fingerprint, True)
+
+
+def release_result(config, result):
+    """
+    结果处理出错或写入失败时移除正在处理的指纹，之后出现的相同结果仍会被处理
+    :param config: 配置
+    :param result: 结果
+    :return: 无
+    """
+    cache, fingerprint = _result_fingerprint(config, result)
+    if cache is not None and cache.get(fingerprint) is False:
+        cache.pop(fingerprint)
 
 
 def result_pusher(record, config, result_queue, message, record_cls=None):
@@ -171,8 +467,11 @@ def result_pusher(record, config, result_queue, message, record_cls=None):
     :param result_queue: 结果队列
     :param message: 原始消息
     :param record_cls: 结果类
-    :return: 无
+    :return: 是否发送到结果队列，重复的结果被丢弃时为False
     """
+    # 处理函数会继续修改原始消息，结果中保存发送时的副本
+    message = copy.deepcopy(message)
+    checked = False
     while 1:
         try:
             if record_cls is not None and isinstance(record, record_cls):
@@ -185,20 +484,20 @@ def result_pusher(record, config, result_queue, message, record_cls=None):
             else:
                 result = copy.deepcopy(record)
 
-            if result_queue.qsize() < RESULT_QUEUE_MAX_SIZE:
-                result_queue.put((
-                    int(config[u'priority']),
-                    json.dumps(
-                        {u'result': result, u'config': config, u'message': message},
-                        ensure_ascii=False,
-                        cls=CustomerJsonEncoder
-                    )
-                ))
-                logging.debug(u'push {0} to result queue successfully!'.format(record_cls))
-                break
-            else:
-                logging.debug(u'too many records in result queue!')
-                gevent.sleep(10)
+            # 分页重叠或同一消息重复入队时会产生相同的结果，去重窗口内已出现过的结果直接丢弃。
+            # 丢弃时不确认消息，消息没有发送任何结果时由处理函数在处理完成后确认
+            if not checked:
+                checked = True
+                if not claim_result(config, result):
+                    logging.debug(u'drop duplicate {0} of {1}.'.format(
+                        record_cls, json.dumps(message, ensure_ascii=False, cls=CustomerJsonEncoder)))
+                    return False
+
+            # 结果队列已满或插件达到高水位时阻塞，有空位后立即恢复
+            result_queue.put(QueueEnvelope(
+                config[u'priority'], message, ConfigRegistry.register(config), result=result))
+            logging.debug(u'push {0} to result queue successfully!'.format(record_cls))
+            return True
         except Exception as e:
             logging.exception(u'result pusher error! - {0}'.format(e.message))
 
@@ -212,19 +511,22 @@ def result_handler(result_queue):
     pipeline_dict = dict()
     while 1:
         try:
-            if not result_queue.empty():
-                priority, temp_args = result_queue.get()
-                args = json.loads(temp_args)
-                plugin_id = tools.build_plugin_id(args[u'config'])
-                if plugin_id not in pipeline_dict.keys():
-                    # 动态加载模块
-                    name = args[u'config'][u'pipeline'].split(u'.')[-1]
-                    i_module = importlib.import_module(args[u'config'][u'pipeline'], name)
-                    cls = getattr(i_module, name)
-                    pipeline_dict[plugin_id] = cls()
-                pipeline_dict[plugin_id].run(args)
-            else:
-                gevent.sleep(10)
+            # 阻塞等待，结果到达后立即被唤醒
+            envelope = result_queue.get()
+            if envelope.is_stop:
+                logging.debug(u'result handler received the stop signal.')
+                break
+            config = envelope.config
+            plugin_id = envelope.config_id
+            if plugin_id not in pipeline_dict.keys():
+                # 动态加载模块
+                name = config[u'pipeline'].split(u'.')[-1]
+                i_module = importlib.import_module(config[u'pipeline'], name)
+                cls = getattr(i_module, name)
+                pipeline_dict[plugin_id] = cls()
+            # 分布式队列中的结果在缓冲写入完成后随消息一起确认，处理出错时超时后由其他进程重新处理
+            pipeline_dict[plugin_id].run({u'result': envelope.result, u'config': config,
+                                          u'message': envelope.message, u'receipt': envelope.receipt})
         except Exception as e:
             logging.exception(u'result handler error! - {0}'.format(e.message))
             gevent.sleep(3)
@@ -5,12 +5,15 @@ import logging
 
 import gevent
 
-from src.config import CACHE_FILE_KEY
-from src.cores.customer import CustomerJsonEncoder
+from src.config import CACHE_FILE_KEY, QUEUE_RECEIPT_KEY
 from baseitem import BaseItem
-from src.cores.pipeline import result_pusher, Pipeline
+from src.cores.customer import CustomerJsonEncoder
+from src.cores.envelope import QueueEnvelope
+from src.cores.queues import is_distributed
+from src.cores.pipeline import ack_message, result_pusher, Pipeline
+from src.cores.registry import ConfigRegistry
 from src.cores.services.proxy_client import ProxyService
-from src.utils import tools
+from src.cores.wal import MessageJournal
 
 
 class Processor(object):
@@ -24,6 +27,7 @@ class Processor(object):
         :param result_queue: 结果队列
         """
         self.config = config
+        self.plugin_id = ConfigRegistry.register(config)
         self.source_queue = source_queue
         self.result_queue = result_queue
         self.retry_limit = 10
@@ -38,6 +42,7 @@ class Processor(object):
         self.base_cookies = dict()
         self.base_proxies = None
         self.breakpoint = False
+        self.queued_results = 0
 
     def refresh_proxy(self, dynamic=False, change=True):
         """
@@ -73,18 +78,11 @@ class Processor(object):
     @staticmethod
     def remove_cache_file(message):
         """
-        移除缓存文件
+        确认消息已处理完成，从预写日志中移除
         :param message: 消息主体
         :return: 无
         """
-        # 删除缓存文件
-        try:
-            file_path = message.get(CACHE_FILE_KEY)
-            if file_path:
-                tools.remove_file(file_path)
-                logging.debug(u'remove cache file({0}) successfully!'.format(file_path))
-        except Exception as e:
-            logging.exception(u'failed to remove cache file! - {0}'.format(e.message))
+        ack_message(message)
 
     def pipeline_pusher(self, message, record, record_cls):
         """
@@ -94,7 +92,8 @@ class Processor(object):
         :param record_cls: 结果类
         :return: 无
         """
-        result_pusher(record, self.config, self.result_queue, message, record_cls)
+        if result_pusher(record, self.config, self.result_queue, message, record_cls):
+            self.queued_results += 1
 
     def source_queue_pusher(self, new_message):
         """
@@ -107,19 +106,16 @@ class Processor(object):
             return
         if CACHE_FILE_KEY in new_message.keys():
             new_message.pop(CACHE_FILE_KEY)
-        # 将消息缓存至临时文件
-        filename = u'cache/{0}_{1}'.format(tools.build_plugin_id(self.config), tools.build_plugin_id(new_message))
-        try:
-            tools.pickle_write_file(filename, new_message)
-            new_message[CACHE_FILE_KEY] = filename
-        except Exception as e:
-            logging.exception(u'cache message pickle error! - {0}'.format(e.message))
+        new_message.pop(QUEUE_RECEIPT_KEY, None)
+        # 将消息记录到预写日志，分布式队列自身保存消息，不需要记录
+        if not is_distributed():
+            try:
+                new_message[CACHE_FILE_KEY] = MessageJournal.record(self.plugin_id, new_message)
+            except Exception as e:
+                logging.exception(u'record message error! - {0}'.format(e.message))
 
-        # 将消息发送到消息队列
-        self.source_queue.put((
-            int(self.config[u'priority']),
-            json.dumps({u'message': new_message, u'config': self.config}, ensure_ascii=False, cls=CustomerJsonEncoder)
-        ))
+        # 将消息发送到消息队列，处理函数自身是消息队列的消费者，不受容量限制，避免互相等待
+        self.source_queue.put(QueueEnvelope(self.config[u'priority'], new_message, self.plugin_id), overflow=True)
 
     def request_list_page(self, message, page_no):
         """
@@ -165,15 +161,18 @@ class Processor(object):
         """
         current_page_no = max_page_no = 1
         self.breakpoint = False
+        self.queued_results = 0
         while current_page_no <= max_page_no:
             try:
                 logging.debug(u'====> {0} - Starting page {1}/{2} of {3}'.format(
-                    self.__class__.__name__, current_page_no, max_page_no, json.dumps(message, ensure_ascii=False)))
+                    self.__class__.__name__, current_page_no, max_page_no,
+                    json.dumps(message, ensure_ascii=False, cls=CustomerJsonEncoder)))
                 temp_max_page_no, list_records, record_cls, has_detail = self.request_list_page(
                     message, current_page_no)
                 max_page_no = max(max_page_no, temp_max_page_no)
                 if not list_records:
-                    logging.debug(u'{0} has no list_records!'.format(json.dumps(message, ensure_ascii=False)))
+                    logging.debug(u'{0} has no list_records!'.format(
+                        json.dumps(message, ensure_ascii=False, cls=CustomerJsonEncoder)))
                     self.remove_cache_file(message)
                 else:
                     if not has_detail:
@@ -185,7 +184,8 @@ class Processor(object):
                             tasks.append(gevent.spawn(self.__request_detail, (message, record, record_cls)))
                         gevent.joinall(tasks)
                 logging.debug(u'====> {0} - The end of page {1}/{2} of {3}'.format(
-                    self.__class__.__name__, current_page_no, max_page_no, json.dumps(message, ensure_ascii=False)))
+                    self.__class__.__name__, current_page_no, max_page_no,
+                    json.dumps(message, ensure_ascii=False, cls=CustomerJsonEncoder)))
                 current_page_no += 1
             except Exception as e:
                 logging.exception(e.message)
@@ -195,6 +195,10 @@ class Processor(object):
                 logging.warning(u'====> Capture the breakpoint signal~')
                 break
 
+        # 发送到结果队列的结果处理完成后确认消息，结果全部重复被丢弃时没有结果确认，在此确认
+        if not self.queued_results:
+            self.remove_cache_file(message)
+
 
 def __springboard(args):
     """
@@ -206,20 +210,23 @@ def __springboard(args):
     instance_dic = dict()
     while 1:
         try:
-            if not source_queue.empty():
-                priority, temp_args = source_queue.get()
-                args = json.loads(temp_args)
-                config = args[u'config']
-                config_id = tools.build_plugin_id(config)
-                if config_id not in instance_dic.keys():
-                    # 动态加载模块
-                    name = config[u'class'].split(u'.')[-1]
-                    i_module = importlib.import_module(config[u'class'], name)
-                    cls = getattr(i_module, name)
-                    instance_dic[config_id] = cls(config, source_queue, result_queue)
-                instance_dic[config_id].run(args[u'message'])
-            else:
-                gevent.sleep(10)
+            # 阻塞等待，消息到达后立即被唤醒
+            envelope = source_queue.get()
+            if envelope.is_stop:
+                logging.debug(u'springboard received the stop signal.')
+                break
+            if envelope.receipt and isinstance(envelope.message, dict):
+                # 处理完成后由Pipeline或remove_cache_file确认
+                envelope.message[QUEUE_RECEIPT_KEY] = envelope.receipt
+            config_id = envelope.config_id
+            if config_id not in instance_dic.keys():
+                # 动态加载模块
+                config = envelope.config
+                name = config[u'class'].split(u'.')[-1]
+                i_module = importlib.import_module(config[u'class'], name)
+                cls = getattr(i_module, name)
+                instance_dic[config_id] = cls(config, source_queue, result_queue)
+            instance_dic[config_id].run(envelope.message)
         except Exception as e:
             logging.exception(u'springboard error! - {0}'.format(e.message))
             gevent.sleep(2)
@@ -235,4 +242,7 @@ def run(args):
     tasks = list()
     for i in range(options.task):
         tasks.append(gevent.spawn(__springboard, (source_queue, result_queue)))
-    gevent.joinall(tasks)
+    try:
+        gevent.joinall(tasks)
+    finally:
+        gevent.killall(tasks)
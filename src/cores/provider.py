@@ -1,24 +1,30 @@
 # -*- coding: utf-8 -*-
 import copy
 import datetime
-import io
 import json
 import logging
 import os
-import sys
 import time
+import types
 
 import gevent
 from bson import ObjectId
 
-from src.config import SOURCE_QUEUE_MAX_SIZE, CACHE_FILE_KEY
+from src.config import CACHE_FILE_KEY, FILE_INGEST_CONFIG, SOURCE_QUEUE_MAX_SIZE
 from src.cores.customer import CustomerJsonEncoder
+from src.cores.envelope import QueueEnvelope, SerializingQueue
+from src.cores.ingest import FileIngestScheduler
+from src.cores.pager import KeysetPager
+from src.cores.queues import is_distributed
+from src.cores.registry import ConfigRegistry
+from src.cores.services import csv_client
 from src.cores.services import excel_client
 from src.cores.services import kafka_client
 from src.cores.services.mongodb_client import MongodbClient
 from src.cores.services.mongodb_client import MongodbService
 from src.cores.services.mysql_client import MySQLClient
 from src.cores.services.mysql_client import MySQLInterface
+from src.cores.wal import MessageJournal
 from src.setting import PROJECT_SETTING
 from src.utils import tools
 
@@ -29,65 +35,147 @@ class SourceProvider(object):
     # 本地消息类型列表
     _localhost_message_types = [u'static', u'excel', u'csv', u'txt', u'daily']
 
+    # 文件数据源的消息不记录到预写日志，停止时队列中未处理的消息会被丢弃。
+    # 读取进度每隔该行数记录一次，并且记录的是落后该行数的进度，重启后从此处重新读取，覆盖队列中可能未处理的数据
+    _checkpoint_rows = max(1000, SOURCE_QUEUE_MAX_SIZE)
+
+    # 旧版本遗留缓存文件的索引，插件ID -> 文件列表
+    __legacy_cache_index = None
+
+    @classmethod
+    def __legacy_cache_files(cls, plugin_ids):
+        """
+        获取插件的旧版缓存文件，首次调用时只列出一次缓存目录并按插件ID分组
+        :param plugin_ids: 插件ID集合
+        :return: 文件列表
+        """
+        if cls.__legacy_cache_index is None:
+            index = dict()
+            for filename in tools.list_folder_files(u'cache'):
+                name = os.path.basename(filename)
+                if u'.' not in name and u'_' in name:
+                    index.setdefault(name.split(u'_')[0], list()).append(filename)
+            cls.__legacy_cache_index = index
+        filename_list = list()
+        for plugin_id in plugin_ids:
+            filename_list.extend(cls.__legacy_cache_index.pop(plugin_id, list()))
+        return filename_list
+
     @classmethod
     def __load_cache_files(cls, params):
         """
-        加载缓存消息文件
+        从预写日志中恢复上次运行未处理完的消息，并加载旧版本遗留的缓存文件。
+        消息在写入队列时才逐条读取，受队列反压控制，不会一次性加载到内存
         :param params: 参数
-        :return: 消息列表
-        """
-        messages = []
-        plugin_id = tools.build_plugin_id(params)
-        filename_list = [filename for filename in tools.list_folder_files(u'cache')
-                         if plugin_id in filename and u'.' not in filename]
-        for name in filename_list:
+        :return: 消息生成器
+        """
+        # 同时恢复旧版插件ID记录的消息
+        plugin_id = ConfigRegistry.register(params)
+        plugin_ids = {plugin_id, tools.build_legacy_plugin_id(params)}
+        for token, message in MessageJournal.recover(plugin_ids):
+            if is_distributed():
+                # 分布式队列自身保存消息，写入队列后直接确认上次运行的记录
+                yield message
+                MessageJournal.ack(token)
+                continue
+            # 先在本次运行的日志中重新记录，再确认上次运行的记录
+            message[CACHE_FILE_KEY] = MessageJournal.record(plugin_id, message)
+            MessageJournal.ack(token)
+            yield message
+        for name in cls.__legacy_cache_files(plugin_ids):
+            message = None
             try:
                 message = tools.pickle_read_file(name)
-                if message:
-                    messages.append(message)
             except Exception as e:
                 logging.exception(u'load cache files error! - {0}'.format(e.message))
+            if message:
+                # 消息写入队列并记录到预写日志后再删除缓存文件
+                yield message
             tools.remove_file(name)
-        return messages
+
+    @staticmethod
+    def __parse_kafka_message(record):
+        """
+        解析单条kafka消息
+        :param record: kafka消息
+        :return: 解析后的消息
+        """
+        if isinstance(record, dict):
+            return record
+        try:
+            return json.loads(record)
+        except Exception as e:
+            logging.exception(u'====>{0}<==== {1}'.format(record, e.message))
+            return eval(record)
 
     @classmethod
-    def __get_message_book_from_kafka(cls, params):
+    def __get_message_book_from_kafka(cls, source_queue, params):
         """
-        从kafka队列获取消息
+        从kafka队列批量获取消息，获取数量不超过消息队列的剩余容量
+        :param source_queue: 消息队列
         :param params: 参数
         :return: 获取的消息
         """
-        message_book = None
-        resp_text = kafka_client.poll(params[u'kafka_topic'], params[u'kafka_group'])
-        if resp_text:
-            try:
-                message_book = json.loads(resp_text)
-            except Exception as e:
-                logging.exception(u'====>{0}<==== {1}'.format(resp_text, e.message))
-                message_book = eval(resp_text)
-        else:
+        message_book = []
+        free_slots = source_queue.free_slots(ConfigRegistry.register(params))
+        batch_size = max(1, min(params.get(u'kafka_batch_size') or 1, free_slots))
+        max_wait = params.get(u'kafka_max_wait') or 0
+        records = kafka_client.poll_batch(params[u'kafka_topic'], params[u'kafka_group'], batch_size, max_wait)
+        for record in records:
+            if record:
+                try:
+                    message_book.append(cls.__parse_kafka_message(record))
+                except Exception as e:
+                    logging.exception(u'Invalid kafka message! - {0}'.format(e.message))
+        if not message_book:
             logging.debug(u'No records in kafka queue({0})!'.format(params[u'kafka_group']))
-            gevent.sleep(1)
+            if not max_wait:
+                gevent.sleep(1)
         return message_book
 
-    @classmethod
-    def __build_mongodb_query(cls, id_cache_file, params):
+    @staticmethod
+    def __build_mongodb_query(params, cache_id):
         """
         构造mongodb查询语句
-        :param id_cache_file: id缓存文件
         :param params: 参数
+        :param cache_id: 起始_id，只查询_id大于该值的数据
         :return: 查询语句
         """
         query_dict = dict()
-        if os.path.exists(id_cache_file):
-            cache_id = tools.pickle_read_file(id_cache_file)
-            if cache_id:
-                if params[u'db_service']:
-                    query_dict[u'_id'] = {u'$gt': {u'$oid': cache_id}}
-                else:
-                    query_dict[u'_id'] = {u'$gt': ObjectId(cache_id)}
+        if cache_id:
+            if params[u'db_service']:
+                query_dict[u'_id'] = {u'$gt': {u'$oid': cache_id}}
+            else:
+                query_dict[u'_id'] = {u'$gt': ObjectId(cache_id)}
         return query_dict
 
+    @classmethod
+    def __fetch_mongodb_page(cls, params, cache_id, limit):
+        """
+        查询一页mongodb数据，只返回配置中的键
+        :param params: 参数
+        :param cache_id: 起始_id
+        :param limit: 数据量
+        :return: 按_id升序排列的数据列表
+        """
+        query_dict = cls.__build_mongodb_query(params, cache_id)
+        columns = list(params[u'db_keys']) or None
+        if params[u'db_service']:   # 使用接口服务
+            if columns and u'_id' not in columns:
+                columns.append(u'_id')
+            records = MongodbService.find(
+                params[u'db_schema'], params[u'db_table'], query_dict, limit,
+                columns=columns, env_schema=params.get(u'db_service_env')
+            )
+            db_records = json.loads(records) if records else None
+        else:                       # 直接连接数据库
+            db_records = list(MongodbClient.find(
+                params[u'db_schema'], params[u'db_table'], query_dict, limit, projection=columns))
+        if not isinstance(db_records, list):
+            logging.warning(u'invalid mongodb records - {0}|query_dict:{1}'.format(db_records, query_dict))
+            return []
+        return [msg for msg in db_records if msg]
+
     @classmethod
     def __fill_mongodb_message_book(cls, params, message_book, msg):
         """
@@ -113,140 +201,90 @@ class SourceProvider(object):
     @classmethod
     def __get_message_book_from_mongodb(cls, params):
         """
-        从mongodb获取数据
+        从mongodb获取数据，按_id键集分页，下一页在当前页的数据发送时预读。
+        每页数据全部发送到消息队列后才记录该页最后的_id
         :param params: 参数
-        :return: 获取的消息
+        :return: 消息生成器
         """
-        message_book = []
         id_cache_file = u'cache/{0}.id'.format(
             u'_'.join([u'mongodb', params[u'db_schema'], params[u'db_table'], tools.md5(params[u'class'])])
         )
-        query_dict = cls.__build_mongodb_query(id_cache_file, params)
-        db_records = []
-        if params[u'db_service']:   # 使用接口服务
-            records = MongodbService.find(
-                params[u'db_schema'], params[u'db_table'], query_dict, params[u'db_limit'],
-                env_schema=params.get(u'db_service_env')
-            )
-            if records:
-                db_records = json.loads(records)
-        else:                       # 直接连接数据库
-            db_records = MongodbClient.find(params[u'db_schema'], params[u'db_table'], query_dict, params[u'db_limit'])
-
-        if db_records:
-            is_valid = False
-            mongodb_id = None
-            for msg in db_records:
-                if msg:
-                    if not is_valid:
-                        is_valid = True
-                    if params[u'db_service']:
-                        mongodb_id = tools.clean_mongodb_service_id(msg[u'_id'])
-                    else:
-                        mongodb_id = str(msg[u'_id'])
-                    cls.__fill_mongodb_message_book(params, message_book, msg)
-            if is_valid and mongodb_id:
-                logging.debug(u'{0}\'s object_id: {1}'.format(params[u'db_table'], mongodb_id))
-                tools.pickle_write_file(id_cache_file, mongodb_id)
-            else:
-                logging.warning(u'++++++++> There\'re no records in mongodb({0})'.format(params[u'db_table']))
-                if params.get(u'loop'):
-                    tools.remove_file(id_cache_file)
+        cache_id = tools.pickle_read_file(id_cache_file) if os.path.exists(id_cache_file) else None
+        if params[u'db_service']:
+            key = lambda msg: tools.clean_mongodb_service_id(msg[u'_id'])
         else:
-            logging.warning(u'invalid mongodb records - {0}|query_dict:{1}'.format(db_records, query_dict))
-            if params.get(u'loop'):
-                tools.remove_file(id_cache_file)
-            gevent.sleep(3)
-        return message_book
+            key = lambda msg: str(msg[u'_id'])
+        pager = KeysetPager(
+            u'mongodb({0})'.format(params[u'db_table']),
+            lambda last, limit: cls.__fetch_mongodb_page(params, last, limit),
+            key, cache_id or None, params[u'db_limit'], params.get(u'db_prefetch') or 1
+        )
+        for records, mongodb_id in pager:
+            message_book = []
+            for msg in records:
+                cls.__fill_mongodb_message_book(params, message_book, msg)
+            for message in message_book:
+                yield message
+            logging.debug(u'{0}\'s object_id: {1}'.format(params[u'db_table'], mongodb_id))
+            tools.pickle_write_file(id_cache_file, mongodb_id, atomic=True)
+        logging.warning(u'++++++++> There\'re no more records in mongodb({0}), {1} records read'.format(
+            params[u'db_table'], pager.count))
+        if params.get(u'loop'):
+            tools.remove_file(id_cache_file)
+        gevent.sleep(3)
 
-    @classmethod
-    def __build_mysql_filter_by_param(cls, filter_str, schema, key, value):
+    # 筛选参数与比较运算符的对应关系
+    __mysql_operators = [
+        (u'$e', u'='), (u'$ne', u'!='), (u'$lt', u'<'), (u'$lte', u'<='), (u'$gt', u'>'), (u'$gte', u'>=')]
+
+    @staticmethod
+    def __mysql_keys(params):
         """
-        构造mysql查询的筛选参数
-        :param filter_str: 筛选语句
-        :param schema: 模式
-        :param key: 键
-        :param value: 值
-        :return: 新的查询语句
+        获取查询的字段列表，id总是作为第一个字段查询
+        :param params: 参数
+        :return: 字段列表
         """
-        if sys.version_info < (3, 4):
-            type_value = eval('(str, unicode)')
-        else:
-            type_value = eval('str')
-        if isinstance(value, type_value):
-            if filter_str:
-                filter_str += u' AND {0}'.format(u"{0}{1}'{2}'".format(key, schema, value))
-            else:
-                filter_str = u"{0}{1}'{2}'".format(key, schema, value)
-        else:
-            if filter_str:
-                filter_str += u' AND {0}'.format(u'{0}{1}{2}'.format(key, schema, value))
-            else:
-                filter_str = u'{0}{1}{2}'.format(key, schema, value)
-        return filter_str
+        keys = list(params[u'db_keys'])
+        if u'id' not in keys:
+            keys.insert(0, u'id')
+        return keys
 
     @classmethod
-    def __build_mysql_query(cls, id_cache_file, params):
+    def __build_mysql_query(cls, params, keys):
         """
-        构造MySQL查询语句
-        :param id_cache_file: id缓存文件
+        构造参数化的MySQL键集分页查询语句，筛选条件的值通过命名参数传递
         :param params: 参数
-        :return: 查询语句
-        """
-        query_str = u'SELECT {0} FROM {1}'.format(u','.join(params[u'db_keys']), params[u'db_table'])
-        # 将缓存的id添加到筛选参数中
-        if os.path.exists(id_cache_file):
-            cache_id = tools.pickle_read_file(id_cache_file)
-            if cache_id:
-                if not params.get(u'db_filter'):
-                    params[u'db_filter'] = dict()
-                if not params[u'db_filter'].get(u'$gt'):
-                    params[u'db_filter'][u'$gt'] = dict()
-                params[u'db_filter'][u'$gt'][u'id'] = cache_id
-        # 根据配置中的筛选参数查询
-        filter_str = u''
-        if params.get(u'db_filter'):
-            # 等于
-            if params[u'db_filter'].get(u'$e'):
-                for key in params[u'db_filter'][u'$e'].keys():
-                    filter_str = cls.__build_mysql_filter_by_param(
-                        filter_str, u'=', key, params[u'db_filter'][u'$e'][key])
-            # 不等于
-            if params[u'db_filter'].get(u'$ne'):
-                for key in params[u'db_filter'][u'$ne'].keys():
-                    filter_str = cls.__build_mysql_filter_by_param(
-                        filter_str, u'!=', key, params[u'db_filter'][u'$ne'][key])
-            # 小于
-            if params[u'db_filter'].get(u'$lt'):
-                for key in params[u'db_filter'][u'$lt'].keys():
-                    filter_str = cls.__build_mysql_filter_by_param(
-                        filter_str, u'<', key, params[u'db_filter'][u'$lt'][key])
-            # 小于等于
-            if params[u'db_filter'].get(u'$lte'):
-                for key in params[u'db_filter'][u'$lte'].keys():
-                    filter_str = cls.__build_mysql_filter_by_param(
-                        filter_str, u'<=', key, params[u'db_filter'][u'$lte'][key])
-            # 大于
-            if params[u'db_filter'].get(u'$gt'):
-                for key in params[u'db_filter'][u'$gt'].keys():
-                    filter_str = cls.__build_mysql_filter_by_param(
-                        filter_str, u'>', key, params[u'db_filter'][u'$gt'][key])
-            # 大于等于
-            if params[u'db_filter'].get(u'$gte'):
-                for key in params[u'db_filter'][u'$gte'].keys():
-                    filter_str = cls.__build_mysql_filter_by_param(
-                        filter_str, u'>=', key, params[u'db_filter'][u'$gte'][key])
-        if filter_str:
-            query_str += u' WHERE {0}'.format(filter_str)
-        if params[u'db_limit'] is not None:
-            query_str += u' LIMIT {0}'.format(params[u'db_limit'])
-        return query_str
+        :param keys: 字段列表
+        :return: 首页查询语句 | 后续页查询语句 | 查询参数，后续页以last_id为起点
+        """
+        conditions = list()
+        args = dict()
+        db_filter = params.get(u'db_filter') or dict()
+        for name, operator in cls.__mysql_operators:
+            for key in sorted((db_filter.get(name) or dict()).keys()):
+                arg = u'f{0}'.format(len(args))
+                conditions.append(u'{0}{1}%({2})s'.format(MySQLClient.check_expression(key), operator, arg))
+                args[arg] = db_filter[name][key]
+        query_str = u'SELECT {0} FROM {1}'.format(
+            u','.join(MySQLClient.check_expression(key) for key in keys),
+            MySQLClient.check_expression(params[u'db_table']))
+        queries = list()
+        for extra in [[], [u'id>%(last_id)s']]:
+            query = query_str
+            if conditions + extra:
+                query += u' WHERE {0}'.format(u' AND '.join(conditions + extra))
+            query += u' ORDER BY id'
+            if params[u'db_limit'] is not None:
+                query += u' LIMIT %(limit)s'
+            queries.append(query)
+        return queries[0], queries[1], args
 
     @classmethod
-    def __fill_mysql_message_book(cls, params, message_book, msg):
+    def __fill_mysql_message_book(cls, params, keys, message_book, msg):
         """
         筛选数据，填充数据列表
         :param params: 参数
+        :param keys: 字段列表
         :param message_book: 数据列表
         :param msg: 单条mysql数据
         :return: 无
@@ -259,7 +297,7 @@ class SourceProvider(object):
                 else:
                     message[key] = msg[key]
         else:
-            for i, key in enumerate(params[u'db_keys']):
+            for i, key in enumerate(keys):
                 if isinstance(msg[i], datetime.datetime):
                     message[key] = msg[i].strftime(u'%Y-%m-%d %H:%M:%S')
                 elif isinstance(msg[i], datetime.date):
@@ -269,167 +307,254 @@ class SourceProvider(object):
         if message:
             message_book.append(message)
 
-    @classmethod
-    def __get_message_book_from_mysql(cls, params):
+    @staticmethod
+    def __fetch_mysql_page(params, queries, cache_id, limit):
         """
-        从MySQL获取数据
+        查询一页MySQL数据
         :param params: 参数
-        :return: 获取的消息
-        """
-        message_book = []
-        if u'id' not in params[u'db_keys']:
-            params[u'db_keys'].insert(0, u'id')
-
-        id_cache_file = u'cache/{0}.id'.format(
-            u'_'.join([u'mysql', params[u'db_schema'], params[u'db_table'], tools.md5(params[u'class'])])
-        )
-        query_str = cls.__build_mysql_query(id_cache_file, params)
+        :param queries: 首页查询语句 | 后续页查询语句 | 查询参数
+        :param cache_id: 起始id
+        :param limit: 数据量
+        :return: 按id升序排列的数据列表
+        """
+        first_query, next_query, args = queries
+        args = dict(args, limit=limit)
+        if cache_id is None:
+            query_str = first_query
+        else:
+            query_str = next_query
+            args[u'last_id'] = cache_id
         if params[u'db_service']:  # 使用接口服务
             db_records = MySQLInterface.find(
                 schema=params[u'db_schema'],
                 db_query=query_str,
+                params=json.dumps(args, ensure_ascii=False, cls=CustomerJsonEncoder),
                 env_schema=params.get(u'db_service_env')
             )
-        else:  # 直接连接数据库
-            db_records = MySQLClient.find(params[u'db_schema'], query_str)
-
-        if db_records:
-            is_valid = False
-            mysql_id = None
-            for msg in db_records:
-                if msg:
-                    if not is_valid:
-                        is_valid = True
-                    if params[u'db_service']:
-                        mysql_id = msg[u'id']
-                    else:
-                        mysql_id = msg[params[u'db_keys'].index(u'id')]
-                    cls.__fill_mysql_message_book(params, message_book, msg)
-            if is_valid and mysql_id:
-                logging.debug(u'{0}\'s id: {1}'.format(params[u'db_table'], mysql_id))
-                tools.pickle_write_file(id_cache_file, mysql_id)
-            else:
-                logging.warning(u'++++++++> There\'re no records in mysql({0})'.format(params[u'db_table']))
-                if params.get(u'loop'):
-                    tools.remove_file(id_cache_file)
-        else:
+        else:  # 直接连接数据库，使用流式游标逐行读取
+            db_records = list(MySQLClient.iter_find(params[u'db_schema'], query_str, args))
+        if not isinstance(db_records, (list, tuple)):
             logging.warning(u'invalid mysql records - {0}|query_str:{1}'.format(db_records, query_str))
-            if params.get(u'loop'):
-                tools.remove_file(id_cache_file)
-            gevent.sleep(3)
-        return message_book
+            return []
+        return [msg for msg in db_records if msg]
 
     @classmethod
-    def __read_record_from_excel(cls, filename, workbook, sheet_names, source_queue, params, mark_num, mark_file):
+    def __get_message_book_from_mysql(cls, params):
         """
-        从excel文件读取数据
-        :param filename: excel文件名
-        :param workbook: excel文件对象
-        :param sheet_names: sheet名列表
-        :param source_queue: 消息队列
+        从MySQL获取数据，按id键集分页，下一页在当前页的数据发送时预读。
+        每页数据全部发送到消息队列后才记录该页最后的id
+        :param params: 参数
+        :return: 消息生成器
+        """
+        keys = cls.__mysql_keys(params)
+        queries = cls.__build_mysql_query(params, keys)
+        id_cache_file = u'cache/{0}.id'.format(
+            u'_'.join([u'mysql', params[u'db_schema'], params[u'db_table'], tools.md5(params[u'class'])])
+        )
+        cache_id = tools.pickle_read_file(id_cache_file) if os.path.exists(id_cache_file) else None
+        if params[u'db_service']:
+            key = lambda msg: msg[u'id']
+        else:
+            key = lambda msg: msg[keys.index(u'id')]
+        pager = KeysetPager(
+            u'mysql({0})'.format(params[u'db_table']),
+            lambda last, limit: cls.__fetch_mysql_page(params, queries, last, limit),
+            key, cache_id, params[u'db_limit'], params.get(u'db_prefetch') or 1
+        )
+        for records, mysql_id in pager:
+            message_book = []
+            for msg in records:
+                cls.__fill_mysql_message_book(params, keys, message_book, msg)
+            for message in message_book:
+                yield message
+            logging.debug(u'{0}\'s id: {1}'.format(params[u'db_table'], mysql_id))
+            tools.pickle_write_file(id_cache_file, mysql_id, atomic=True)
+        logging.warning(u'++++++++> There\'re no more records in mysql({0}), {1} records read'.format(
+            params[u'db_table'], pager.count))
+        if params.get(u'loop'):
+            tools.remove_file(id_cache_file)
+        gevent.sleep(3)
+
+    @staticmethod
+    def __file_scheduler(params):
+        """
+        创建文件数据源调度器
         :param params: 配置参数
-        :param mark_num: 记录在临时文件中的已经读取到的行数
-        :param mark_file: 记录行数的临时文件名
-        :return: 无
+        :return: 调度器
         """
-        sheet, row_num, col_num = excel_client.read_sheet_by_name(workbook, sheet_names[0])
-        for i in tools.irange(0, row_num):
-            if i <= mark_num:
-                continue
-            record = excel_client.read_sheet_row_by_index(sheet, i)
+        return FileIngestScheduler(
+            params.get(u'province', u'Provider'), params.get(u'file_concurrency') or 1,
+            FILE_INGEST_CONFIG[u'chunk_size'], FILE_INGEST_CONFIG[u'report_interval'])
+
+    @staticmethod
+    def __excel_rows(filename, params, marks, sheets):
+        """
+        在线程池中执行：读取excel数据并构造消息
+        :param filename: excel文件名
+        :param params: 配置参数
+        :param marks: 各sheet的读取进度
+        :param sheets: [(sheet名, 行数)]，用于计算读取位置
+        :return: (消息, 读取位置, (sheet名, 行索引))生成器
+        """
+        before = dict()
+        total = 0
+        for name, rows in sheets:
+            before[name] = total
+            total += rows or 0
+        for sheet_name, i, record in excel_client.iter_rows(filename, params.get(u'excel_sheets'), marks):
             if record:
                 message = dict()
                 for index, value in enumerate(record):
                     message[u'key{0}'.format(index)] = value
-                # message_book.append(message)
-                while 1:
-                    if source_queue.qsize() < SOURCE_QUEUE_MAX_SIZE:
-                        cls.__source_queue_pusher(source_queue, params, message)
-                        if i % 100 == 0:
-                            logging.info(u'========> {0}-{1}已经发送了{2}条数据'.format(
-                                params.get(u'province', u'Provider'), filename, i + 1))
-                        if i % 1000 == 0:
-                            tools.pickle_write_file(mark_file, max(0, i - 1000))
-                            gevent.sleep(0.1)
-                        break
-                    else:
-                        tools.pickle_write_file(mark_file, max(i - 1000, tools.pickle_read_file(mark_file)))
-                        gevent.sleep(2)
-        # 遍历完毕，设置mark_file为-1
-        tools.pickle_write_file(mark_file, -1)
+                yield message, before.get(sheet_name, 0) + i + 1, (sheet_name, i)
+
+    @classmethod
+    def __schedule_excel_file(cls, scheduler, filename, source_queue, params, mark_num, mark_file):
+        """
+        将excel文件加入调度器，按sheet记录进度
+        :param scheduler: 文件数据源调度器
+        :param filename: excel文件名
+        :param source_queue: 消息队列
+        :param params: 配置参数
+        :param mark_num: 记录在临时文件中的各sheet读取进度
+        :param mark_file: 记录进度的临时文件名
+        :return: 无
+        """
+        # 兼容旧版只记录第一个sheet行数的进度
+        marks = dict(mark_num) if isinstance(mark_num, dict) else {0: mark_num or 0}
+        sheets = gevent.get_hub().threadpool.apply(excel_client.sheet_rows, (filename, params.get(u'excel_sheets')))
+        total = None if any(rows is None for name, rows in sheets) else sum(rows for name, rows in sheets)
+        current = [None]
+
+        def push(message, state):
+            sheet_name, i = state
+            if sheet_name != current[0]:
+                if current[0] is not None:
+                    marks[current[0]] = -1
+                current[0] = sheet_name
+            cls.__source_queue_pusher(source_queue, params, message)
+            if i % 100 == 0:
+                logging.info(u'========> {0}-{1}-{2}已经发送了{3}条数据'.format(
+                    params.get(u'province', u'Provider'), filename, sheet_name, i + 1))
+            if i % cls._checkpoint_rows == 0:
+                marks[sheet_name] = max(0, i - cls._checkpoint_rows)
+                tools.pickle_write_file(mark_file, marks, atomic=True)
+
+        def finish():
+            # 遍历完毕，设置mark_file为-1
+            tools.pickle_write_file(mark_file, -1, atomic=True)
+
+        scheduler.add(filename, cls.__excel_rows(filename, params, dict(marks), sheets), push, total,
+                      (params.get(u'file_weights') or dict()).get(filename, 1), finish)
 
     @classmethod
     def __get_message_book_from_excel(cls, source_queue, params):
         """
-        从excel获取数据
+        从excel获取数据，多个文件同时读取
         :param source_queue: 消息队列
         :param params: 参数
         :return: 获取的消息
         """
         message_book = []
         try:
+            scheduler = cls.__file_scheduler(params)
             for filename in params[u'messages']:
                 if os.path.exists(filename):
-                    workbook, sheet_names = excel_client.read_excel(filename)
-                    if sheet_names:
-                        mark_file = cls.__init_mark_file_name(params, filename)
-                        mark_num = cls.__init_mark_num(mark_file)
-                        if mark_num == -1:
-                            logging.warning(u'========> {0} has been finished!'.format(filename))
-                            continue
-                        cls.__read_record_from_excel(
-                            filename, workbook, sheet_names, source_queue, params, mark_num, mark_file)
+                    mark_file = cls.__init_mark_file_name(params, filename)
+                    mark_num = cls.__init_mark_num(mark_file)
+                    if mark_num == -1:
+                        logging.warning(u'========> {0} has been finished!'.format(filename))
+                        continue
+                    cls.__schedule_excel_file(scheduler, filename, source_queue, params, mark_num, mark_file)
+            scheduler.run()
         except Exception as e:
             logging.exception(u'Get messages from excel error! - {0}'.format(e.message))
         return message_book
 
+    @staticmethod
+    def __init_csv_checkpoint(filename, source_encode, params, mark_num):
+        """
+        初始化csv读取进度，兼容旧版按行数记录的进度，并跳过表头
+        :param filename: 文件名
+        :param source_encode: 文件编码
+        :param params: 配置参数
+        :param mark_num: 记录文件中保存的进度
+        :return: 进度{offset: 字节偏移量, count: 已读取行数} | 字段名列表
+        """
+        if isinstance(mark_num, dict):
+            checkpoint = mark_num
+        elif mark_num:
+            checkpoint = {u'offset': csv_client.line_offset(filename, mark_num), u'count': mark_num}
+        else:
+            checkpoint = {u'offset': 0, u'count': 0}
+        header = params.get(u'csv_header')
+        if header is True:
+            header, header_end = csv_client.read_header(filename, source_encode, params.get(u'csv_delimiter') or u',')
+            if checkpoint[u'offset'] < header_end:
+                checkpoint = {u'offset': header_end, u'count': 0}
+        return checkpoint, header or list()
+
+    @staticmethod
+    def __csv_rows(filename, source_encode, params, checkpoint, header):
+        """
+        在线程池中执行：读取csv数据并构造消息
+        :param filename: 文件名
+        :param source_encode: 文件编码
+        :param params: 配置参数
+        :param checkpoint: 读取进度
+        :param header: 字段名列表
+        :return: (消息, 字节偏移量, (字节偏移量, 已读取行数))生成器
+        """
+        count = checkpoint[u'count']
+        rows = csv_client.iter_rows(
+            filename, source_encode, checkpoint[u'offset'], params.get(u'csv_delimiter') or u',')
+        for row_items, offset in rows:
+            count += 1
+            message = dict()
+            for index, value in enumerate(row_items):
+                key = header[index] if index < len(header) and header[index] else u'key{0}'.format(index)
+                message[key] = value.strip()
+            yield message, offset, (offset, count)
+
     @classmethod
-    def __read_record_from_csv(cls, filename, source_encode, source_queue, params, mark_num, mark_file):
+    def __schedule_csv_file(cls, scheduler, filename, source_encode, source_queue, params, mark_num, mark_file):
         """
-        从csv文件读取数据
+        将csv文件加入调度器，按字节偏移量记录进度，恢复时直接定位
+        :param scheduler: 文件数据源调度器
         :param filename: 文件名
         :param source_encode: 文件编码
         :param source_queue: 消息队列
         :param params: 配置参数
-        :param mark_num: 记录在临时文件中的已经读取到的行数
-        :param mark_num: 记录行数的临时文件名
+        :param mark_num: 记录在临时文件中的读取进度
+        :param mark_file: 记录进度的临时文件名
         :return: 无
         """
-        count = 0
-        with io.open(filename, encoding=source_encode) as f:
-            try:
-                for line in f:
-                    count += 1
-                    if count <= mark_num:
-                        continue
-                    row_items = line.split(u',')
-                    if row_items:
-                        message = dict()
-                        for index, value in enumerate(row_items):
-                            message[u'key{0}'.format(index)] = value.strip()
-                        # message_book.append(message)
-                        while 1:
-                            if source_queue.qsize() < SOURCE_QUEUE_MAX_SIZE:
-                                cls.__source_queue_pusher(source_queue, params, message)
-                                if count % 100 == 0:
-                                    logging.info(u'========> {0}-{1}已经发送了{2}条数据'.format(
-                                        params.get(u'province', u'Provider'), filename, count))
-                                if count % 1000 == 0:
-                                    tools.pickle_write_file(mark_file, max(0, count - 1000))
-                                    gevent.sleep(0.1)
-                                break
-                            else:
-                                tools.pickle_write_file(mark_file, max(count - 1000, tools.pickle_read_file(mark_file)))
-                                gevent.sleep(2)
-                # 遍历完毕，设置mark_file为-1
-                tools.pickle_write_file(mark_file, -1)
-            except Exception as e:
-                logging.exception(u'Read CSV file Error! - {0}'.format(e.message))
+        checkpoint, header = gevent.get_hub().threadpool.apply(
+            cls.__init_csv_checkpoint, (filename, source_encode, params, mark_num))
+        # 已经发送但可能还在队列中的数据在重启后需要重新读取，因此记录的是上一次的进度
+        saved = [checkpoint]
+
+        def push(message, state):
+            offset, count = state
+            cls.__source_queue_pusher(source_queue, params, message)
+            if count % 100 == 0:
+                logging.info(u'========> {0}-{1}已经发送了{2}条数据'.format(
+                    params.get(u'province', u'Provider'), filename, count))
+            if count % cls._checkpoint_rows == 0:
+                tools.pickle_write_file(mark_file, saved[0], atomic=True)
+                saved[0] = {u'offset': offset, u'count': count}
+
+        def finish():
+            # 遍历完毕，设置mark_file为-1
+            tools.pickle_write_file(mark_file, -1, atomic=True)
+
+        scheduler.add(filename, cls.__csv_rows(filename, source_encode, params, checkpoint, header), push,
+                      os.path.getsize(filename), (params.get(u'file_weights') or dict()).get(filename, 1), finish)
 
     @classmethod
     def __get_message_book_from_csv(cls, source_queue, params):
         """
-        从CSV获取数据
+        从CSV获取数据，多个文件同时读取
         :param source_queue: 消息队列
         :param params: 参数
         :return: 获取的消息
@@ -439,6 +564,7 @@ class SourceProvider(object):
             source_encode = u'UTF-8'
             if params.get(u'source_encode'):
                 source_encode = params[u'source_encode']
+            scheduler = cls.__file_scheduler(params)
             for filename in params[u'messages']:
                 if os.path.exists(filename):
                     mark_file = cls.__init_mark_file_name(params, filename)
@@ -446,7 +572,9 @@ class SourceProvider(object):
                     if mark_num == -1:
                         logging.warning(u'========> {0} has been finished!'.format(filename))
                         continue
-                    cls.__read_record_from_csv(filename, source_encode, source_queue, params, mark_num, mark_file)
+                    cls.__schedule_csv_file(
+                        scheduler, filename, source_encode, source_queue, params, mark_num, mark_file)
+            scheduler.run()
         except Exception as e:
             logging.exception(u'Get message from csv error! - {0}'.format(e.message))
         return message_book
@@ -459,8 +587,15 @@ class SourceProvider(object):
         :param filename: 数据源文件
         :return: 记录文件名
         """
-        return u'cache/{0}_num_{1}_{2}.txt'.format(
-                    params[u'source'], filename.split(u'/')[-1].split(u'.')[0], tools.build_plugin_id(params))
+        name = filename.split(u'/')[-1].split(u'.')[0]
+        mark_file = u'cache/{0}_num_{1}_{2}.txt'.format(params[u'source'], name, ConfigRegistry.register(params))
+        if not os.path.exists(mark_file):
+            # 沿用旧版插件ID生成的记录文件
+            legacy_file = u'cache/{0}_num_{1}_{2}.txt'.format(
+                params[u'source'], name, tools.build_legacy_plugin_id(params))
+            if os.path.exists(legacy_file):
+                os.rename(legacy_file, mark_file)
+        return mark_file
 
     @staticmethod
     def __init_mark_num(mark_file):
@@ -497,7 +632,7 @@ class SourceProvider(object):
                     message_book = [{u'date': tools.days_before(1)}]
                 else:
                     if params[u'source'] == u'kafka':
-                        message_book = cls.__get_message_book_from_kafka(params)
+                        message_book = cls.__get_message_book_from_kafka(source_queue, params)
                     elif params[u'source'] == u'mongodb':
                         message_book = cls.__get_message_book_from_mongodb(params)
                     elif params[u'source'] == u'mysql':
@@ -508,19 +643,17 @@ class SourceProvider(object):
         return message_book
 
     @classmethod
-    def __cache_message_pickle(cls, params, message):
+    def __record_message(cls, params, message):
         """
-        将消息缓存至临时文件
+        将消息记录到预写日志
         :param params: 参数
         :param message: 消息主体
         :return: 无
         """
-        filename = u'cache/{0}_{1}'.format(tools.build_plugin_id(params), tools.build_plugin_id(message))
         try:
-            tools.pickle_write_file(filename, message)
-            message[CACHE_FILE_KEY] = filename
+            message[CACHE_FILE_KEY] = MessageJournal.record(ConfigRegistry.register(params), message)
         except Exception as e:
-            logging.exception(u'cache message pickle error! - {0}'.format(e.message))
+            logging.exception(u'record message error! - {0}'.format(e.message))
 
     @classmethod
     def __source_queue_pusher(cls, source_queue, params, message):
@@ -534,15 +667,13 @@ class SourceProvider(object):
         if not isinstance(message, dict):
             logging.error(u'Invalid message! - {0}'.format(message))
             return
-        # 缓存至临时文件
-        # 从本地消息中加载的数据不写入文件
-        if params[u'source'] not in cls._localhost_message_types:
-            cls.__cache_message_pickle(params, message)
+        # 记录到预写日志，从日志中恢复的消息已经重新记录
+        # 从本地消息中加载的数据不记录，分布式队列自身保存消息，也不记录
+        if params[u'source'] not in cls._localhost_message_types and CACHE_FILE_KEY not in message \
+                and not is_distributed():
+            cls.__record_message(params, message)
         # 将消息发送到内存队列
-        source_queue.put((
-            int(params[u'priority']),
-            json.dumps({u'message': message, u'config': params}, ensure_ascii=False, cls=CustomerJsonEncoder)
-        ))
+        source_queue.put(QueueEnvelope(params[u'priority'], message, ConfigRegistry.register(params)))
 
     @classmethod
     def __push_source_messages(cls, source_queue, params, first):
@@ -557,7 +688,7 @@ class SourceProvider(object):
         if message_book:
             if isinstance(message_book, dict):
                 cls.__source_queue_pusher(source_queue, params, message_book)
-            elif isinstance(message_book, list):
+            elif isinstance(message_book, (list, types.GeneratorType)):
                 for m in message_book:
                     cls.__source_queue_pusher(source_queue, params, m)
             else:
@@ -570,8 +701,7 @@ class SourceProvider(object):
         :param args: 参数
         :return: 无
         """
-        params, source_queue = args
-        first = True
+        params, source_queue, first = args
         while 1:
             try:
                 # 检查运行时间
@@ -586,28 +716,68 @@ class SourceProvider(object):
                         gevent.sleep(60)
                         if not params.get(u'loop'):
                             break
-                elif source_queue.qsize() < SOURCE_QUEUE_MAX_SIZE:
+                else:
+                    # 消息队列已满或插件达到高水位时put阻塞，回落到低水位后立即恢复
                     SourceProvider.__push_source_messages(source_queue, params, first)
                     if first:
                         first = False
-                else:
-                    logging.debug(u'too many messages in source queue!')
-                    gevent.sleep(10)
             except Exception as e:
                 logging.exception(u'source provider error! - {0}'.format(e.message))
                 gevent.sleep(3)
 
 
+def register_plugins(schema):
+    """
+    登记指定模式下所有插件的配置并计算插件ID，此后只在队列中传递插件ID。
+    处理消息的进程都要登记所有插件，包括多进程模式下的每个worker和只处理消息的consumer
+    :param schema: 模式
+    :return: 插件配置列表
+    """
+    plugin_sets = list()
+    for plugin in PROJECT_SETTING[u'PLUGINS'][schema]:
+        plugin_set = copy.deepcopy(PROJECT_SETTING[u'COMMON'])
+        plugin_set.update(plugin)
+        ConfigRegistry.register(plugin_set)
+        plugin_sets.append(plugin_set)
+    return plugin_sets
+
+
+def __relay(shared_queue, source_queue):
+    """
+    将共享队列中的消息转发到本进程的消息队列，本进程队列已满时暂停读取
+    :param shared_queue: 各worker共享的消息队列
+    :param source_queue: 本进程的消息队列
+    :return: 无
+    """
+    while 1:
+        try:
+            source_queue.put(shared_queue.get())
+        except Exception as e:
+            logging.exception(u'relay shared messages error! - {0}'.format(e.message))
+            gevent.sleep(3)
+
+
 def run(args):
     """
     开启所有插件的消息提供
     :param args: 参数
     :return: 无
     """
-    options, source_queue = args
+    options, source_queue, shared_queue = args
     tasks = list()
-    for plugin in PROJECT_SETTING[u'PLUGINS'][options.schema]:
-        plugin_set = copy.deepcopy(PROJECT_SETTING[u'COMMON'])
-        plugin_set.update(plugin)
-        tasks.append(gevent.spawn(SourceProvider.run, (plugin_set, source_queue)))
-    gevent.joinall(tasks)
+    for index, plugin_set in enumerate(register_plugins(options.schema)):
+        if shared_queue is None:
+            tasks.append(gevent.spawn(SourceProvider.run, (plugin_set, source_queue, True)))
+            continue
+        owner = index % options.workers == options.worker_index
+        if plugin_set[u'source'] == u'kafka':
+            # kafka插件在每个worker中运行，由消费组分配消息，缓存文件只由一个worker恢复
+            tasks.append(gevent.spawn(SourceProvider.run, (plugin_set, source_queue, owner)))
+        elif owner:
+            tasks.append(gevent.spawn(SourceProvider.run, (plugin_set, SerializingQueue(shared_queue), True)))
+    if shared_queue is not None:
+        tasks.append(gevent.spawn(__relay, SerializingQueue(shared_queue), source_queue))
+    try:
+        gevent.joinall(tasks)
+    finally:
+        gevent.killall(tasks)
@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+
+import gevent
+import gevent.select
+from gevent.event import Event
+from gevent.queue import PriorityQueue, Full, Empty
+from gevent.threadpool import ThreadPool
+
+from src.config import QUEUE_BACKEND, REDIS_QUEUE_CONFIG
+from src.cores.envelope import QueueEnvelope
+from src.cores.registry import ConfigRegistry
+from src.cores.services.redis_client import RedisClient
+
+# 取出待处理的消息并移入处理中集合，返回[成员, 消息, 成员, 消息...]
+_FETCH_SCRIPT = """
+local members = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+local result = {}
+for i, member in ipairs(members) do
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('ZADD', KEYS[2], ARGV[2], member)
+    result[#result + 1] = member
+    result[#result + 1] = redis.call('HGET', KEYS[3], member) or ''
+end
+return result
+"""
+
+# 将超时未确认的消息按原优先级放回待处理集合，成员以优先级开头
+_RECLAIM_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for i, member in ipairs(members) do
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZADD', KEYS[1], tonumber(string.match(member, '^(-?%d+):')), member)
+end
+return #members
+"""
+
+
+def is_distributed():
+    """
+    是否使用分布式队列。分布式队列自身保证消息至少被处理一次，消息不再记录到本地的预写日志
+    :return: 判断结果
+    """
+    return QUEUE_BACKEND == u'redis'
+
+
+def create_queue(name, capacity, namespace):
+    """
+    按配置的QUEUE_BACKEND创建队列
+    :param name: 队列名称
+    :param capacity: 队列容量
+    :param namespace: 命名空间，分布式队列中同一命名空间的队列在各台机器之间共享
+    :return: 队列
+    """
+    if is_distributed():
+        return RedisPriorityQueue(name, capacity, namespace)
+    return BoundedPriorityQueue(name, capacity)
+
+
+def acknowledge(receipt):
+    """
+    确认分布式队列中的消息已处理完成，本地队列的消息没有回执
+    :param receipt: 投递回执
+    :return: 无
+    """
+    if receipt:
+        RedisPriorityQueue.acknowledge(receipt)
+
+
+class BoundedPriorityQueue(PriorityQueue):
+    """
+    有界优先级队列，队列已满或插件达到高水位时put阻塞，
+    有空位或插件回落到低水位时立即唤醒生产者，并统计队列水位
+    """
+
+    def __init__(self, name, capacity):
+        """
+        初始化
+        :param name: 队列名称，仅用于日志和统计
+        :param capacity: 队列容量
+        """
+        # 容量由put自行控制，底层队列不限长度，以便处理函数回写消息和停止信号不受容量限制
+        PriorityQueue.__init__(self)
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.__space = Event()
+        self.__space.set()
+        self.__counts = collections.defaultdict(int)
+        self.__gates = dict()
+        self.__watermarks = dict()
+        self.__puts = 0
+        self.__gets = 0
+        self.__blocked_puts = 0
+        self.__blocked_seconds = 0.0
+        self.__peak = 0
+
+    def watermarks(self, plugin_id):
+        """
+        插件在本队列中的高低水位，由插件配置的queue_high_watermark、queue_low_watermark按队列容量换算
+        :param plugin_id: 插件ID
+        :return: 高水位 | 低水位
+        """
+        if plugin_id not in self.__watermarks:
+            try:
+                config = ConfigRegistry.get(plugin_id)
+            except KeyError:
+                config = dict()
+            high = max(1, int(self.capacity * (config.get(u'queue_high_watermark') or 1.0)))
+            low = min(high - 1, int(self.capacity * (config.get(u'queue_low_watermark') or 0.8)))
+            self.__watermarks[plugin_id] = (min(high, self.capacity), max(0, low))
+        return self.__watermarks[plugin_id]
+
+    def __gate(self, plugin_id):
+        """
+        插件的入队闸门，未达到高水位时打开
+        :param plugin_id: 插件ID
+        :return: 闸门事件
+        """
+        gate = self.__gates.get(plugin_id)
+        if gate is None:
+            gate = self.__gates[plugin_id] = Event()
+            gate.set()
+        return gate
+
+    def free_slots(self, plugin_id):
+        """
+        插件当前可以不阻塞写入的消息数量
+        :param plugin_id: 插件ID
+        :return: 消息数量
+        """
+        high, low = self.watermarks(plugin_id)
+        if not self.__gate(plugin_id).is_set():
+            return 0
+        return max(0, min(self.capacity - self.qsize(), high - self.__counts[plugin_id]))
+
+    def put(self, item, block=True, timeout=None, overflow=False):
+        """
+        写入队列，队列已满或插件达到高水位时阻塞
+        :param item: 队列元素
+        :param block: 是否阻塞
+        :param timeout: 最长阻塞时间（秒）
+        :param overflow: 是否忽略容量限制，用于消费者回写消息，避免消费者互相等待造成死锁
+        :return: 无
+        """
+        if not overflow and not item.is_stop:
+            gate = self.__gate(item.config_id)
+            deadline = None if timeout is None else time.time() + timeout
+            start = None
+            while not gate.is_set() or self.qsize() >= self.capacity:
+                if not block:
+                    raise Full
+                if start is None:
+                    start = time.time()
+                    self.__blocked_puts += 1
+                event = self.__space if gate.is_set() else gate
+                if not event.wait(None if deadline is None else max(0, deadline - time.time())):
+                    self.__blocked_seconds += time.time() - start
+                    raise Full
+            if start is not None:
+                self.__blocked_seconds += time.time() - start
+        PriorityQueue.put(self, item)
+
+    def _put(self, item):
+        PriorityQueue._put(self, item)
+        self.__puts += 1
+        size = self.qsize()
+        self.__peak = max(self.__peak, size)
+        if size >= self.capacity:
+            self.__space.clear()
+        plugin_id = getattr(item, u'config_id', None)
+        if plugin_id is not None:
+            self.__counts[plugin_id] += 1
+            if self.__counts[plugin_id] >= self.watermarks(plugin_id)[0]:
+                self.__gate(plugin_id).clear()
+
+    def _get(self):
+        item = PriorityQueue._get(self)
+        self.__gets += 1
+        if self.qsize() < self.capacity:
+            self.__space.set()
+        plugin_id = getattr(item, u'config_id', None)
+        if plugin_id is not None:
+            self.__counts[plugin_id] -= 1
+            if self.__counts[plugin_id] <= self.watermarks(plugin_id)[1]:
+                self.__gate(plugin_id).set()
+            if not self.__counts[plugin_id]:
+                self.__counts.pop(plugin_id)
+        return item
+
+    def metrics(self):
+        """
+        队列水位统计
+        :return: 统计结果
+        """
+        size = self.qsize()
+        return {
+            u'name': self.name,
+            u'size': size,
+            u'capacity': self.capacity,
+            u'fill': round(float(size) / self.capacity, 4),
+            u'peak': self.__peak,
+            u'puts': self.__puts,
+            u'gets': self.__gets,
+            u'blocked_puts': self.__blocked_puts,
+            u'blocked_seconds': round(self.__blocked_seconds, 3),
+            u'plugins': dict(self.__counts),
+            u'paused_plugins': [k for k, gate in self.__gates.items() if not gate.is_set()]
+        }
+
+
+class IpcQueue(object):
+    """
+    基于管道的跨进程队列，需要在fork之前创建。读写在线程池中进行，不阻塞gevent事件循环，
+    管道缓冲区写满时写入方等待，读取方处理不过来时自然形成反压。
+    读和写各使用一个专用线程，不占用事件循环的默认线程池：写入方阻塞时，文件读取等任务和读取方仍能取得线程
+    """
+
+    def __init__(self):
+        self.__reader, self.__writer = multiprocessing.Pipe(duplex=False)
+        self.__read_lock = multiprocessing.Lock()
+        self.__write_lock = multiprocessing.Lock()
+        self.__size = multiprocessing.Value('i', 0)
+        self.__pools = None
+
+    def __pool(self, index):
+        """
+        获取本进程的读(0)或写(1)线程池，fork之后在各进程中首次使用时创建
+        :param index: 0为读，1为写
+        :return: 线程池
+        """
+        if self.__pools is None or self.__pools[0] != os.getpid():
+            self.__pools = (os.getpid(), ThreadPool(1), ThreadPool(1))
+        return self.__pools[1 + index]
+
+    def __send(self, item):
+        # 先计数再写入，读取方取出后再减少，计数不会为负
+        with self.__size.get_lock():
+            self.__size.value += 1
+        try:
+            with self.__write_lock:
+                self.__writer.send(item)
+        except Exception:
+            with self.__size.get_lock():
+                self.__size.value -= 1
+            raise
+
+    def __receive(self, timeout, cancelled):
+        """
+        在线程池中执行：读取一条消息。等待的协程被杀死后线程不会随之停止，
+        因此每次读取前检查取消标记，已取出但无人接收的消息重新写回管道
+        :param timeout: 最长等待时间（秒）
+        :param cancelled: 取消标记，[是否已取消]
+        :return: 消息，已取消时为None
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not cancelled[0]:
+            # 每次只短暂持有读锁，避免持锁的进程退出后其他进程永远无法读取
+            with self.__read_lock:
+                if self.__reader.poll(0.5) and not cancelled[0]:
+                    item = self.__reader.recv()
+                    with self.__size.get_lock():
+                        self.__size.value -= 1
+                    if cancelled[0]:
+                        self.__send(item)
+                        return None
+                    return item
+            if deadline is not None and time.time() >= deadline:
+                raise Empty
+        return None
+
+    def put(self, item, block=True, timeout=None):
+        """
+        写入队列，管道缓冲区已满时阻塞
+        :param item: 队列元素
+        :param block: 是否阻塞
+        :param timeout: 最长阻塞时间（秒）
+        :return: 无
+        """
+        if not block or timeout is not None:
+            # 在事件循环中等待管道可写，超时后放弃写入；单个元素超过管道剩余空间时写入仍会短暂阻塞
+            writable = gevent.select.select([], [self.__writer.fileno()], [], timeout if block else 0)[1]
+            if not writable:
+                raise Full
+        # 并发的写入在线程池中排队，管道的写锁本就只允许一个写入方
+        self.__pool(1).apply(self.__send, (item,))
+
+    def get(self, block=True, timeout=None):
+        """
+        取出一个元素，等待的协程被杀死时通知读取线程停止读取
+        :param block: 是否阻塞
+        :param timeout: 最长阻塞时间（秒）
+        :return: 队列元素
+        """
+        cancelled = [False]
+        try:
+            return self.__pool(0).apply(self.__receive, (timeout if block else 0, cancelled))
+        finally:
+            cancelled[0] = True
+
+    def qsize(self):
+        return self.__size.value
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class RedisPriorityQueue(object):
+    """
+    基于redis的分布式优先级队列，多台机器共享同一个队列。待处理的消息保存在有序集合中，分数为优先级，
+    优先级相同时按入队时间排序；取出的消息移入处理中集合，分数为可见性超时的时间点，确认后删除，
+    超时未确认的消息重新放回待处理集合，保证消息至少被处理一次。进程定期延长本进程持有的消息的可见性超时，
+    处理时间较长的消息不会在处理期间被其他机器重新取出，进程退出后不再延长。
+    每个进程在本地预取少量消息，停止信号只在本地传递；容量按整个队列计算，不区分插件水位
+    """
+
+    # 本进程取出、尚未确认的消息，{投递回执: 取出的时间}
+    __leases = dict()
+    __heartbeat = None
+
+    def __init__(self, name, capacity, namespace):
+        """
+        初始化
+        :param name: 队列名称
+        :param capacity: 队列容量
+        :param namespace: 命名空间
+        """
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.key = u'{0}:{1}:{2}'.format(REDIS_QUEUE_CONFIG[u'prefix'], namespace, name)
+        self.__buffer = PriorityQueue()
+        self.__demand = Event()
+        self.__tasks = list()
+        self.__stopping = False
+        self.__size = 0
+        self.__size_time = 0
+        self.__puts = 0
+        self.__gets = 0
+        self.__reclaimed = 0
+        self.__blocked_puts = 0
+        self.__blocked_seconds = 0.0
+        self.__peak = 0
+        self.__scripts = dict()
+
+    @staticmethod
+    def __keys(key):
+        return key + u':pending', key + u':processing', key + u':payloads'
+
+    @staticmethod
+    def __execute(func):
+        return RedisClient.execute(REDIS_QUEUE_CONFIG[u'schema'], REDIS_QUEUE_CONFIG[u'index'], func)
+
+    def __script(self, r, source):
+        script = self.__scripts.get(source)
+        if script is None:
+            script = self.__scripts[source] = r.register_script(source)
+        return script
+
+    def __pending_size(self, refresh=False):
+        """
+        待处理的消息数量，写入时使用缓存的值，避免每条消息多一次往返
+        :param refresh: 是否强制刷新
+        :return: 消息数量
+        """
+        if refresh or time.time() - self.__size_time >= REDIS_QUEUE_CONFIG[u'size_cache']:
+            pending = self.__keys(self.key)[0]
+            self.__size = self.__execute(lambda r: r.zcard(pending))
+            self.__size_time = time.time()
+            self.__peak = max(self.__peak, self.__size)
+        return self.__size
+
+    def free_slots(self, plugin_id):
+        """
+        当前可以不阻塞写入的消息数量
+        :param plugin_id: 插件ID
+        :return: 消息数量
+        """
+        return max(0, self.capacity - self.__pending_size())
+
+    def put(self, item, block=True, timeout=None, overflow=False):
+        """
+        写入队列，队列已满时阻塞。停止信号只放入本地缓冲区，并停止预取
+        :param item: 队列元素
+        :param block: 是否阻塞
+        :param timeout: 最长阻塞时间（秒）
+        :param overflow: 是否忽略容量限制
+        :return: 无
+        """
+        if item.is_stop:
+            self.__stopping = True
+            self.__buffer.put(item)
+            return
+        if not overflow and self.__pending_size() >= self.capacity:
+            if not block:
+                raise Full
+            start = time.time()
+            self.__blocked_puts += 1
+            while self.__pending_size(refresh=True) >= self.capacity:
+                if timeout is not None and time.time() - start >= timeout:
+                    self.__blocked_seconds += time.time() - start
+                    raise Full
+                gevent.sleep(REDIS_QUEUE_CONFIG[u'poll_interval'])
+            self.__blocked_seconds += time.time() - start
+        # 成员以优先级开头，超时放回时据此恢复分数；同一优先级内按时间的字典序出队
+        member = u'{0}:{1:013d}:{2}'.format(item.priority, int(time.time() * 1000), uuid.uuid4().hex)
+        pending, processing, payloads = self.__keys(self.key)
+        data = item.dumps()
+
+        def func(r):
+            pipe = r.pipeline()
+            pipe.hset(payloads, member, data)
+            pipe.zadd(pending, {member: item.priority})
+            pipe.execute()
+        self.__execute(func)
+        self.__size += 1
+        self.__puts += 1
+
+    def __fetch(self, count):
+        """
+        取出待处理的消息
+        :param count: 最多取出的数量
+        :return: 队列元素列表
+        """
+        keys = self.__keys(self.key)
+        deadline = time.time() + REDIS_QUEUE_CONFIG[u'visibility_timeout']
+        reply = self.__execute(lambda r: self.__script(r, _FETCH_SCRIPT)(keys=keys, args=[count, deadline], client=r))
+        items = list()
+        for i in range(0, len(reply), 2):
+            receipt = u'{0}\t{1}'.format(self.key, reply[i])
+            if not reply[i + 1]:
+                RedisPriorityQueue.acknowledge(receipt)
+                continue
+            try:
+                item = QueueEnvelope.loads(reply[i + 1])
+            except Exception as e:
+                logging.exception(u'invalid {0} queue item({1})! - {2}'.format(self.name, reply[i], e.message))
+                RedisPriorityQueue.acknowledge(receipt)
+                continue
+            item.receipt = receipt
+            items.append(item)
+        RedisPriorityQueue.__hold([item.receipt for item in items])
+        return items
+
+    @classmethod
+    def __hold(cls, receipts):
+        """
+        记录本进程持有的消息，首次取出消息时开始定期延长可见性超时
+        :param receipts: 投递回执列表
+        :return: 无
+        """
+        now = time.time()
+        for receipt in receipts:
+            cls.__leases[receipt] = now
+        if cls.__heartbeat is None and REDIS_QUEUE_CONFIG[u'heartbeat_interval']:
+            cls.__heartbeat = gevent.spawn(cls.__heartbeat_loop)
+
+    @classmethod
+    def extend_leases(cls):
+        """
+        延长本进程持有的消息的可见性超时，已被确认或放回待处理集合的消息不受影响
+        :return: 延长的数量
+        """
+        now = time.time()
+        deadline = now + REDIS_QUEUE_CONFIG[u'visibility_timeout']
+        grouped = dict()
+        for receipt, leased in list(cls.__leases.items()):
+            if now - leased >= REDIS_QUEUE_CONFIG[u'max_lease']:
+                cls.__leases.pop(receipt, None)
+                logging.warning(u'stop extending the queue item({0}) held for {1:.0f}s.'.format(receipt, now - leased))
+                continue
+            key, member = receipt.split(u'\t', 1)
+            grouped.setdefault(cls.__keys(key)[1], dict())[member] = deadline
+        if not grouped:
+            return 0
+
+        def func(r):
+            pipe = r.pipeline(transaction=False)
+            for processing, mapping in grouped.items():
+                pipe.zadd(processing, mapping, xx=True)
+            pipe.execute()
+        cls.__execute(func)
+        return sum(len(mapping) for mapping in grouped.values())
+
+    @classmethod
+    def __heartbeat_loop(cls):
+        while 1:
+            gevent.sleep(REDIS_QUEUE_CONFIG[u'heartbeat_interval'])
+            try:
+                cls.extend_leases()
+            except Exception as e:
+                logging.exception(u'extend queue leases error! - {0}'.format(e.message))
+
+    def __fetch_loop(self):
+        """
+        预取消息到本地缓冲区，缓冲区中的消息被取走后继续预取
+        :return: 无
+        """
+        prefetch = max(1, REDIS_QUEUE_CONFIG[u'prefetch'])
+        while not self.__stopping:
+            try:
+                count = prefetch - self.__buffer.qsize()
+                if count <= 0:
+                    self.__demand.clear()
+                    self.__demand.wait(REDIS_QUEUE_CONFIG[u'poll_interval'])
+                    continue
+                items = self.__fetch(count)
+                if not items:
+                    gevent.sleep(REDIS_QUEUE_CONFIG[u'poll_interval'])
+                    continue
+                for item in items:
+                    self.__buffer.put(item)
+            except Exception as e:
+                logging.exception(u'fetch {0} queue error! - {1}'.format(self.name, e.message))
+                gevent.sleep(3)
+
+    def reclaim(self, limit=1000):
+        """
+        将超时未确认的消息放回待处理集合，任意一台机器执行即可
+        :param limit: 单次最多放回的数量
+        :return: 放回的数量
+        """
+        keys = self.__keys(self.key)
+        count = self.__execute(
+            lambda r: self.__script(r, _RECLAIM_SCRIPT)(keys=keys, args=[time.time(), limit], client=r))
+        if count:
+            self.__reclaimed += count
+            logging.warning(u'{0} unacknowledged items of {1} queue timed out and were requeued.'.format(
+                count, self.name))
+        return count
+
+    def __reclaim_loop(self):
+        while 1:
+            gevent.sleep(REDIS_QUEUE_CONFIG[u'reclaim_interval'])
+            try:
+                self.reclaim()
+            except Exception as e:
+                logging.exception(u'reclaim {0} queue error! - {1}'.format(self.name, e.message))
+
+    def get(self, block=True, timeout=None):
+        """
+        取出优先级最高的元素，首次调用时开始预取
+        :param block: 是否阻塞
+        :param timeout: 最长阻塞时间（秒）
+        :return: 队列元素
+        """
+        if not self.__tasks and not self.__stopping:
+            self.__tasks.append(gevent.spawn(self.__fetch_loop))
+            if REDIS_QUEUE_CONFIG[u'reclaim_interval']:
+                self.__tasks.append(gevent.spawn(self.__reclaim_loop))
+        item = self.__buffer.get(block, timeout)
+        self.__demand.set()
+        if not item.is_stop:
+            self.__gets += 1
+        return item
+
+    @classmethod
+    def acknowledge(cls, receipt):
+        """
+        确认消息已处理完成，重复确认没有影响
+        :param receipt: 投递回执
+        :return: 无
+        """
+        key, member = receipt.split(u'\t', 1)
+        pending, processing, payloads = cls.__keys(key)
+
+        def func(r):
+            pipe = r.pipeline()
+            pipe.zrem(processing, member)
+            pipe.hdel(payloads, member)
+            pipe.execute()
+        cls.__execute(func)
+        cls.__leases.pop(receipt, None)
+
+    def close(self):
+        """
+        停止预取，并将本地缓冲区中未处理的消息立即放回待处理集合
+        :return: 无
+        """
+        self.__stopping = True
+        gevent.killall(self.__tasks)
+        del self.__tasks[:]
+        members = list()
+        while not self.__buffer.empty():
+            item = self.__buffer.get()
+            if item.receipt:
+                RedisPriorityQueue.__leases.pop(item.receipt, None)
+                members.append((item.priority, item.receipt.split(u'\t', 1)[1]))
+        if not members:
+            return
+        pending, processing, payloads = self.__keys(self.key)
+
+        def func(r):
+            pipe = r.pipeline()
+            for priority, member in members:
+                pipe.zrem(processing, member)
+                pipe.zadd(pending, {member: priority})
+            pipe.execute()
+        self.__execute(func)
+        logging.info(u'returned {0} prefetched items to {1} queue.'.format(len(members), self.name))
+
+    def qsize(self):
+        return self.__pending_size() + self.__buffer.qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def metrics(self):
+        """
+        队列水位统计
+        :return: 统计结果
+        """
+        size = self.__pending_size(refresh=True)
+        return {
+            u'name': self.name,
+            u'size': size,
+            u'capacity': self.capacity,
+            u'fill': round(float(size) / self.capacity, 4),
+            u'peak': self.__peak,
+            u'puts': self.__puts,
+            u'gets': self.__gets,
+            u'prefetched': self.__buffer.qsize(),
+            u'reclaimed': self.__reclaimed,
+            u'blocked_puts': self.__blocked_puts,
+            u'blocked_seconds': round(self.__blocked_seconds, 3),
+            u'plugins': dict(),
+            u'paused_plugins': list()
+        }
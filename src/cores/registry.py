@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from src.utils import tools
+
+
+class ConfigRegistry(object):
+    """插件配置注册表，每个配置只计算一次插件ID、只保存一份，队列中只传递插件ID"""
+
+    __configs = dict()
+    __mutex = threading.Lock()
+
+    @classmethod
+    def register(cls, config):
+        """
+        登记插件配置，同一个配置对象只计算一次插件ID
+        :param config: 插件配置
+        :return: 插件ID
+        """
+        plugin_id = tools.build_plugin_id(config, memo=True)
+        if plugin_id not in cls.__configs:
+            with cls.__mutex:
+                cls.__configs.setdefault(plugin_id, config)
+        return plugin_id
+
+    @classmethod
+    def get(cls, plugin_id):
+        """
+        根据插件ID获取插件配置
+        :param plugin_id: 插件ID
+        :return: 插件配置
+        """
+        return cls.__configs[plugin_id]
+
+    @classmethod
+    def plugin_ids(cls):
+        """
+        已登记的插件ID列表
+        :return: 插件ID列表
+        """
+        return list(cls.__configs.keys())
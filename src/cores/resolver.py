@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+import gevent
+from gevent.event import AsyncResult
+
+from src.cores.services.mongodb_client import MongodbService
+from src.utils.cache import TTLCache
+
+
+class EntityEidResolver(object):
+    """
+    企业eid查询器：查询结果缓存在容量有限且会过期的LRU缓存中，查不到的企业缓存较短的时间；
+    并发查询同一企业时只查询一次，同一轮事件循环中各协程查询的企业合并为一次$in查询
+    """
+
+    def __init__(self, schema=u'gs', table=u'entities', max_size=100000, ttl=3600, negative_ttl=300,
+                 max_batch=100, linger=0):
+        """
+        初始化
+        :param schema: 企业库的模式名
+        :param table: 企业库的表名
+        :param max_size: 最大缓存数量
+        :param ttl: 查询到的eid的缓存时间（秒）
+        :param negative_ttl: 查不到的企业的缓存时间（秒）
+        :param max_batch: 单次查询的最大企业数
+        :param linger: 合并查询前等待的时间（秒），为0时只合并同一轮事件循环中的查询
+        """
+        self.schema = schema
+        self.table = table
+        self.negative_ttl = negative_ttl
+        self.max_batch = max(1, max_batch)
+        self.linger = linger
+        self.__cache = TTLCache(max_size, ttl)
+        self.__waiting = dict()
+        self.__pending = list()
+        self.__flusher = None
+
+    @staticmethod
+    def normalize(name):
+        """
+        企业库中的企业名使用全角括号
+        :param name: 企业名
+        :return: 转换后的企业名
+        """
+        return name.replace(u'(', u'（').replace(u')', u'）')
+
+    def __submit(self, name):
+        """
+        提交查询，已有相同企业的查询时共用其结果
+        :param name: 转换后的企业名
+        :return: 查询结果
+        """
+        result = self.__waiting.get(name)
+        if result is None:
+            result = self.__waiting[name] = AsyncResult()
+            self.__pending.append(name)
+            if self.__flusher is None:
+                # 当前协程让出后执行，此前其他协程提交的查询会合并到同一批
+                self.__flusher = gevent.spawn_later(self.linger, self.__flush)
+        return result
+
+    def __flush(self):
+        """
+        执行所有待执行的查询
+        :return: 无
+        """
+        try:
+            while self.__pending:
+                batch, self.__pending = self.__pending[:self.max_batch], self.__pending[self.max_batch:]
+                self.__query(batch)
+        finally:
+            self.__flusher = None
+
+    def __query(self, batch):
+        """
+        使用一次$in查询一批企业，并将结果分发给各协程。查询出错时返回空eid且不缓存
+        :param batch: 转换后的企业名列表
+        :return: 无
+        """
+        names = set(batch)
+        found = dict()
+        resp_text = None
+        try:
+            # 同名企业可能有多条记录，不限制返回数量
+            resp_text = MongodbService.find(self.schema, self.table, {u'name': {u'$in': batch}}, 0, [u'name', u'eid'])
+            if resp_text is None:
+                raise IOError(u'no response')
+            for record in json.loads(resp_text) or []:
+                if record.get(u'name') in names and record.get(u'eid'):
+                    found.setdefault(record[u'name'], record[u'eid'])
+        except Exception as e:
+            logging.exception(u'Failed to query eid of {0} entities! - {1} - {2}'.format(
+                len(batch), e.message, resp_text))
+            for name in batch:
+                self.__waiting.pop(name).set(u'')
+            return
+        for name in batch:
+            eid = found.get(name, u'')
+            self.__cache.put(name, eid, None if eid else self.negative_ttl)
+            self.__waiting.pop(name).set(eid)
+
+    def resolve_many(self, names):
+        """
+        批量查询企业eid
+        :param names: 企业名列表
+        :return: {企业名: 企业eid}，查不到的企业为空字符串
+        """
+        results = dict()
+        waiting = dict()
+        for name in names:
+            if name in results or name in waiting:
+                continue
+            if not name:
+                results[name] = u''
+                continue
+            key = self.normalize(name)
+            eid = self.__cache.get(key)
+            if eid is None:
+                waiting[name] = self.__submit(key)
+            else:
+                results[name] = eid
+        for name, result in waiting.items():
+            results[name] = result.get()
+        return results
+
+    def resolve(self, name):
+        """
+        查询企业eid
+        :param name: 企业名
+        :return: 企业eid，查不到时为空字符串
+        """
+        return self.resolve_many([name])[name]
+
+    def clear(self):
+        """
+        清空缓存
+        :return: 无
+        """
+        self.__cache.clear()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import codecs
+import csv
+import io
+import logging
+
+# 读取文件时的缓冲区大小
+BUFFER_SIZE = 1024 * 1024
+
+
+class _LineReader(object):
+    """按行读取二进制文件，并记录已读取的字节偏移量"""
+
+    def __init__(self, f, offset):
+        self.f = f
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line
+
+    __next__ = next
+
+
+def __open(filename, offset, buffer_size):
+    """
+    打开文件并定位到指定的字节偏移量，从文件开头读取时跳过UTF-8 BOM
+    :param filename: 文件名
+    :param offset: 字节偏移量
+    :param buffer_size: 缓冲区大小
+    :return: 文件对象 | 按行读取对象
+    """
+    f = io.open(filename, u'rb', buffering=buffer_size)
+    if offset:
+        f.seek(offset)
+    elif f.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8:
+        offset = len(codecs.BOM_UTF8)
+    else:
+        f.seek(0)
+    return f, _LineReader(f, offset)
+
+
+def iter_rows(filename, encoding=u'UTF-8', offset=0, delimiter=u',', buffer_size=BUFFER_SIZE):
+    """
+    流式读取csv文件，正确处理引号、转义和字段内的换行。编码需要兼容ASCII，如UTF-8、GBK
+    :param filename: 文件名
+    :param encoding: 文件编码
+    :param offset: 开始读取的字节偏移量，必须位于行首
+    :param delimiter: 分隔符
+    :param buffer_size: 缓冲区大小
+    :return: (字段列表, 该行结束处的字节偏移量)生成器，空行被跳过
+    """
+    f, lines = __open(filename, offset, buffer_size)
+    with f:
+        for row in csv.reader(lines, delimiter=str(delimiter)):
+            if row:
+                yield [value.decode(encoding) for value in row], lines.offset
+
+
+def read_header(filename, encoding=u'UTF-8', delimiter=u','):
+    """
+    读取csv文件的表头
+    :param filename: 文件名
+    :param encoding: 文件编码
+    :param delimiter: 分隔符
+    :return: 表头字段列表 | 表头结束处的字节偏移量
+    """
+    for row, offset in iter_rows(filename, encoding, delimiter=delimiter, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        return [value.strip() for value in row], offset
+    return [], 0
+
+
+def line_offset(filename, line_count):
+    """
+    计算前若干行结束处的字节偏移量，用于将按行数记录的旧进度转换为字节偏移量
+    :param filename: 文件名
+    :param line_count: 行数
+    :return: 字节偏移量
+    """
+    offset = 0
+    with io.open(filename, u'rb', buffering=BUFFER_SIZE) as f:
+        for i, line in enumerate(f):
+            if i >= line_count:
+                break
+            offset += len(line)
+    logging.debug(u'the first {0} lines of {1} end at byte {2}.'.format(line_count, filename, offset))
+    return offset
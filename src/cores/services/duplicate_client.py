@@ -1,15 +1,72 @@
 # -*- coding: utf-8 -*-
-from src.config import FLASK_SERVICE_CONFIG, ENVIRONMENT
+import atexit
+import json
+import logging
+import os
 
+from gevent.pool import Pool
+
+from src.config import FLASK_SERVICE_CONFIG, ENVIRONMENT, DEDUP_CACHE_CONFIG
+from src.cores.batcher import BatchWriter
 from src.cores.services import http_client
+from src.utils.bloom import BloomFilter
+from src.utils.cache import TTLCache
 
+# 各数据类型的本地布隆过滤器
+_FILTERS = dict()
 
-def check_exist(type_name, key):
+# 已加入查重池、尚未写入查重服务的数据，{(数据类型, 关键字): 缓冲次数}，写入完成前在本进程中视为已存在
+_PENDING = dict()
+
+# 查重服务确认不存在的结果，短时间内不再重复查询
+_NEGATIVE_CACHE = TTLCache(DEDUP_CACHE_CONFIG[u'negative_max_size'], DEDUP_CACHE_CONFIG[u'negative_ttl'])
+
+
+def __filter(type_name):
     """
-    检查数据是否重复
+    获取数据类型对应的布隆过滤器，首次使用时打开或创建文件
+    :param type_name: 数据类型
+    :return: 布隆过滤器
+    """
+    bloom = _FILTERS.get(type_name)
+    if bloom is None:
+        if not _FILTERS:
+            atexit.register(close)
+        bloom = _FILTERS[type_name] = BloomFilter(
+            os.path.join(DEDUP_CACHE_CONFIG[u'path'], type_name),
+            DEDUP_CACHE_CONFIG[u'capacity'], DEDUP_CACHE_CONFIG[u'error_rate'])
+    return bloom
+
+
+def __parse_exist(resp):
+    """
+    解析查重服务的返回结果
+    :param resp: 响应正文
+    :return: 是否存在，无法解析时为None
+    """
+    if resp is None:
+        return None
+    try:
+        result = json.loads(resp)
+    except ValueError:
+        result = resp.strip().strip(u'"').lower()
+        return True if result == u'true' else False if result == u'false' else u'true' in result
+    if isinstance(result, dict):
+        for key in [u'data', u'result', u'exist', u'exists']:
+            if key in result:
+                result = result[key]
+                break
+    if isinstance(result, bool):
+        return result
+    return u'true' in json.dumps(result).lower()
+
+
+def __check_remote(type_name, key):
+    """
+    向查重服务查询数据是否重复
     :param type_name: 数据类型
     :param key: 关键字
-    :return: 检查结果
+    :return: 检查结果，查询失败时为None
     """
     url = u'http://{0}:{1}/api/SpiderDuplicate/check'.format(
         FLASK_SERVICE_CONFIG[ENVIRONMENT][u'host'], FLASK_SERVICE_CONFIG[ENVIRONMENT][u'port'])
@@ -17,13 +74,12 @@ def check_exist(type_name, key):
         u'type': type_name,
         u'key': key
     }
-    resp = (http_client.do_http_get(url, params=params))[0]
-    return True if u'true' in resp else False
+    return __parse_exist((http_client.do_http_get(url, params=params))[0])
 
 
-def put(type_name, key):
+def __put_remote(type_name, key):
     """
-    将数据加入查重池
+    将数据加入查重服务
     :param type_name: 数据类型
     :param key: 关键字
     :return: 添加结果
@@ -35,3 +91,128 @@ def put(type_name, key):
         u'key': key
     }
     return (http_client.do_http_post(url, data=data))[0]
+
+
+def _flush_puts(type_name, keys):
+    """
+    将缓冲的数据并发写入查重服务，写入成功后才加入本地布隆过滤器；
+    写入失败的数据不加入，之后的检查仍会查询查重服务，避免本地认为已存在而其他机器查不到
+    :param type_name: 数据类型
+    :param keys: 关键字列表
+    :return: 每个关键字是否写入成功
+    """
+    pool = Pool(DEDUP_CACHE_CONFIG[u'concurrency'])
+    results = pool.map(lambda key: __put_remote(type_name, key), keys)
+    bloom = __filter(type_name)
+    written = list()
+    for key, result in zip(keys, results):
+        count = _PENDING.pop((type_name, key), 1) - 1
+        if count > 0:
+            _PENDING[(type_name, key)] = count
+        if result is None:
+            logging.error(u'Failed to put duplicate key({0}) - {1}'.format(type_name, key))
+        else:
+            bloom.add(key)
+        written.append(result is not None)
+    logging.debug(u'Finished putting {0} duplicate keys({1}), {2} failed.'.format(
+        len(keys), type_name, written.count(False)))
+    return written
+
+
+# 查重服务的批量写入器，按数据类型分组
+_WRITER = BatchWriter(u'duplicate writer', _flush_puts, **DEDUP_CACHE_CONFIG[u'writer'])
+
+
+def check_exist_many(type_name, keys):
+    """
+    批量检查数据是否重复：本地布隆过滤器中已存在或正在写入查重服务的直接返回，近期确认不存在的不再查询，
+    其余并发查询查重服务
+    :param type_name: 数据类型
+    :param keys: 关键字列表
+    :return: {关键字: 检查结果}
+    """
+    bloom = __filter(type_name)
+    result = dict()
+    remote = list()
+    for key in keys:
+        if key in result:
+            continue
+        if key in bloom or (type_name, key) in _PENDING:
+            result[key] = True
+        elif (type_name, key) in _NEGATIVE_CACHE:
+            result[key] = False
+        else:
+            result[key] = None
+            remote.append(key)
+    if remote:
+        pool = Pool(DEDUP_CACHE_CONFIG[u'concurrency'])
+        for key, exists in zip(remote, pool.map(lambda k: __check_remote(type_name, k), remote)):
+            if exists:
+                bloom.add(key)
+            elif exists is False:
+                _NEGATIVE_CACHE.put((type_name, key), True)
+            else:
+                logging.warning(u'Failed to check duplicate key({0}) - {1}'.format(type_name, key))
+            result[key] = bool(exists)
+    return result
+
+
+def check_exist(type_name, key):
+    """
+    检查数据是否重复
+    :param type_name: 数据类型
+    :param key: 关键字
+    :return: 检查结果
+    """
+    return check_exist_many(type_name, [key])[key]
+
+
+def put_many(type_name, keys):
+    """
+    批量将数据加入查重池：查重服务异步批量写入，写入成功后加入本地布隆过滤器，写入完成前在本进程中视为已存在
+    :param type_name: 数据类型
+    :param keys: 关键字列表
+    :return: 无
+    """
+    for key in keys:
+        _PENDING[(type_name, key)] = _PENDING.get((type_name, key), 0) + 1
+        _NEGATIVE_CACHE.pop((type_name, key))
+        _WRITER.put(type_name, key, len(key))
+
+
+def put(type_name, key):
+    """
+    将数据加入查重池，查重服务异步写入
+    :param type_name: 数据类型
+    :param key: 关键字
+    :return: 添加结果
+    """
+    put_many(type_name, [key])
+    return True
+
+
+def warm(type_name, keys):
+    """
+    预热本地布隆过滤器，从查重服务导出的已有数据中加载，只写入本地，见warm_dedup_cache.py
+    :param type_name: 数据类型
+    :param keys: 关键字迭代器
+    :return: 加载的数量
+    """
+    bloom = __filter(type_name)
+    count = 0
+    for key in keys:
+        bloom.add(key)
+        count += 1
+    bloom.flush()
+    logging.info(u'Warmed duplicate filter({0}) with {1} keys.'.format(type_name, count))
+    return count
+
+
+def close():
+    """
+    写出缓冲的数据并关闭本地布隆过滤器
+    :return: 无
+    """
+    _WRITER.flush()
+    for type_name in list(_FILTERS.keys()):
+        _FILTERS.pop(type_name).close()
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
+import openpyxl
 import xlrd
 # import xlwt
+import datetime
 import logging
+import os
+
+# 使用openpyxl流式读取的文件类型，其余使用xlrd按需加载sheet
+OPENPYXL_EXTENSIONS = (u'.xlsx', u'.xlsm')
 
 
 def read_excel(filename):
@@ -58,3 +64,108 @@ def read_sheet_col_by_index(sheet, index):
     :return: 列数据
     """
     return sheet.col_values(index)
+
+
+def __select_sheets(all_names, sheets):
+    """
+    选择需要读取的sheet
+    :param all_names: 文件中所有sheet名
+    :param sheets: None-第一个sheet；u'*'-所有sheet；列表-指定的sheet名或索引
+    :return: sheet名列表
+    """
+    if not all_names:
+        return list()
+    if sheets is None:
+        return all_names[:1]
+    if sheets == u'*':
+        return list(all_names)
+    selected = list()
+    for sheet in sheets:
+        name = all_names[sheet] if isinstance(sheet, int) and sheet < len(all_names) else sheet
+        if name in all_names:
+            selected.append(name)
+        else:
+            logging.warning(u'sheet {0} not found! - {1}'.format(sheet, all_names))
+    return selected
+
+
+def __cell_value(value):
+    """
+    转换xlsx单元格的值：空单元格转换为空字符串，日期和时间转换为字符串，以便消息可以序列化
+    :param value: 单元格的值
+    :return: 转换后的值
+    """
+    if value is None:
+        return u''
+    if isinstance(value, datetime.datetime):
+        return value.strftime(u'%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.date):
+        return value.strftime(u'%Y-%m-%d')
+    if isinstance(value, (datetime.time, datetime.timedelta)):
+        return unicode(value)
+    return value
+
+
+def iter_rows(filename, sheets=None, marks=None):
+    """
+    流式读取excel文件，同一时间只加载一个sheet，xlsx文件逐行解析，内存占用与文件大小无关。
+    从进度恢复时只是不再返回进度之前的行：xlsx文件仍会从头解析这些行，xls文件仍会加载整个sheet
+    :param filename: 文件名
+    :param sheets: None-第一个sheet；u'*'-所有sheet；列表-指定的sheet名或索引
+    :param marks: 各sheet已经读取到的行索引{sheet名或sheet索引: 行索引}，小于等于该索引的行被跳过，为-1时跳过整个sheet
+    :return: (sheet名, 行索引, 行数据)生成器，空单元格为空字符串，xlsx中的日期为字符串
+    """
+    marks = marks or dict()
+    if os.path.splitext(filename)[1].lower() in OPENPYXL_EXTENSIONS:
+        workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            for name in __select_sheets(workbook.sheetnames, sheets):
+                mark = marks.get(name, marks.get(workbook.sheetnames.index(name), 0))
+                if mark == -1:
+                    continue
+                # openpyxl的行号从1开始
+                rows = workbook[name].iter_rows(min_row=mark + 2, values_only=True)
+                for index, row in enumerate(rows, mark + 1):
+                    yield name, index, [__cell_value(value) for value in row]
+        finally:
+            workbook.close()
+    else:
+        workbook = xlrd.open_workbook(filename, on_demand=True)
+        try:
+            for name in __select_sheets(workbook.sheet_names(), sheets):
+                mark = marks.get(name, marks.get(workbook.sheet_names().index(name), 0))
+                if mark == -1:
+                    continue
+                sheet = workbook.sheet_by_name(name)
+                for index in range(mark + 1, sheet.nrows):
+                    yield name, index, sheet.row_values(index)
+                workbook.unload_sheet(name)
+        finally:
+            workbook.release_resources()
+
+
+def sheet_rows(filename, sheets=None):
+    """
+    获取需要读取的各sheet的行数，用于估算读取进度
+    :param filename: 文件名
+    :param sheets: None-第一个sheet；u'*'-所有sheet；列表-指定的sheet名或索引
+    :return: [(sheet名, 行数)]，xlsx文件没有记录行数时行数为None
+    """
+    result = list()
+    if os.path.splitext(filename)[1].lower() in OPENPYXL_EXTENSIONS:
+        workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            for name in __select_sheets(workbook.sheetnames, sheets):
+                # 只读模式下行数来自文件中记录的表格范围，不需要遍历数据
+                result.append((name, workbook[name].max_row))
+        finally:
+            workbook.close()
+    else:
+        workbook = xlrd.open_workbook(filename, on_demand=True)
+        try:
+            for name in __select_sheets(workbook.sheet_names(), sheets):
+                result.append((name, workbook.sheet_by_name(name).nrows))
+                workbook.unload_sheet(name)
+        finally:
+            workbook.release_resources()
+    return result
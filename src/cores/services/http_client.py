@@ -1,16 +1,30 @@
 # -*- coding: utf-8 -*-
 import base64
+import collections
+import contextlib
 import logging
 import random
+import sys
+import threading
+import time
 
 import cchardet
 import copy
 import gevent
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import *
 
+from src.config import HTTP_POOL_CONFIG
 from src.utils import tools
 
+if sys.version_info < (3, 4):
+    from cookielib import DefaultCookiePolicy
+    from urlparse import urlparse
+else:
+    from http.cookiejar import DefaultCookiePolicy
+    from urllib.parse import urlparse
+
 _BROWSER_HEADERS = [
     u'Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:54.0) Gecko/20100101 Firefox/54.0',
     (u'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.90 '
@@ -32,6 +46,150 @@ _BROWSER_HEADERS = [
 ]
 
 
+class _BlockAllCookiePolicy(DefaultCookiePolicy):
+    """禁止session自身保存cookie，cookie仍由调用方通过cookies参数显式传递"""
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class _SessionEntry(object):
+    """session池中的单个条目"""
+
+    __slots__ = (u'session', u'active', u'last_used')
+
+    def __init__(self, session):
+        self.session = session
+        self.active = 0
+        self.last_used = time.time()
+
+
+class HttpSessionPool(object):
+    """按host和代理复用的keep-alive session池，可在多个greenlet之间共享"""
+
+    __sessions = collections.OrderedDict()
+    __mutex = threading.Lock()
+    __last_sweep = time.time()
+
+    @staticmethod
+    def __build_key(url, proxies):
+        """
+        构造session的键，同一host、同一代理共享一个session
+        :param url: 链接
+        :param proxies: 代理
+        :return: session键
+        """
+        parts = urlparse(url)
+        scheme = parts.scheme.lower()
+        proxy = None
+        if isinstance(proxies, dict):
+            proxy = proxies.get(scheme) or proxies.get(u'all')
+        return scheme, parts.netloc.lower(), proxy
+
+    @staticmethod
+    def __create_session():
+        """
+        创建带连接池的session
+        :return: session
+        """
+        session = requests.Session()
+        session.cookies.set_policy(_BlockAllCookiePolicy())
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_CONFIG[u'pool_connections'],
+            pool_maxsize=HTTP_POOL_CONFIG[u'pool_maxsize'],
+            pool_block=HTTP_POOL_CONFIG[u'pool_block']
+        )
+        session.mount(u'http://', adapter)
+        session.mount(u'https://', adapter)
+        return session
+
+    @classmethod
+    def __sweep(cls):
+        """
+        回收空闲超时的session，并将session数量控制在上限以内
+        :return: 无
+        """
+        now = time.time()
+        if now - cls.__last_sweep < HTTP_POOL_CONFIG[u'sweep_interval'] and \
+                len(cls.__sessions) <= HTTP_POOL_CONFIG[u'max_sessions']:
+            return
+        expired = []
+        with cls.__mutex:
+            cls.__last_sweep = now
+            overflow = len(cls.__sessions) - HTTP_POOL_CONFIG[u'max_sessions']
+            # OrderedDict按最近使用排序，越靠前越久未使用
+            for key in list(cls.__sessions.keys()):
+                entry = cls.__sessions[key]
+                if entry.active > 0:
+                    continue
+                if overflow > 0 or now - entry.last_used > HTTP_POOL_CONFIG[u'idle_timeout']:
+                    expired.append(cls.__sessions.pop(key))
+                    overflow -= 1
+        for entry in expired:
+            try:
+                entry.session.close()
+            except Exception as e:
+                logging.exception(u'failed to close idle session! - {0}'.format(e.message))
+        if expired:
+            logging.debug(u'{0} idle http sessions have been closed.'.format(len(expired)))
+
+    @classmethod
+    @contextlib.contextmanager
+    def session(cls, url, proxies=None):
+        """
+        获取指定host和代理对应的session
+        :param url: 链接
+        :param proxies: 代理
+        :return: session
+        """
+        key = cls.__build_key(url, proxies)
+        with cls.__mutex:
+            entry = cls.__sessions.pop(key, None)
+            if entry is None:
+                entry = _SessionEntry(cls.__create_session())
+            cls.__sessions[key] = entry
+            entry.active += 1
+            entry.last_used = time.time()
+        try:
+            yield entry.session
+        finally:
+            with cls.__mutex:
+                entry.active -= 1
+                entry.last_used = time.time()
+            cls.__sweep()
+
+    @classmethod
+    def request(cls, method, url, proxies=None, **kwargs):
+        """
+        使用池中的session发送请求
+        :param method: 请求方法
+        :param url: 链接
+        :param proxies: 代理
+        :param kwargs: 其他请求参数
+        :return: 响应
+        """
+        with cls.session(url, proxies) as session:
+            return session.request(method, url, proxies=proxies, **kwargs)
+
+    @classmethod
+    def close_all(cls):
+        """
+        关闭所有session
+        :return: 无
+        """
+        with cls.__mutex:
+            entries = list(cls.__sessions.values())
+            cls.__sessions.clear()
+        for entry in entries:
+            try:
+                entry.session.close()
+            except Exception as e:
+                logging.exception(u'failed to close session! - {0}'.format(e.message))
+
+
 def do_http_get(url, params=None, headers=None, timeout=20, cookies=None, proxies=False, encoding=None,
                 allow_status=None, err_retry=3, allow_redirects=False):
     """
@@ -64,8 +222,9 @@ def do_http_get(url, params=None, headers=None, timeout=20, cookies=None, proxie
     resp = None
     while err_count < err_retry:
         try:
-            resp = requests.get(
-                url=url,
+            resp = HttpSessionPool.request(
+                u'GET',
+                url,
                 params=params,
                 headers=headers,
                 timeout=timeout,
@@ -137,8 +296,9 @@ def do_http_post(url, data=None, be_json=False, headers=None, timeout=20, cookie
     while err_count < err_retry:
         try:
             if be_json:
-                resp = requests.post(
-                    url=url,
+                resp = HttpSessionPool.request(
+                    u'POST',
+                    url,
                     json=data,
                     headers=headers,
                     timeout=timeout,
@@ -148,8 +308,9 @@ def do_http_post(url, data=None, be_json=False, headers=None, timeout=20, cookie
                     verify=False
                 )
             else:
-                resp = requests.post(
-                    url=url,
+                resp = HttpSessionPool.request(
+                    u'POST',
+                    url,
                     data=data,
                     headers=headers,
                     timeout=timeout,
@@ -220,8 +381,9 @@ def download(url, params=None, path=None, headers=None, timeout=20, cookies=None
     resp = None
     while err_count < err_retry:
         try:
-            resp = requests.get(
-                url=url,
+            resp = HttpSessionPool.request(
+                u'GET',
+                url,
                 params=params,
                 headers=headers,
                 timeout=timeout,
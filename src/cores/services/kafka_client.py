@@ -2,7 +2,8 @@
 import json
 import logging
 
-from src.config import KAFKA_CONFIG, ENVIRONMENT, FLASK_SERVICE_CONFIG
+from src.config import KAFKA_CONFIG, ENVIRONMENT, FLASK_SERVICE_CONFIG, KAFKA_PRODUCER_CONFIG
+from src.cores.batcher import BatchWriter
 from src.cores.customer import CustomerJsonEncoder
 from src.cores.services import http_client
 
@@ -22,6 +23,35 @@ def poll(topic, group_id):
     return (http_client.do_http_get(url, params=params))[0]
 
 
+def poll_batch(topic, group_id, max_records=100, max_wait=5):
+    """
+    从kafka队列中批量获取消息，队列为空时服务端最多等待max_wait秒（长轮询）
+    :param topic: kafka的topic
+    :param group_id: 对应topic的指定group_id
+    :param max_records: 单次获取的最大消息数量
+    :param max_wait: 最长等待时间（秒）
+    :return: 消息数据列表
+    """
+    url = u'http://{0}:{1}/kafka/poll_batch'.format(
+        KAFKA_CONFIG[ENVIRONMENT][u'host'], KAFKA_CONFIG[ENVIRONMENT][u'port'])
+    params = {
+        u'topic_name': topic,
+        u'group_id': group_id,
+        u'max_records': max_records,
+        u'max_wait': max_wait
+    }
+    records = []
+    resp_text = (http_client.do_http_get(url, params=params, timeout=max_wait + 20))[0]
+    if resp_text:
+        try:
+            records = json.loads(resp_text)
+        except Exception as e:
+            logging.exception(u'Invalid kafka batch - {0}|{1}'.format(resp_text, e.message))
+        if not isinstance(records, list):
+            records = [records]
+    return records
+
+
 def offer(topic, data):
     """
     向kafka队列发送一条消息
@@ -41,6 +71,66 @@ def offer(topic, data):
     return (http_client.do_http_post(url, data=data))[0]
 
 
+def offer_batch(topic, data_list):
+    """
+    向kafka队列批量发送消息
+    :param topic: kafka的topic
+    :param data_list: 需要发送的消息字符串列表
+    :return: 操作结果
+    """
+    url = u'http://{0}:{1}/kafka/offer_batch'.format(
+        KAFKA_CONFIG[ENVIRONMENT][u'host'], KAFKA_CONFIG[ENVIRONMENT][u'port'])
+    data = {
+        u'topic_names': topic,
+        u'data_list': json.dumps(data_list, ensure_ascii=False)
+    }
+    return (http_client.do_http_post(url, data=data))[0]
+
+
+def _flush_offer_batch(topic, data_list):
+    """
+    批量发送缓冲的消息，批量发送失败时逐条补发
+    :param topic: kafka的topic
+    :param data_list: 消息字符串列表
+    :return: 每条消息是否发送成功
+    """
+    if offer_batch(topic, data_list) is not None:
+        return [True] * len(data_list)
+    logging.error(u'Failed to offer {0} records to kafka({1}) in batch, retry one by one.'.format(
+        len(data_list), topic))
+    results = list()
+    for data_str in data_list:
+        results.append(offer(topic, data_str) is not None)
+        if not results[-1]:
+            logging.error(u'Lost kafka record({0}) - {1}'.format(topic, data_str))
+    return results
+
+
+_producer = BatchWriter(u'kafka producer', _flush_offer_batch, **KAFKA_PRODUCER_CONFIG)
+
+
+def offer_buffered(topic, data):
+    """
+    将消息放入发送缓冲，按数量、字节数或等待时间批量发送到kafka队列
+    :param topic: kafka的topic
+    :param data: 需要发送的消息
+    :return: 发送结果，消息发送后get()返回是否发送成功
+    """
+    if isinstance(data, (dict, list, tuple, set)):
+        data_str = json.dumps(data, ensure_ascii=False, cls=CustomerJsonEncoder)
+    else:
+        data_str = str(data)
+    return _producer.put(topic, data_str, len(data_str))
+
+
+def flush():
+    """
+    立即发送缓冲中的所有消息
+    :return: 无
+    """
+    _producer.flush()
+
+
 def llen(topic, group=None):
     """
     获取kafka队列的长度
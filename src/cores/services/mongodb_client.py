@@ -111,13 +111,14 @@ class MongodbClient(object):
         return update_result
 
     @classmethod
-    def find(cls, schema, table, query_dict, limit=None):
+    def find(cls, schema, table, query_dict, limit=None, projection=None):
         """
         查询符合条件的多条数据。若limit不赋值，则返回所有符合条件的数据
         :param schema: 模式名
         :param table: 表名
         :param query_dict: 查询语句
         :param limit: 最大返回数量
+        :param projection: 返回的字段，数组['field1', 'field2']，_id总是返回；为None时返回所有字段
         :return: 查询结果
         """
         db = cls.__get_table(schema, table)
@@ -129,9 +130,9 @@ class MongodbClient(object):
             raise CollectionInvalid(u'[mongodb]not a dict!')
 
         if limit:
-            results = db.find(query_dict, sort=[(u'_id', pymongo.ASCENDING)], limit=limit)
+            results = db.find(query_dict, projection, sort=[(u'_id', pymongo.ASCENDING)], limit=limit)
         else:
-            results = db.find(query_dict, sort=[(u'_id', pymongo.ASCENDING)])
+            results = db.find(query_dict, projection, sort=[(u'_id', pymongo.ASCENDING)])
         return results
 
     @classmethod
@@ -1,59 +1,268 @@
 # -*- coding: utf-8 -*-
-import sys
-
-from src.config import MYSQL_CONFIG, ENVIRONMENT
-
-if sys.version_info < (3, 4):
-    import thread
-else:
-    import _thread as thread
-import pymysql
+import contextlib
 import copy
 import json
+import logging
+import re
+import time
+
+import gevent
+import pymysql
+import pymysql.cursors
+from gevent.lock import BoundedSemaphore
 
+from src.config import MYSQL_CONFIG, MYSQL_POOL_CONFIG, ENVIRONMENT
 from src.cores.services import http_client
 
+# 连接失效类错误：服务端断开、连接丢失、连接状态错乱
+_CONNECTION_ERRORS = (2006, 2013, 2014, 2045, 2055)
+
+# 暂时性的错误，重试即可恢复：连接数过多、锁等待超时、死锁、无法连接服务端
+_TRANSIENT_ERRORS = (1040, 1205, 1213, 2003)
+
+# 合法的字段名和表名，防止通过配置或数据注入SQL
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_$]*(\.[A-Za-z_][A-Za-z0-9_$]*)?$')
+
+# 配置中的查询表达式不允许包含多条语句和注释
+_FORBIDDEN_SQL = re.compile(r';|--|#|/\*')
+
+
+class _PooledConnection(object):
+    """连接池中的连接"""
+
+    def __init__(self, connection, generation):
+        self.connection = connection
+        self.generation = generation
+        self.created = time.time()
+        self.last_used = self.created
+
+
+class _ConnectionPool(object):
+    """单个schema的有界连接池，连接在使用期间由一个协程独占"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.__slots = BoundedSemaphore(MYSQL_POOL_CONFIG[u'max_size'])
+        self.__idle = list()
+        self.__generation = 0
+
+    def __connect(self):
+        """
+        建立新连接
+        :return: 连接
+        """
+        config = MYSQL_CONFIG[self.schema]
+        client = pymysql.connect(
+            host=config[u'host'],
+            user=config[u'user'],
+            password=config[u'password'],
+            db=config[u'db'],
+            port=config[u'port'],
+            charset=config[u'charset'],
+            connect_timeout=MYSQL_POOL_CONFIG[u'connect_timeout']
+        )
+        return _PooledConnection(client, self.__generation)
+
+    @staticmethod
+    def __discard(entry):
+        try:
+            entry.connection.close()
+        except Exception:
+            pass
+
+    def __is_healthy(self, entry):
+        """
+        检查空闲连接是否可用：超过最长存活时间的连接被关闭，空闲较久的连接先ping
+        :param entry: 连接
+        :return: 检查结果
+        """
+        now = time.time()
+        if entry.generation != self.__generation or now - entry.created > MYSQL_POOL_CONFIG[u'max_lifetime']:
+            return False
+        if now - entry.last_used > MYSQL_POOL_CONFIG[u'ping_interval']:
+            try:
+                entry.connection.ping(reconnect=False)
+            except Exception as e:
+                logging.warning(u'discard broken mysql connection({0})! - {1}'.format(self.schema, e))
+                return False
+        return True
+
+    def acquire(self):
+        """
+        取出一个可用的连接，连接数达到上限时等待其他协程归还
+        :return: 连接
+        """
+        if not self.__slots.acquire(timeout=MYSQL_POOL_CONFIG[u'checkout_timeout']):
+            raise IOError(u'Timed out waiting for a mysql connection - {0}'.format(self.schema))
+        try:
+            while self.__idle:
+                # 优先使用最近归还的连接
+                entry = self.__idle.pop()
+                if self.__is_healthy(entry):
+                    return entry
+                self.__discard(entry)
+            return self.__connect()
+        except BaseException:
+            self.__slots.release()
+            raise
+
+    def release(self, entry, broken=False):
+        """
+        归还连接
+        :param entry: 连接
+        :param broken: 连接是否已失效
+        :return: 无
+        """
+        try:
+            expired = time.time() - entry.created > MYSQL_POOL_CONFIG[u'max_lifetime']
+            if broken or expired or entry.generation != self.__generation or not entry.connection.open:
+                self.__discard(entry)
+            else:
+                entry.last_used = time.time()
+                self.__idle.append(entry)
+        finally:
+            self.__slots.release()
+
+    def close(self):
+        """
+        关闭所有空闲连接，正在使用的连接在归还时关闭
+        :return: 无
+        """
+        self.__generation += 1
+        idle, self.__idle = self.__idle, list()
+        for entry in idle:
+            self.__discard(entry)
+
 
 class MySQLClient(object):
-    """初步封装的MySQL相关方法类"""
+    """初步封装的MySQL相关方法类，每个schema使用一个有界连接池"""
 
     __CONNECTION_POOL = dict()
-    __mutex = thread.allocate_lock()
 
     @staticmethod
-    def __init_instance(schema):
+    def __get_pool(schema):
         """
-        init instance
+        get pool
         :param schema:
         :return:
         """
-        if schema not in MySQLClient.__CONNECTION_POOL.keys():
-            MySQLClient.__mutex.acquire()
-            config = MYSQL_CONFIG[schema]
-            client = pymysql.connect(
-                host=config[u'host'],
-                user=config[u'user'],
-                password=config[u'password'],
-                db=config[u'db'],
-                port=config[u'port'],
-                charset=config[u'charset']
-            )
-            if client.cursor():
-                MySQLClient.__CONNECTION_POOL[schema] = client
-            else:
-                raise Exception(u"Failed to connect to mysql - {0}".format(config[u'host']))
-            MySQLClient.__mutex.release()
-        return
+        pool = MySQLClient.__CONNECTION_POOL.get(schema)
+        if pool is None:
+            if schema not in MYSQL_CONFIG:
+                raise Exception(u"Unknown mysql schema - {0}".format(schema))
+            pool = MySQLClient.__CONNECTION_POOL[schema] = _ConnectionPool(schema)
+        return pool
 
     @staticmethod
-    def __get_client(schema):
+    def check_identifier(name):
         """
-        get client
+        检查字段名或表名是否合法
+        :param name: 字段名或表名
+        :return: 字段名或表名
+        """
+        if not _IDENTIFIER.match(name):
+            raise ValueError(u'Invalid mysql identifier! - {0}'.format(name))
+        return name
+
+    @staticmethod
+    def check_expression(expression):
+        """
+        检查插件配置中的查询字段或表名，可以是表达式，如DATE(created) AS day、`order`、a JOIN b ON a.id=b.aid。
+        配置中的内容原样写入语句，只拒绝多条语句和注释；语句使用参数化查询，其中的%转义为%%
+        :param expression: 查询字段或表名
+        :return: 转义后的内容
+        """
+        if not expression or _FORBIDDEN_SQL.search(expression):
+            raise ValueError(u'Invalid mysql expression! - {0}'.format(expression))
+        return expression.replace(u'%', u'%%')
+
+    @staticmethod
+    def build_insert_sql(table, columns, update_columns=None, rows=None):
+        """
+        构造INSERT语句，指定更新字段时为INSERT ... ON DUPLICATE KEY UPDATE
+        :param table: 表名
+        :param columns: 字段列表
+        :param update_columns: 主键或唯一索引冲突时更新的字段，为None时不更新
+        :param rows: 行数。为None时构造单行的位置参数语句，由executemany展开为多行；
+                     否则构造多行的命名参数语句，第i行第j个字段的参数名为vi_j
+        :return: 语句
+        """
+        names = u','.join(MySQLClient.check_identifier(column) for column in columns)
+        if rows is None:
+            values = u'({0})'.format(u','.join([u'%s'] * len(columns)))
+        else:
+            values = u','.join(
+                u'({0})'.format(u','.join(u'%(v{0}_{1})s'.format(i, j) for j in range(len(columns))))
+                for i in range(rows))
+        sql = u'INSERT INTO {0} ({1}) VALUES {2}'.format(MySQLClient.check_identifier(table), names, values)
+        if update_columns:
+            sql += u' ON DUPLICATE KEY UPDATE {0}'.format(u','.join(
+                u'{0}=VALUES({0})'.format(MySQLClient.check_identifier(column)) for column in update_columns))
+        return sql
+
+    @staticmethod
+    def is_connection_error(e):
+        """
+        判断异常是否由连接失效引起
+        :param e: 异常
+        :return: 判断结果
+        """
+        if isinstance(e, pymysql.err.InterfaceError):
+            return True
+        return isinstance(e, pymysql.err.OperationalError) and bool(e.args) and e.args[0] in _CONNECTION_ERRORS
+
+    @staticmethod
+    def is_transient_error(e):
+        """
+        判断异常是否是暂时性的，如连接失效、服务不可用、取连接超时、锁冲突，与数据本身无关，重试即可恢复
+        :param e: 异常
+        :return: 判断结果
+        """
+        if MySQLClient.is_connection_error(e) or isinstance(e, IOError):
+            return True
+        return isinstance(e, pymysql.err.OperationalError) and bool(e.args) and e.args[0] in _TRANSIENT_ERRORS
+
+    @staticmethod
+    @contextlib.contextmanager
+    def connection(schema):
+        """
+        从连接池取出一个连接，使用完毕后自动归还；出现异常时回滚，连接失效时关闭
         :param schema:
-        :return:
+        :return: 连接
+        """
+        pool = MySQLClient.__get_pool(schema)
+        entry = pool.acquire()
+        broken = False
+        try:
+            yield entry.connection
+        except BaseException as e:
+            broken = MySQLClient.is_connection_error(e) or isinstance(e, gevent.GreenletExit)
+            if not broken:
+                try:
+                    entry.connection.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            pool.release(entry, broken)
+
+    @staticmethod
+    def __run(schema, func, retry):
+        """
+        使用池中的连接执行操作，连接失效时换一个连接重试
+        :param schema:
+        :param func: 操作函数，调用方式为func(连接)
+        :param retry: 是否允许重试，写操作只在未提交前允许重试
+        :return: 操作结果
         """
-        MySQLClient.__init_instance(schema)
-        return MySQLClient.__CONNECTION_POOL.get(schema)
+        for i in range(MYSQL_POOL_CONFIG[u'retries'] + 1):
+            try:
+                with MySQLClient.connection(schema) as client:
+                    return func(client)
+            except Exception as e:
+                if not retry or i >= MYSQL_POOL_CONFIG[u'retries'] or not MySQLClient.is_connection_error(e):
+                    raise
+                logging.warning(u'mysql connection({0}) lost, retrying! - {1}'.format(schema, e))
 
     @staticmethod
     def execute(schema, db_query, params=()):
@@ -64,13 +273,11 @@ class MySQLClient(object):
         :param params:
         :return:
         """
-        client = MySQLClient.__get_client(schema)
-        if client:
-            cursor = client.cursor()
-            cursor.execute(db_query, params)
+        def func(client):
+            with client.cursor() as cursor:
+                cursor.execute(db_query, params)
             client.commit()
-            cursor.close()
-        return
+        return MySQLClient.__run(schema, func, False)
 
     @staticmethod
     def execute_many(schema, db_query, params):
@@ -81,13 +288,11 @@ class MySQLClient(object):
         :param params:
         :return:
         """
-        client = MySQLClient.__get_client(schema)
-        if client:
-            cursor = client.cursor()
-            cursor.executemany(db_query, params)
+        def func(client):
+            with client.cursor() as cursor:
+                cursor.executemany(db_query, params)
             client.commit()
-            cursor.close()
-        return
+        return MySQLClient.__run(schema, func, False)
 
     @staticmethod
     def find_one(schema, db_query, params=()):
@@ -98,14 +303,11 @@ class MySQLClient(object):
         :param params:
         :return:
         """
-        result = None
-        client = MySQLClient.__get_client(schema)
-        if client:
-            cursor = client.cursor()
-            cursor.execute(db_query, params)
-            result = cursor.fetchone()
-            cursor.close()
-        return result
+        def func(client):
+            with client.cursor() as cursor:
+                cursor.execute(db_query, params)
+                return cursor.fetchone()
+        return MySQLClient.__run(schema, func, True)
 
     @staticmethod
     def find(schema, db_query, params=()):
@@ -116,14 +318,34 @@ class MySQLClient(object):
         :param params:
         :return:
         """
-        result_list = list()
-        client = MySQLClient.__get_client(schema)
-        if client:
-            cursor = client.cursor()
-            cursor.execute(db_query, params)
-            result_list = cursor.fetchall()
-            cursor.close()
-        return result_list
+        def func(client):
+            with client.cursor() as cursor:
+                cursor.execute(db_query, params)
+                return cursor.fetchall()
+        return MySQLClient.__run(schema, func, True)
+
+    @staticmethod
+    def iter_find(schema, db_query, params=(), size=1000):
+        """
+        使用流式游标查询，数据逐批从服务端读取，不在客户端缓存整个结果集。读取期间独占一个连接
+        :param schema:
+        :param db_query:
+        :param params:
+        :param size: 每批读取的数量
+        :return: 数据生成器
+        """
+        with MySQLClient.connection(schema) as client:
+            cursor = client.cursor(pymysql.cursors.SSCursor)
+            try:
+                cursor.execute(db_query, params)
+                while 1:
+                    rows = cursor.fetchmany(size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
 
     @staticmethod
     def reconnect(schema):
@@ -133,7 +355,6 @@ class MySQLClient(object):
         :return:
         """
         MySQLClient.close(schema)
-        MySQLClient.__init_instance(schema)
         return
 
     @staticmethod
@@ -143,10 +364,9 @@ class MySQLClient(object):
         :param schema:
         :return:
         """
-        client = MySQLClient.__get_client(schema)
-        if client:
-            client.close()
-            MySQLClient.__CONNECTION_POOL.__delitem__(schema)
+        pool = MySQLClient.__CONNECTION_POOL.get(schema)
+        if pool:
+            pool.close()
         return
 
     @staticmethod
@@ -8,33 +8,93 @@ from src.cores.customer import CustomerJsonEncoder
 from src.cores.services import http_client
 
 
-def ots_service_put_row(instance_name, table_name, pk, data_json):
+def _strip_pk_columns(pk, data_json):
     """
-    上传OTS数据
-    :param instance_name:
-    :param table_name:
+    移除数据列中与主键重复的列
     :param pk: [{"dataid":"1111"}, {"dataid": "2222"}]
     :param data_json: {"col1": "1111", "col2": "222"}
-    :return:
+    :return: 移除主键列之后的数据列
     """
-    url = u'http://{0}:{1}/ots/put_row?_=0'.format(OTS_CONFIG[ENVIRONMENT][u'host'], OTS_CONFIG[ENVIRONMENT][u'port'])
-    # 检查data_json
     new_data_json = copy.copy(data_json)
     for i in pk:
-        pk_key = i.keys()[0]
+        pk_key = list(i.keys())[0]
         if pk_key in new_data_json.keys():
             new_data_json.pop(pk_key, None)
             logging.warning(
                 u"data json including PK column - " + pk_key + u", will remove it from data json automatically.")
+    return new_data_json
+
+
+def ots_service_put_row(instance_name, table_name, pk, data_json):
+    """
+    上传OTS数据
+    :param instance_name:
+    :param table_name:
+    :param pk: [{"dataid":"1111"}, {"dataid": "2222"}]
+    :param data_json: {"col1": "1111", "col2": "222"}
+    :return:
+    """
+    url = u'http://{0}:{1}/ots/put_row?_=0'.format(OTS_CONFIG[ENVIRONMENT][u'host'], OTS_CONFIG[ENVIRONMENT][u'port'])
     req_data = {
         u"instance_name": instance_name,
         u"tablename": table_name,
         u"pk": json.dumps(pk, ensure_ascii=False, cls=CustomerJsonEncoder),
-        u"columns": json.dumps(new_data_json, ensure_ascii=False, cls=CustomerJsonEncoder)
+        u"columns": json.dumps(_strip_pk_columns(pk, data_json), ensure_ascii=False, cls=CustomerJsonEncoder)
     }
     return (http_client.do_http_post(url, data=req_data))[0]
 
 
+def build_batch_row(pk, data_json):
+    """
+    将单行数据序列化为批量写入使用的格式
+    :param pk: [{"dataid":"1111"}, {"dataid": "2222"}]
+    :param data_json: {"col1": "1111", "col2": "222"}
+    :return: 序列化后的单行数据
+    """
+    return json.dumps(
+        {u'pk': pk, u'columns': _strip_pk_columns(pk, data_json)}, ensure_ascii=False, cls=CustomerJsonEncoder)
+
+
+def ots_service_batch_write_row(instance_name, table_name, rows):
+    """
+    批量上传OTS数据
+    :param instance_name:
+    :param table_name:
+    :param rows: [(pk, data_json), ...]，也可以是build_batch_row序列化后的单行数据
+    :return: 每一行的写入结果 [(是否成功, 错误信息), ...]，响应中缺少的行视为写入失败
+    """
+    url = u'http://{0}:{1}/ots/batch_write_row?_=0'.format(
+        OTS_CONFIG[ENVIRONMENT][u'host'], OTS_CONFIG[ENVIRONMENT][u'port'])
+    row_list = [build_batch_row(*row) if isinstance(row, (tuple, list)) else row for row in rows]
+    req_data = {
+        u"instance_name": instance_name,
+        u"tablename": table_name,
+        u"rows": u'[{0}]'.format(u','.join(row_list))
+    }
+    resp_text = (http_client.do_http_post(url, data=req_data))[0]
+    if resp_text is None:
+        return [(False, u'request failed')] * len(row_list)
+    try:
+        resp_json = json.loads(resp_text)
+    except Exception as e:
+        logging.exception(u'Invalid OTS batch response - {0}|{1}'.format(resp_text, e.message))
+        return [(False, u'invalid response')] * len(row_list)
+    if not isinstance(resp_json, list):
+        logging.error(u'Unexpected OTS batch response - {0}'.format(resp_text))
+        return [(False, u'unexpected response')] * len(row_list)
+    results = []
+    for i in range(len(row_list)):
+        if i >= len(resp_json):
+            results.append((False, u'missing from response'))
+            continue
+        item = resp_json[i]
+        if isinstance(item, dict) and not item.get(u'is_ok', True):
+            results.append((False, item.get(u'error_message') or item.get(u'error_code')))
+        else:
+            results.append((True, None))
+    return results
+
+
 def ots_service_get_row(instance_name, table_name, pk, columns):
     """
     获取OTS 数据
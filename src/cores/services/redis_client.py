@@ -1,44 +1,85 @@
 # _*_ coding: utf-8 _*_
+import contextlib
 import copy
 import logging
 import threading
 
 import datetime
+import gevent
 import redis as redis
+from gevent.event import AsyncResult
 
-from src.config import REDIS_CONFIG, ENVIRONMENT
+from src.config import REDIS_CONFIG, REDIS_POOL_CONFIG, ENVIRONMENT
+
+# 单条命令携带的最大元素数量，避免单条命令过大阻塞服务端
+_CHUNK_SIZE = 1000
+
+# 连接池中的连接全部被占用且等待超时时redis-py抛出的ConnectionError的信息
+_POOL_EXHAUSTED_MESSAGE = u'No connection available.'
+
+# 原子地取出列表头部的多个元素
+_LPOP_MANY_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+end
+return items
+"""
 
 
 class RedisClient(object):
     """
     Redis Client
+    每个schema和index对应一个有界的阻塞连接池，命令执行期间才占用连接，各协程之间不需要加锁
     """
     __redis_pool = {}
     __redis_client = {}
+    __failures = {}
+    __generations = {}
+    __batchers = {}
+    __scripts = {}
     __mutex = threading.Lock()
 
+    @staticmethod
+    def __pool_key(schema, redis_index):
+        """
+        连接池的键
+        :param schema: 指定的schema
+        :param redis_index: 指定的index，为None时使用配置中的index
+        :return: 键 | index
+        """
+        if redis_index is None:
+            redis_index = REDIS_CONFIG[ENVIRONMENT][schema].get(u'index') or 0
+        return u'{0}{1}'.format(schema, redis_index), redis_index
+
     @classmethod
     def __init_instance(cls, schema, redis_index):
         """
         初始化连接实例
         :param schema: 指定的schema
         :param redis_index: 指定的index
-        :return: 无
-        """
-        schema = u'{0}{1}'.format(schema, redis_index)
-        if schema not in cls.__redis_pool.keys():
-            cls.__mutex.acquire()
-            if schema not in cls.__redis_pool.keys():
-                cls.__redis_pool[schema] = redis.ConnectionPool(
-                    host=REDIS_CONFIG[ENVIRONMENT][schema][u'host'],
-                    port=REDIS_CONFIG[ENVIRONMENT][schema][u'port'],
-                    db=redis_index,
-                    password=REDIS_CONFIG[ENVIRONMENT][schema][u'auth'],
-                    encoding=REDIS_CONFIG[ENVIRONMENT][schema][u'encoding'],
-                    max_connections=1
-                )
-                cls.__redis_client[schema] = redis.Redis(connection_pool=cls.__redis_pool[schema])
-            cls.__mutex.release()
+        :return: 连接池的键
+        """
+        key, redis_index = cls.__pool_key(schema, redis_index)
+        if key not in cls.__redis_client:
+            with cls.__mutex:
+                if key not in cls.__redis_client:
+                    config = REDIS_CONFIG[ENVIRONMENT][schema]
+                    cls.__redis_pool[key] = redis.BlockingConnectionPool(
+                        host=config[u'host'],
+                        port=config[u'port'],
+                        db=redis_index,
+                        password=config[u'auth'] or None,
+                        encoding=config[u'encoding'] or u'utf-8',
+                        max_connections=REDIS_POOL_CONFIG[u'max_connections'],
+                        timeout=REDIS_POOL_CONFIG[u'timeout'],
+                        socket_timeout=REDIS_POOL_CONFIG[u'socket_timeout'],
+                        socket_connect_timeout=REDIS_POOL_CONFIG[u'socket_connect_timeout'],
+                        socket_keepalive=True,
+                        health_check_interval=REDIS_POOL_CONFIG[u'health_check_interval']
+                    )
+                    cls.__redis_client[key] = redis.Redis(connection_pool=cls.__redis_pool[key])
+        return key
 
     @classmethod
     def __get_client(cls, schema, redis_index):
@@ -48,33 +89,122 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: redis连接实例
         """
-        cls.__init_instance(schema, redis_index)
-        schema = u'{0}{1}'.format(schema, redis_index)
-        return cls.__redis_client[schema]
+        return cls.__redis_client[cls.__init_instance(schema, redis_index)]
+
+    @classmethod
+    def __generation(cls, schema, redis_index):
+        """
+        获取连接池当前的代数，每次重置连接池后加一
+        :param schema: 指定的schema
+        :param redis_index: 指定的index
+        :return: 代数
+        """
+        return cls.__generations.get(cls.__pool_key(schema, redis_index)[0], 0)
+
+    @staticmethod
+    def is_pool_exhausted(e):
+        """
+        判断异常是否是连接池中的连接全部被占用导致的，此时连接本身是正常的，不需要重置连接池
+        :param e: 异常
+        :return: 判断结果
+        """
+        return isinstance(e, redis.ConnectionError) and bool(e.args) and e.args[0] == _POOL_EXHAUSTED_MESSAGE
+
+    @classmethod
+    def __backoff(cls, schema, redis_index, generation, e):
+        """
+        连接出错后按连续失败次数指数退避，然后重置出错时使用的连接池
+        :param schema: 指定的schema
+        :param redis_index: 指定的index
+        :param generation: 出错时连接池的代数
+        :param e: 异常
+        :return: 无
+        """
+        key = cls.__pool_key(schema, redis_index)[0]
+        failures = cls.__failures[key] = cls.__failures.get(key, 0) + 1
+        delay = min(REDIS_POOL_CONFIG[u'max_backoff'], REDIS_POOL_CONFIG[u'backoff'] * 2 ** (failures - 1))
+        logging.warning(u'redis({0}) connection error, reconnecting in {1:.1f}s! - {2}'.format(key, delay, e))
+        gevent.sleep(delay)
+        cls.reconnect(schema, redis_index, generation)
+
+    @classmethod
+    @contextlib.contextmanager
+    def client(cls, schema, redis_index=None):
+        """
+        获取redis连接实例，用于执行本类未封装的命令；出现连接错误时重置连接池后抛出，连接池耗尽时直接抛出
+        :param schema: 指定的schema
+        :param redis_index: 指定的index
+        :return: redis连接实例
+        """
+        generation = cls.__generation(schema, redis_index)
+        try:
+            yield cls.__get_client(schema, redis_index)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            if not cls.is_pool_exhausted(e):
+                cls.reconnect(schema, redis_index, generation)
+            raise
+
+    @classmethod
+    def execute(cls, schema, redis_index, func):
+        """
+        执行redis操作，连接出错时退避后重连重试，连接池耗尽时直接重试，直到成功；其他错误直接抛出
+        :param schema: 指定的schema
+        :param redis_index: 指定的index
+        :param func: 操作函数，调用方式为func(redis连接实例)
+        :return: 操作结果
+        """
+        while 1:
+            generation = cls.__generation(schema, redis_index)
+            try:
+                result = func(cls.__get_client(schema, redis_index))
+                cls.__failures.pop(cls.__pool_key(schema, redis_index)[0], None)
+                return result
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                if cls.is_pool_exhausted(e):
+                    # 取连接时已等待了连接池的超时时间，连接本身正常，重置连接池只会中断其他协程正在执行的命令
+                    logging.warning(u'redis({0}) connection pool exhausted, retrying! - {1}'.format(
+                        cls.__pool_key(schema, redis_index)[0], e))
+                    continue
+                cls.__backoff(schema, redis_index, generation, e)
+
+    @classmethod
+    def batcher(cls, schema, redis_index=None):
+        """
+        获取自动批量执行器，各协程同时提交的命令合并为一次往返
+        :param schema: 指定的schema
+        :param redis_index: 指定的index
+        :return: 自动批量执行器
+        """
+        key = cls.__pool_key(schema, redis_index)[0]
+        if key not in cls.__batchers:
+            with cls.__mutex:
+                if key not in cls.__batchers:
+                    cls.__batchers[key] = RedisAutoBatcher(schema, redis_index)
+        return cls.__batchers[key]
+
+    @classmethod
+    def __script(cls, r, source):
+        """
+        注册Lua脚本，执行时使用EVALSHA，脚本不存在时自动重新加载
+        :param r: redis连接实例
+        :param source: 脚本内容
+        :return: 脚本对象
+        """
+        script = cls.__scripts.get(source)
+        if script is None:
+            script = cls.__scripts[source] = r.register_script(source)
+        return script
 
     @classmethod
     def list_keys(cls, schema, keys_pattern, redis_index):
         """
-        列出当前的redis连接key列表
+        列出当前的redis连接key列表，使用SCAN逐批遍历，不阻塞服务端
         :param schema: 指定的schema
         :param keys_pattern: 正则
         :param redis_index: 指定的index
         :return: key列表
         """
-        while 1:
-            try:
-                key_list = []
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                temp_key_list = r.keys(keys_pattern)
-                for temp_key in temp_key_list:
-                    key_list.append(temp_key)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
-        return key_list
+        return cls.execute(schema, redis_index, lambda r: list(r.scan_iter(keys_pattern, _CHUNK_SIZE)))
 
     @classmethod
     def lpop(cls, schema, key, size, redis_index):
@@ -86,26 +216,22 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 获取的结果列表
         """
-        while 1:
-            pop_items = []
-            try:
-                i = 0
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                pipe = r.pipeline()
-                while i < size:
-                    pipe.lpop(key)
-                    i += 1
-                temp_pop_items = pipe.execute()
-                for temp_item in temp_pop_items:
-                    if temp_item is not None:
-                        pop_items.append(temp_item)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
-        return pop_items
+        return cls.lpop_many(schema, key, size, redis_index)
+
+    @classmethod
+    def lpop_many(cls, schema, key, size, redis_index=None):
+        """
+        一次往返原子地取出列表头部的多个元素
+        :param schema: 指定的schema
+        :param key: key名
+        :param size: 最多取出的个数
+        :param redis_index: 指定的index
+        :return: 获取的结果列表
+        """
+        if size <= 0:
+            return []
+        return cls.execute(
+            schema, redis_index, lambda r: cls.__script(r, _LPOP_MANY_SCRIPT)(keys=[key], args=[size], client=r))
 
     @classmethod
     def rpush(cls, schema, key, json_text, redis_index):
@@ -117,16 +243,7 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 无
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                r.rpush(key, json_text)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
+        cls.execute(schema, redis_index, lambda r: r.rpush(key, json_text))
 
     @classmethod
     def lpush(cls, schema, key, json_text, redis_index):
@@ -138,16 +255,7 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 无
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                r.lpush(key, json_text)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
+        cls.execute(schema, redis_index, lambda r: r.lpush(key, json_text))
 
     @classmethod
     def rpush_list(cls, schema, key, json_text_array, redis_index):
@@ -159,34 +267,37 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 无
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                pipe = r.pipeline()
-                for json_text in json_text_array:
-                    pipe.rpush(key, json_text)
-                pipe.execute()
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
+        values = list(json_text_array)
+        if not values:
+            return
+
+        def func(r):
+            # 每条RPUSH携带多个值，整批在一次往返中发送
+            pipe = r.pipeline(transaction=False)
+            for i in range(0, len(values), _CHUNK_SIZE):
+                pipe.rpush(key, *values[i:i + _CHUNK_SIZE])
+            pipe.execute()
+        cls.execute(schema, redis_index, func)
 
     @classmethod
-    def reconnect(cls, schema, redis_index):
+    def reconnect(cls, schema, redis_index, generation=None):
         """
         重置连接
         :param schema: 指定的schema
         :param redis_index: 指定的index
+        :param generation: 出错时连接池的代数，连接池已被其他协程重置过时不再重置；为None时总是重置
         :return: 无
         """
-        keys = copy.deepcopy(list(cls.__redis_pool.keys()))
-        if schema in keys:
+        key = cls.__pool_key(schema, redis_index)[0]
+        with cls.__mutex:
+            if generation is not None and cls.__generations.get(key, 0) != generation:
+                return
+            cls.__generations[key] = cls.__generations.get(key, 0) + 1
+            pool = cls.__redis_pool.pop(key, None)
+            cls.__redis_client.pop(key, None)
+        if pool is not None:
             try:
-                cls.__redis_pool[schema].disconnect()
-                cls.__redis_pool.pop(schema)
-                cls.__redis_client.pop(schema)
+                pool.disconnect()
             except Exception as e:
                 logging.exception(e)
         cls.__init_instance(schema, redis_index)
@@ -200,17 +311,7 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 长度
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                length = r.llen(key)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
-        return length
+        return cls.execute(schema, redis_index, lambda r: r.llen(key))
 
     @classmethod
     def hash_set(cls, schema, hash_key, field, json_text, redis_index, expired_in=-1):
@@ -224,21 +325,14 @@ class RedisClient(object):
         :param expired_in: ttl
         :return: 无
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                pipe = r.pipeline()
-                pipe.hset(hash_key, field, json_text)
-                if expired_in != -1:
-                    temp_expire = datetime.timedelta(days=0, seconds=expired_in)
-                    pipe.expire(hash_key, temp_expire)
-                pipe.execute()
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
+        def func(r):
+            pipe = r.pipeline()
+            pipe.hset(hash_key, field, json_text)
+            if expired_in != -1:
+                temp_expire = datetime.timedelta(days=0, seconds=expired_in)
+                pipe.expire(hash_key, temp_expire)
+            pipe.execute()
+        cls.execute(schema, redis_index, func)
 
     @classmethod
     def hash_get(cls, schema, hash_key, field, redis_index):
@@ -250,17 +344,22 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 获取到的结果
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                result = r.hget(hash_key, field)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
-        return result
+        return cls.execute(schema, redis_index, lambda r: r.hget(hash_key, field))
+
+    @classmethod
+    def hash_mget(cls, schema, hash_key, fields, redis_index=None):
+        """
+        一次获取hash对象的多个字段
+        :param schema: 指定的schema
+        :param hash_key: hash key
+        :param fields: 字段列表
+        :param redis_index: 指定的index
+        :return: 与字段列表一一对应的结果列表，字段不存在时为None
+        """
+        fields = list(fields)
+        if not fields:
+            return []
+        return cls.execute(schema, redis_index, lambda r: r.hmget(hash_key, fields))
 
     @classmethod
     def delete(cls, schema, key, redis_index=None):
@@ -271,16 +370,7 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 无
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                r.delete(key)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
+        cls.execute(schema, redis_index, lambda r: r.delete(key))
 
     @classmethod
     def exists(cls, schema, key, redis_index=None):
@@ -291,17 +381,27 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 是否存在
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                status = r.exists(key)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
-        return status
+        return cls.execute(schema, redis_index, lambda r: r.exists(key))
+
+    @classmethod
+    def exists_many(cls, schema, keys, redis_index=None):
+        """
+        一次往返判断多个key是否存在
+        :param schema: 指定的schema
+        :param keys: key列表
+        :param redis_index: 指定的index
+        :return: 与key列表一一对应的判断结果列表
+        """
+        keys = list(keys)
+        if not keys:
+            return []
+
+        def func(r):
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                pipe.exists(key)
+            return [bool(status) for status in pipe.execute()]
+        return cls.execute(schema, redis_index, func)
 
     @classmethod
     def hash_increment_by(cls, schema, hash_key, field, redis_index, amount=1):
@@ -309,21 +409,12 @@ class RedisClient(object):
         hash步进
         :param schema: 指定的schema
         :param hash_key: hash key
-        :param field: 
+        :param field:
         :param redis_index: 指定的index
         :param amount: 步长
-        :return: 
+        :return:
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                r.hincrby(hash_key, field, amount)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
-                cls.reconnect(schema, redis_index)
+        cls.execute(schema, redis_index, lambda r: r.hincrby(hash_key, field, amount))
 
     @classmethod
     def expire_valid_time(cls, schema, key, seconds, redis_index=None):
@@ -335,15 +426,7 @@ class RedisClient(object):
         :param redis_index: 指定的index
         :return: 无
         """
-        while 1:
-            try:
-                r = cls.__get_client(schema, redis_index)
-                cls.__mutex.acquire()
-                r.expire(key, seconds)
-                cls.__mutex.release()
-                break
-            except Exception as e:
-                logging.exception(e)
+        cls.execute(schema, redis_index, lambda r: r.expire(key, seconds))
 
     @classmethod
     def close(cls):
@@ -351,11 +434,99 @@ class RedisClient(object):
         关闭所有的redis连接
         :return: 无
         """
-        keys = copy.deepcopy(list(cls.__redis_pool.keys()))
-        for schema in keys:
+        with cls.__mutex:
+            pools = copy.copy(cls.__redis_pool)
+            cls.__redis_pool.clear()
+            cls.__redis_client.clear()
+        for key in pools:
             try:
-                cls.__redis_pool[schema].disconnect()
-                cls.__redis_pool.pop(schema)
-                cls.__redis_client.pop(schema)
+                pools[key].disconnect()
             except Exception as e:
                 logging.exception(e)
+
+
+class RedisAutoBatcher(object):
+    """
+    redis自动批量执行器：同一轮事件循环中各协程提交的命令合并为一个pipeline执行，
+    每个协程只等待自己命令的结果，调用方式与逐条执行相同
+    """
+
+    def __init__(self, schema, redis_index=None, max_batch=_CHUNK_SIZE):
+        """
+        初始化
+        :param schema: 指定的schema
+        :param redis_index: 指定的index
+        :param max_batch: 单个pipeline的最大命令数
+        """
+        self.schema = schema
+        self.redis_index = redis_index
+        self.max_batch = max(1, max_batch)
+        self.__pending = list()
+        self.__flusher = None
+
+    def call(self, command, *args):
+        """
+        提交一条命令并等待结果
+        :param command: 命令名，如GET、EXISTS、SISMEMBER
+        :param args: 命令参数
+        :return: 命令结果，命令出错时抛出异常
+        """
+        result = AsyncResult()
+        self.__pending.append((command, args, result))
+        if self.__flusher is None:
+            # 当前协程让出后执行，此前其他协程提交的命令会合并到同一批
+            self.__flusher = gevent.spawn(self.__flush)
+        return result.get()
+
+    def __flush(self):
+        """
+        执行所有待执行的命令
+        :return: 无
+        """
+        try:
+            while self.__pending:
+                batch, self.__pending = self.__pending[:self.max_batch], self.__pending[self.max_batch:]
+                self.__execute(batch)
+        finally:
+            self.__flusher = None
+
+    def __execute(self, batch):
+        """
+        使用一个pipeline执行一批命令，并将结果分发给各协程
+        :param batch: [(命令名, 参数, 结果)]
+        :return: 无
+        """
+        def func(r):
+            pipe = r.pipeline(transaction=False)
+            for command, args, result in batch:
+                pipe.execute_command(command, *args)
+            return pipe.execute(raise_on_error=False)
+        try:
+            replies = RedisClient.execute(self.schema, self.redis_index, func)
+        except Exception as e:
+            for command, args, result in batch:
+                result.set_exception(e)
+            return
+        for (command, args, result), reply in zip(batch, replies):
+            if isinstance(reply, Exception):
+                result.set_exception(reply)
+            else:
+                result.set(reply)
+
+    def get(self, key):
+        return self.call(u'GET', key)
+
+    def exists(self, key):
+        return bool(self.call(u'EXISTS', key))
+
+    def hget(self, hash_key, field):
+        return self.call(u'HGET', hash_key, field)
+
+    def sismember(self, key, member):
+        return bool(self.call(u'SISMEMBER', key, member))
+
+    def sadd(self, key, *members):
+        return self.call(u'SADD', key, *members)
+
+    def rpush(self, key, *values):
+        return self.call(u'RPUSH', key, *values)
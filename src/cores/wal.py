@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import atexit
+import io
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import gevent
+
+from src.config import WAL_CONFIG
+from src.cores.customer import CustomerJsonEncoder
+from src.utils.cache import LRUCache
+
+
+class MessageJournal(object):
+    """
+    消息预写日志，替代逐条消息的缓存文件。消息发送到队列前追加一条put记录，处理完成后追加一条ack记录，
+    日志按大小分段，已封存的分段定期压缩，只保留未确认的消息；启动时顺序扫描上次运行的日志恢复未确认的消息。
+    日志文件名为 {运行ID}-{日志名}.{分段序号}.log，多进程模式下每个worker写各自的日志，由一个worker负责压缩。
+    每条记录一行，字段以制表符分隔：put\t标识\t插件ID\t消息JSON 或 ack\t标识，扫描时不需要解析消息内容
+    """
+
+    __run_id = None
+    __name = None
+    __file = None
+    __segment = 0
+    __size = 0
+    __counter = itertools.count()
+    __acked = LRUCache(10000)
+    __recovery_index = None
+    __recovery_mutex = threading.Lock()
+    __recovering = list()
+    __tasks = list()
+    __exit_registered = False
+    __mutex = threading.Lock()
+
+    __COMPACT_NAME = u'compact'
+
+    @staticmethod
+    def new_run_id():
+        """
+        生成运行ID，多进程模式下由父进程生成后所有worker共用
+        :return: 运行ID
+        """
+        return u'{0}{1}'.format(time.strftime(u'%Y%m%d%H%M%S'), os.getpid())
+
+    @classmethod
+    def open(cls, run_id=None, name=u'main', compactor=True):
+        """
+        打开日志
+        :param run_id: 运行ID，用于区分本次运行和上次运行的日志
+        :param name: 日志名，同一次运行中每个进程不同
+        :param compactor: 是否负责压缩日志
+        :return: 无
+        """
+        with cls.__mutex:
+            if cls.__file is not None:
+                return
+            if not os.path.exists(WAL_CONFIG[u'path']):
+                os.makedirs(WAL_CONFIG[u'path'])
+            cls.__run_id = run_id or cls.new_run_id()
+            cls.__name = name
+            cls.__segment = 0
+            cls.__recovery_index = None
+            cls.__roll()
+            if WAL_CONFIG[u'flush_interval']:
+                cls.__tasks.append(gevent.spawn(cls.__flush_loop))
+            if compactor and WAL_CONFIG[u'compact_interval']:
+                cls.__tasks.append(gevent.spawn(cls.__compact_loop))
+            if not cls.__exit_registered:
+                atexit.register(cls.close)
+                cls.__exit_registered = True
+
+    @classmethod
+    def close(cls):
+        """
+        关闭日志，写出缓冲的记录
+        :return: 无
+        """
+        gevent.killall(cls.__tasks)
+        del cls.__tasks[:]
+        with cls.__mutex:
+            if cls.__file is not None:
+                cls.__file.close()
+                cls.__file = None
+
+    @classmethod
+    def __path(cls, journal, segment):
+        return os.path.join(WAL_CONFIG[u'path'], u'{0}.{1:08d}.log'.format(journal, segment))
+
+    @classmethod
+    def __roll(cls):
+        """
+        封存当前分段并开始写新的分段，调用方需持有锁
+        :return: 无
+        """
+        if cls.__file is not None:
+            cls.__file.close()
+        cls.__segment += 1
+        cls.__file = io.open(cls.__path(u'{0}-{1}'.format(cls.__run_id, cls.__name), cls.__segment), u'ab')
+        cls.__size = 0
+
+    @classmethod
+    def __append(cls, line):
+        """
+        追加一条记录
+        :param line: 记录
+        :return: 无
+        """
+        if cls.__file is None:
+            cls.open()
+        data = line.encode(u'utf-8') if isinstance(line, unicode) else line
+        with cls.__mutex:
+            cls.__file.write(data)
+            cls.__size += len(data)
+            if not WAL_CONFIG[u'flush_interval']:
+                cls.__file.flush()
+            if cls.__size >= WAL_CONFIG[u'segment_bytes']:
+                cls.__roll()
+
+    @classmethod
+    def record(cls, plugin_id, message):
+        """
+        记录一条待处理的消息
+        :param plugin_id: 插件ID
+        :param message: 消息
+        :return: 记录标识，消息处理完成后用于确认
+        """
+        if cls.__file is None:
+            cls.open()
+        token = u'{0}-{1}:{2}'.format(cls.__run_id, cls.__name, next(cls.__counter))
+        cls.__append(u'put\t{0}\t{1}\t{2}\n'.format(
+            token, plugin_id, json.dumps(message, ensure_ascii=False, cls=CustomerJsonEncoder)))
+        return token
+
+    @classmethod
+    def ack(cls, token):
+        """
+        确认消息已处理完成，同一条消息的多个结果只确认一次
+        :param token: 记录标识
+        :return: 无
+        """
+        if token in cls.__acked:
+            return
+        cls.__acked.put(token, True)
+        cls.__append(u'ack\t{0}\n'.format(token))
+
+    @classmethod
+    def flush(cls):
+        """
+        将缓冲的记录写入操作系统
+        :return: 无
+        """
+        with cls.__mutex:
+            if cls.__file is not None:
+                cls.__file.flush()
+
+    @classmethod
+    def __flush_loop(cls):
+        while 1:
+            gevent.sleep(WAL_CONFIG[u'flush_interval'])
+            try:
+                cls.flush()
+            except Exception as e:
+                logging.exception(u'flush message journal error! - {0}'.format(e.message))
+
+    @classmethod
+    def __segments(cls):
+        """
+        列出所有日志分段
+        :return: [(文件路径, 日志名, 分段序号)]
+        """
+        segments = list()
+        for filename in os.listdir(WAL_CONFIG[u'path']):
+            parts = filename.split(u'.')
+            if len(parts) == 3 and parts[2] == u'log' and parts[1].isdigit():
+                segments.append((os.path.join(WAL_CONFIG[u'path'], filename), parts[0], int(parts[1])))
+        segments.sort(key=lambda s: (s[1], s[2]))
+        return segments
+
+    @staticmethod
+    def __read(path):
+        """
+        顺序读取日志分段中的记录，只拆分字段不解析消息内容，跳过正在写入的不完整记录
+        :param path: 文件路径
+        :return: (记录偏移量, 操作, 标识, 插件ID, 原始记录)生成器，ack记录的插件ID为None
+        """
+        try:
+            with io.open(path, u'rb') as f:
+                offset = 0
+                for line in f:
+                    start, offset = offset, offset + len(line)
+                    if not line.endswith(b'\n'):
+                        continue
+                    fields = line.rstrip(b'\n').split(b'\t', 3)
+                    if fields[0] == b'put' and len(fields) == 4:
+                        yield start, u'put', fields[1].decode(u'utf-8'), fields[2].decode(u'utf-8'), line
+                    elif fields[0] == b'ack' and len(fields) == 2:
+                        yield start, u'ack', fields[1].decode(u'utf-8'), None, line
+        except (IOError, OSError) as e:
+            logging.warning(u'read message journal({0}) error! - {1}'.format(path, e))
+
+    @classmethod
+    def __build_recovery_index(cls):
+        """
+        单次顺序扫描上次运行的日志，建立插件ID到未确认消息位置的索引，所有插件共用
+        :return: {插件ID: [(文件路径, 记录偏移量, 标识)]}
+        """
+        prefix = u'{0}-'.format(cls.__run_id)
+        acked = set()
+        index = dict()
+        count = 0
+        for path, journal, segment in cls.__segments():
+            if journal.startswith(prefix):
+                continue
+            for offset, op, token, plugin_id, line in cls.__read(path):
+                if op == u'ack':
+                    acked.add(token)
+                else:
+                    index.setdefault(plugin_id, list()).append((path, offset, token))
+                    count += 1
+        for plugin_id in list(index.keys()):
+            index[plugin_id] = [item for item in index[plugin_id] if item[2] not in acked]
+            if not index[plugin_id]:
+                index.pop(plugin_id)
+        logging.info(u'indexed {0} pending messages of {1} plugins from the message journal, {2} acked.'.format(
+            sum(len(v) for v in index.values()), len(index), count - sum(len(v) for v in index.values())))
+        return index
+
+    @classmethod
+    def recover(cls, plugin_ids):
+        """
+        从上次运行的日志中恢复未确认的消息，首次调用时建立索引，之后按插件直接定位，逐条读取
+        :param plugin_ids: 插件ID集合
+        :return: (记录标识, 消息)生成器
+        """
+        if cls.__file is None:
+            cls.open()
+        with cls.__recovery_mutex:
+            if cls.__recovery_index is None:
+                cls.__recovery_index = cls.__build_recovery_index()
+            locations = list()
+            for plugin_id in plugin_ids:
+                locations.extend(cls.__recovery_index.pop(plugin_id, list()))
+            # 恢复完成前，压缩时保留正在读取的分段
+            reading = set(location[0] for location in locations)
+            cls.__recovering.append(reading)
+        locations.sort()
+        handle, current = None, None
+        try:
+            for path, offset, token in locations:
+                if path != current:
+                    if handle is not None:
+                        handle.close()
+                        handle = None
+                    current = path
+                    try:
+                        handle = io.open(path, u'rb')
+                    except (IOError, OSError) as e:
+                        # 正在恢复的分段不会被压缩，文件不存在时说明已被外部删除
+                        logging.warning(u'open message journal({0}) error! - {1}'.format(path, e))
+                if handle is None:
+                    continue
+                handle.seek(offset)
+                line = handle.readline()
+                try:
+                    message = json.loads(line.rstrip(b'\n').split(b'\t', 3)[3])
+                except (ValueError, IndexError) as e:
+                    logging.warning(u'invalid message journal record({0}:{1})! - {2}'.format(path, offset, e))
+                    continue
+                yield token, message
+        finally:
+            if handle is not None:
+                handle.close()
+            with cls.__recovery_mutex:
+                cls.__recovering.remove(reading)
+
+    @classmethod
+    def __held_paths(cls):
+        """
+        恢复需要读取的上次运行的分段：尚未恢复的插件的消息所在分段，以及正在恢复的分段
+        :return: 文件路径集合，尚未建立恢复索引时为None，表示上次运行的分段全部保留
+        """
+        with cls.__recovery_mutex:
+            if cls.__recovery_index is None:
+                return None
+            held = set()
+            for locations in cls.__recovery_index.values():
+                held.update(location[0] for location in locations)
+            for reading in cls.__recovering:
+                held.update(reading)
+            return held
+
+    @classmethod
+    def compact(cls):
+        """
+        压缩已封存的分段：未确认的消息，以及消息记录仍在不压缩的分段中的确认记录，写入新的压缩分段，
+        之后删除已封存的分段。每次运行的各个日志中序号最大的分段为活动分段。
+        恢复的消息以上次运行的标识确认，其消息记录可能在恢复读取完毕之前保留的分段中，确认记录同样需要保留。
+        压缩分段属于本次运行，恢复时会跳过，因此上次运行的分段在恢复读取完毕之前不压缩
+        :return: 无
+        """
+        prefix = u'{0}-'.format(cls.__run_id)
+        compact_journal = prefix + cls.__COMPACT_NAME
+        segments = cls.__segments()
+        held = cls.__held_paths()
+        active = dict()
+        for path, journal, segment in segments:
+            if journal.startswith(prefix) and journal != compact_journal:
+                active[journal] = max(active.get(journal, 0), segment)
+        sealed = [s for s in segments if active.get(s[1]) != s[2] and (
+            s[1].startswith(prefix) or held is not None and s[0] not in held)]
+        if len(sealed) <= 1 and all(s[1] == compact_journal for s in sealed):
+            return
+        acked, retained_puts = set(), set()
+        sealed_paths = set(s[0] for s in sealed)
+        for path, journal, segment in segments:
+            for offset, op, token, plugin_id, line in cls.__read(path):
+                if op == u'ack':
+                    acked.add(token)
+                elif path not in sealed_paths:
+                    retained_puts.add(token)
+        number = max([s[2] for s in sealed if s[1] == compact_journal] or [0]) + 1
+        target = cls.__path(compact_journal, number)
+        kept = 0
+        with io.open(target + u'.tmp', u'wb') as f:
+            for path, journal, segment in sealed:
+                for offset, op, token, plugin_id, line in cls.__read(path):
+                    if op == u'put' and token not in acked or op == u'ack' and token in retained_puts:
+                        f.write(line)
+                        kept += 1
+        os.rename(target + u'.tmp', target)
+        for path, journal, segment in sealed:
+            os.remove(path)
+        logging.info(u'compacted {0} journal segments, {1} records kept.'.format(len(sealed), kept))
+
+    @classmethod
+    def __compact_loop(cls):
+        while 1:
+            gevent.sleep(WAL_CONFIG[u'compact_interval'])
+            try:
+                cls.compact()
+            except Exception as e:
+                logging.exception(u'compact message journal error! - {0}'.format(e.message))
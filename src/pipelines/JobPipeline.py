@@ -45,5 +45,6 @@ class JobPipeline(Pipeline):
         pk = [{u'_dataid': data_id}]
         columns = {u"parsed_data": result}
 
-        self.flow_to_ots(self.ots_instance, self.ots_table, pk, columns)
-        self.flow_to_kafka(self.kafka, kafka_record)
+        ots_result = self.flow_to_ots(self.ots_instance, self.ots_table, pk, columns)
+        # kafka中的数据通过_dataid引用OTS中的数据，OTS写入成功后再发送
+        self.flow_to_kafka(self.kafka, kafka_record, after=[ots_result])
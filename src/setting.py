@@ -4,14 +4,26 @@ PROJECT_SETTING = {
         u'class': u'',  # module名要和类名相同
         u'pipeline': u'',  # module名要和类名相同
         u'priority': 500,  # 数字越小优先级越高
+        u'queue_high_watermark': 1.0,  # 插件在队列中的消息数达到队列容量的该比例时暂停写入
+        u'queue_low_watermark': 0.8,  # 暂停写入后，插件的消息数回落到队列容量的该比例时恢复写入
+        u'dedup_keys': None,  # 结果去重字段列表，如[u'url']；为None时不去重
+        u'dedup_window': 3600,  # 结果去重的时间窗口（秒），窗口内相同字段值的结果只处理一次
+        u'dedup_max_size': 100000,  # 每个插件最多保留的结果指纹数量
 
         u'source': u'kafka',  # 消息来源，[static,kafka,mongodb,mysql,excel,csv]
         u'loop': True,  # 是否循环
         u'source_encode': u'UTF-8',  # 数据源编码，目前只有当source为CSV时才用到
+        u'csv_header': False,  # CSV表头：False-字段名为key0..keyN；True-以首行为字段名；列表-指定字段名
+        u'csv_delimiter': u',',  # CSV分隔符
+        u'file_concurrency': 4,  # excel|csv|txt同时读取的文件数
+        u'file_weights': {},  # 同时读取的文件按权重分配发送的数据量，{文件名: 权重}，默认权重为1
+        u'excel_sheets': None,  # 读取的excel sheet：None-第一个sheet；'*'-所有sheet；列表-指定的sheet名或索引
 
         # 当source为kafka时，需指定这两个参数
         u'kafka_topic': u'',  # kafka消息队列的topic
         u'kafka_group': u'',  # kafka消息队列的group
+        u'kafka_batch_size': 100,  # 单次从kafka批量获取的最大消息数量
+        u'kafka_max_wait': 5,  # 队列为空时单次获取的最长等待时间（秒）
 
         # 当source为 mysql|mongodb 时需要指定这四个参数
         u'db_service': True,  # 是否使用接口服务
@@ -19,6 +31,7 @@ PROJECT_SETTING = {
         u'db_schema': u'',  # 数据库连接模式
         u'db_table': u'',  # 数据表
         u'db_limit': 100,  # 单次查询最大数量
+        u'db_prefetch': 1,  # mongodb|mysql在发送当前页时预读的页数
         u'db_keys': [],  # 需要获取的键
         u'db_filter': {u'$e': {}, u'$ne': {}, u'$lt': {}, u'$lte': {}, u'$gt': {}, u'$gte': {}},  # 筛选条件
 
@@ -38,7 +51,8 @@ PROJECT_SETTING = {
                 u'pipeline': u'src.pipelines.qiye.job.JobPipeline',
                 u'priority': 498,
                 u'kafka_topic': u'topic_qy_auto_update',
-                u'kafka_group': u'qy_jobs'
+                u'kafka_group': u'qy_jobs',
+                u'dedup_keys': [u'url']
             },  # 招聘数据自动更新
         ],
         u'TODO': [
@@ -49,7 +63,8 @@ PROJECT_SETTING = {
                 u'pipeline': u'src.pipelines.qiye.job.JobPipeline',
                 u'priority': 498,
                 u'kafka_topic': u'topic_qy_auto_update',
-                u'kafka_group': u'qy_jobs'
+                u'kafka_group': u'qy_jobs',
+                u'dedup_keys': [u'url']
             },  # 招聘数据自动更新
         ]
     }
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import math
+import mmap
+import os
+import struct
+
+
+class BloomFilter(object):
+    """
+    持久化到内存映射文件的布隆过滤器：判断不存在时一定不存在，判断存在时有error_rate的概率误判。
+    文件名包含位数和哈希函数个数，容量或误判率配置变化后使用新的文件
+    """
+
+    def __init__(self, path, capacity, error_rate):
+        """
+        初始化，文件不存在时创建
+        :param path: 文件路径，不含扩展名
+        :param capacity: 预计的元素数量，超出后误判率上升
+        :param error_rate: 达到预计数量时的误判率
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.size = (bits + 7) // 8
+        self.bits = self.size * 8
+        self.hashes = max(1, int(round(float(self.bits) / capacity * math.log(2))))
+        self.filename = u'{0}.{1}.{2}.bloom'.format(path, self.bits, self.hashes)
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        if not os.path.exists(self.filename):
+            with io.open(self.filename, u'wb') as f:
+                f.truncate(self.size)
+        self.__file = io.open(self.filename, u'r+b')
+        self.__map = mmap.mmap(self.__file.fileno(), self.size)
+
+    def __positions(self, key):
+        """
+        计算元素对应的位，使用两个哈希值组合出多个哈希函数
+        :param key: 元素
+        :return: 位置生成器
+        """
+        if isinstance(key, unicode):
+            key = key.encode(u'utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def __contains__(self, key):
+        for position in self.__positions(key):
+            if not ord(self.__map[position >> 3]) & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """
+        添加元素
+        :param key: 元素
+        :return: 添加前是否可能已存在
+        """
+        existed = True
+        for position in self.__positions(key):
+            index, mask = position >> 3, 1 << (position & 7)
+            value = ord(self.__map[index])
+            if not value & mask:
+                existed = False
+                self.__map[index] = chr(value | mask)
+        return existed
+
+    def flush(self):
+        """
+        将修改写入文件
+        :return: 无
+        """
+        self.__map.flush()
+
+    def close(self):
+        """
+        写入并关闭文件
+        :return: 无
+        """
+        self.__map.flush()
+        self.__map.close()
+        self.__file.close()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import collections
+import time
+
+
+class LRUCache(object):
+    """容量有限的LRU缓存，超出容量时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize=1024):
+        """
+        初始化
+        :param maxsize: 最大条目数
+        """
+        self.maxsize = maxsize
+        self.__data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def get(self, key, default=None):
+        """
+        获取缓存，命中时将条目移到最近使用的位置
+        :param key: 键
+        :param default: 未命中时的返回值
+        :return: 缓存值
+        """
+        try:
+            value = self.__data.pop(key)
+        except KeyError:
+            return default
+        self.__data[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        写入缓存
+        :param key: 键
+        :param value: 值
+        :return: 无
+        """
+        self.__data.pop(key, None)
+        self.__data[key] = value
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        移除缓存
+        :param key: 键
+        :param default: 不存在时的返回值
+        :return: 缓存值
+        """
+        return self.__data.pop(key, default)
+
+    def clear(self):
+        """
+        清空缓存
+        :return: 无
+        """
+        self.__data.clear()
+
+
+class TTLCache(object):
+    """容量有限且条目会过期的LRU缓存，过期的条目在访问时移除，超出容量时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        """
+        初始化
+        :param maxsize: 最大条目数
+        :param ttl: 条目的默认有效时间（秒）
+        """
+        self.ttl = ttl
+        self.__data = LRUCache(maxsize)
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return self.get(key, TTLCache) is not TTLCache
+
+    def get(self, key, default=None):
+        """
+        获取未过期的缓存
+        :param key: 键
+        :param default: 未命中或已过期时的返回值
+        :return: 缓存值
+        """
+        item = self.__data.get(key)
+        if item is None:
+            return default
+        if item[1] <= time.time():
+            self.__data.pop(key)
+            return default
+        return item[0]
+
+    def put(self, key, value, ttl=None):
+        """
+        写入缓存
+        :param key: 键
+        :param value: 值
+        :param ttl: 有效时间（秒），默认使用初始化时的有效时间
+        :return: 无
+        """
+        self.__data.put(key, (value, time.time() + (self.ttl if ttl is None else ttl)))
+
+    def pop(self, key, default=None):
+        """
+        移除缓存
+        :param key: 键
+        :param default: 不存在时的返回值
+        :return: 缓存值
+        """
+        item = self.__data.pop(key)
+        return default if item is None else item[0]
+
+    def clear(self):
+        """
+        清空缓存
+        :return: 无
+        """
+        self.__data.clear()
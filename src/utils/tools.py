@@ -16,6 +16,9 @@ from logging.handlers import RotatingFileHandler
 import gevent
 import magic
 
+from src.config import PLUGIN_ID_SCHEMA
+from src.utils.cache import LRUCache
+
 if sys.version_info < (3, 4):
     import cPickle
     from urllib import quote
@@ -25,6 +28,9 @@ else:
     from urllib.parse import quote
     from urllib.parse import urlencode
 
+# 按对象标识缓存插件ID，只用于不会再被修改的配置对象
+_PLUGIN_ID_MEMO = LRUCache(1024)
+
 
 def allot_logger(name=None, filename=None, level=None, formatter=None):
     """
@@ -178,10 +184,64 @@ def hmac_sha512(key, text):
     return h.hexdigest()
 
 
-def build_plugin_id(param):
+def _canonical(param):
+    """
+    将参数转换为顺序确定的结构：字典转换为按键排序的键值对列表，集合排序
+    :param param: 参数
+    :return: 转换结果
+    """
+    if isinstance(param, dict):
+        return [[key, _canonical(param[key])] for key in sorted(param.keys())]
+    if isinstance(param, (list, tuple)):
+        return [_canonical(element) for element in param]
+    if isinstance(param, (set, frozenset)):
+        return sorted(_canonical(element) for element in param)
+    return param
+
+
+def canonical_dumps(param):
+    """
+    将参数序列化为规范文本，内容相同的参数得到相同的结果
+    :param param: 参数
+    :return: 规范文本
+    """
+    # 不使用sort_keys，python2下sort_keys会退回到纯python实现的编码器
+    return json.dumps(_canonical(param), separators=(u',', u':'), default=str)
+
+
+def build_plugin_id(param, memo=False, legacy=None):
     """
     根据配置参数构造插件的ID
     :param param: 配置参数
+    :param memo: 是否按对象标识缓存结果，仅当参数对象此后不再被修改时使用
+    :param legacy: 是否使用旧版逐层MD5算法，默认由PLUGIN_ID_SCHEMA决定
+    :return: ID
+    """
+    if legacy is None:
+        legacy = PLUGIN_ID_SCHEMA == u'legacy'
+    key = (id(param), legacy)
+    if memo:
+        cached = _PLUGIN_ID_MEMO.get(key)
+        if cached is not None and cached[0] is param:
+            return cached[1]
+    if legacy:
+        plugin_id = build_legacy_plugin_id(param)
+    else:
+        try:
+            plugin_id = md5(canonical_dumps(param))
+        except Exception as e:
+            logging.exception(u'canonical dumps error! - {0}'.format(e.message))
+            plugin_id = build_legacy_plugin_id(param)
+    if memo:
+        # 同时保存参数对象的引用，避免对象被回收后id被复用
+        _PLUGIN_ID_MEMO.put(key, (param, plugin_id))
+    return plugin_id
+
+
+def build_legacy_plugin_id(param):
+    """
+    使用旧版逐层MD5算法构造插件的ID，用于读取旧版本生成的缓存文件
+    :param param: 配置参数
     :return: ID
     """
     text = u''
@@ -252,16 +312,20 @@ def pickle_read_file(filename):
     return result
 
 
-def pickle_write_file(filename, record):
+def pickle_write_file(filename, record, atomic=False):
     """
     使用pickle写文件
     :param filename: 文件名
     :param record: 需要写入文件的记录
+    :param atomic: 是否先写临时文件再重命名，避免写入中断后留下损坏的文件
     :return: 无
     """
-    with open(filename, 'wb') as f:
+    target = filename + u'.tmp' if atomic else filename
+    with open(target, 'wb') as f:
         cPickle.dump(record, f, protocol=2)
         f.flush()
+    if atomic:
+        os.rename(target, filename)
 
 
 def write_file(filename, text, add=False):
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.config import WAL_CONFIG
+from src.cores.wal import MessageJournal
+
+
+class MessageJournalCompactTest(unittest.TestCase):
+    """
+    预写日志压缩
+    """
+
+    def setUp(self):
+        self.config = dict(WAL_CONFIG)
+        self.path = tempfile.mkdtemp()
+        # 每条记录后封存分段，确认记录所在的分段都会被压缩
+        WAL_CONFIG.update({u'path': self.path, u'segment_bytes': 1, u'flush_interval': 0, u'compact_interval': 0})
+        with io.open(os.path.join(self.path, u'run1-worker0.00000001.log'), u'wb') as f:
+            f.write(b'put\trun1-worker0:0\tpA\t{"id": 0}\n')
+            f.write(b'put\trun1-worker0:1\tpB\t{"id": 1}\n')
+
+    def tearDown(self):
+        MessageJournal.close()
+        WAL_CONFIG.clear()
+        WAL_CONFIG.update(self.config)
+        shutil.rmtree(self.path)
+
+    @staticmethod
+    def __process(plugin_id):
+        """
+        按provider的方式恢复插件的消息：在本次运行的日志中重新记录后确认上次运行的记录，处理完成后确认
+        :param plugin_id: 插件ID
+        :return: 恢复的消息列表
+        """
+        messages = list()
+        for token, message in MessageJournal.recover({plugin_id}):
+            new_token = MessageJournal.record(plugin_id, message)
+            MessageJournal.ack(token)
+            MessageJournal.ack(new_token)
+            messages.append(message)
+        return messages
+
+    def test_recovered_ack_survives_compaction_while_old_segment_is_held(self):
+        MessageJournal.open(u'run2', u'worker0', compactor=False)
+        self.assertEqual([{u'id': 0}], self.__process(u'pA'))
+        # pB尚未恢复，上次运行的分段保留，pA的确认记录所在的分段被压缩
+        MessageJournal.compact()
+        self.assertEqual([{u'id': 1}], self.__process(u'pB'))
+        MessageJournal.compact()
+        MessageJournal.close()
+
+        MessageJournal.open(u'run3', u'worker0', compactor=False)
+        self.assertEqual([], list(MessageJournal.recover({u'pA'})))
+        self.assertEqual([], list(MessageJournal.recover({u'pB'})))
+
+
+if __name__ == u'__main__':
+    unittest.main()
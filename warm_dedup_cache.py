@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import argparse
+import io
+
+from src.cores.services import duplicate_client
+
+
+def get_args():
+    """
+    获取参数
+    :return: 参数集合
+    """
+    args = argparse.ArgumentParser(description=u'warm the local duplicate filter with keys exported from the service.')
+    args.add_argument(u'--type', required=True, help=u'查重数据类型')
+    args.add_argument(u'--filename', required=True, help=u'查重服务导出的关键字文件，每行一个关键字')
+    return args.parse_args()
+
+
+def read_keys(filename):
+    """
+    逐行读取关键字，跳过空行
+    :param filename: 文件名
+    :return: 关键字生成器
+    """
+    with io.open(filename, u'r', encoding=u'utf-8') as f:
+        for line in f:
+            key = line.strip()
+            if key:
+                yield key
+
+
+if __name__ == u'__main__':
+    params = get_args()
+    try:
+        print(u'Warmed {0} keys.'.format(duplicate_client.warm(params.type, read_keys(params.filename))))
+    finally:
+        duplicate_client.close()